@@ -0,0 +1,264 @@
+"""
+    End-to-end benchmark of the disk path on loop devices.
+
+    For every layout a sparse image file is attached with losetup and goes
+    through the real BlockDevice partition and format code and the MountPlan
+    mount and umount, like an install with wipe: True. Each phase is timed and
+    the subprocesses it spawns are counted by a runner wrapped around
+    Command.runner. Needs root, losetup, sgdisk and the mkfs of the layouts.
+
+    Results are written as json; --compare checks a run against a baseline and
+    exits with 1 when a phase got slower by more than the threshold or spawns
+    more subprocesses.
+
+    Usage
+    ----
+    sudo python -m benchmarks.loopdev --layouts btrfs ext4 --repeat 3 --output new.json
+    python -m benchmarks.loopdev --compare base.json new.json --threshold 0.1
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import yaml
+from sanarch.lib.command import Command
+from sanarch.lib.config import Config
+from sanarch.lib.disk.blockdevice import BlockDevice
+from sanarch.lib.disk.mount import MountPlan
+from sanarch.lib.logger import Logger
+from sanarch.lib.runner import Runner
+
+GIB = 1024 ** 3
+PHASES = ["attach", "partition", "format", "mount", "umount", "detach"]
+# Changes smaller than this are noise, whatever the threshold
+MIN_DELTA = 0.05
+
+# name -> partitions; mountpoints are relative to the mount root, the last partition uses the rest of the disk
+LAYOUTS = {
+    "btrfs": [
+        {"fs": "vfat", "size": "512m", "type": "ef00", "mountpoint": "efi"},
+        {"fs": "btrfs", "size": "0", "mountpoint": "", "mountoptions": "noatime,compress=zstd:2",
+         "subvolumes": [{"name": "@", "mountpoint": ""}, {"name": "@log", "mountpoint": "var/log"},
+                        {"name": "@pkg", "mountpoint": "var/cache/pacman/pkg"},
+                        {"name": "@snapshots", "mountpoint": ".snapshots"}]},
+    ],
+    "xfs": [
+        {"fs": "vfat", "size": "512m", "type": "ef00", "mountpoint": "efi"},
+        {"fs": "xfs", "size": "0", "mountpoint": ""},
+    ],
+    "ext4": [
+        {"fs": "vfat", "size": "512m", "type": "ef00", "mountpoint": "efi"},
+        {"fs": "ext4", "size": "0", "mountpoint": ""},
+    ],
+    # Several filesystems formatted at the same time
+    "mixed": [
+        {"fs": "vfat", "size": "512m", "type": "ef00", "mountpoint": "efi"},
+        {"fs": "ext4", "size": "2g", "mountpoint": ""},
+        {"fs": "xfs", "size": "2g", "mountpoint": "home"},
+        {"fs": "btrfs", "size": "0", "mountpoint": "srv",
+         "subvolumes": [{"name": "@srv", "mountpoint": "srv"}, {"name": "@data", "mountpoint": "data"}]},
+    ],
+}
+
+
+class CountingRunner(Runner):
+    """ Counts the commands run by another runner, by program """
+    def __init__(self, runner: Runner):
+        self.runner = runner
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    def run(self, command, input, program_name):
+        with self.lock:
+            self.counts[program_name] += 1
+        return self.runner.run(command, input, program_name)
+
+    def take(self) -> Counter:
+        with self.lock:
+            counts, self.counts = self.counts, Counter()
+        return counts
+
+
+def loop_profile(loopdev, layout, root) -> dict:
+    def mountpoint(path):
+        return str(Path(root) / path) if path else str(root)
+
+    partitions = []
+    for number, spec in enumerate(LAYOUTS[layout], 1):
+        partition = {
+            "number": number, "path": f'{loopdev}p{number}', "label": f'{spec["fs"]}{number}',
+            "type": spec.get("type", "8300"), "fs": spec["fs"], "size": spec["size"], "force-format": True,
+            "mountpoint": mountpoint(spec["mountpoint"]), "mountoptions": spec.get("mountoptions"),
+            "overwrite": True,
+        }
+        if "subvolumes" in spec:
+            partition["subvolumes"] = [{"name": subvol["name"], "mountpoint": mountpoint(subvol["mountpoint"])}
+                                       for subvol in spec["subvolumes"]]
+        partitions.append(partition)
+
+    return {"partlabel": [{"device": loopdev, "wipe": True, "partitions": partitions}], "base-packages": []}
+
+
+def wait_for_partitions(blkdev: BlockDevice, timeout = 10):
+    # The kernel creates the partition nodes of a --partscan loop device once the table is written
+    deadline = time.monotonic() + timeout
+    while not all(Path(partition.path).exists() for partition in blkdev.partitions):
+        if time.monotonic() > deadline:
+            raise Exception(f"Partitions of {blkdev.path} didn't appear")
+        time.sleep(0.01)
+
+
+def run_layout(layout, image_size, workdir, counter: CountingRunner, logger) -> dict:
+    image = Path(workdir) / f'{layout}.img'
+    root = Path(workdir) / f'{layout}-root'
+    with open(image, "wb") as f:
+        f.truncate(image_size)
+
+    phases = {}
+    def phase(name, func):
+        counter.take()
+        start = time.monotonic()
+        try:
+            return func()
+        finally:
+            phases[name] = {"seconds": time.monotonic() - start, "programs": dict(counter.take())}
+
+    loopdev = None
+    plan = None
+    try:
+        loopdev = phase("attach", lambda: Command("losetup", args=["--find", "--show", "--partscan", str(image)])()
+                        .stdout.strip())
+        profile = Path(workdir) / f'{layout}.yaml'
+        profile.write_text(yaml.safe_dump(loop_profile(loopdev, layout, root)))
+        info = Config(profile).get_device_info()[0]
+        blkdev = BlockDevice(name=Path(loopdev).name, size=str(image_size), path=loopdev, wipe=info["wipe"],
+                             part_info=info["partitions"], logger=logger)
+
+        def partition():
+            blkdev.write_partition()
+            wait_for_partitions(blkdev)
+
+        phase("partition", partition)
+        phase("format", blkdev.format_partitions)
+        plan = MountPlan.from_filesystems(partition.filesystem for partition in blkdev.partitions)
+        phase("mount", plan.mount)
+        phase("umount", plan.umount)
+        phase("detach", lambda: Command("losetup", args=["--detach", loopdev])())
+        loopdev = None
+    finally:
+        if plan and plan.mounted:
+            plan.umount(check_returncode=False)
+        if loopdev:
+            Command("losetup", args=["--detach", loopdev], check_returncode=False)()
+        image.unlink(missing_ok=True)
+
+    for result in phases.values():
+        result["subprocesses"] = sum(result["programs"].values())
+    return phases
+
+
+def summarize(runs: list[dict]) -> dict:
+    phases = {}
+    for name in PHASES:
+        results = [run[name] for run in runs if name in run]
+        if not results:
+            continue
+        seconds = [result["seconds"] for result in results]
+        phases[name] = {
+            "seconds": statistics.median(seconds), "min": min(seconds), "max": max(seconds),
+            "subprocesses": max(result["subprocesses"] for result in results), "programs": results[-1]["programs"],
+        }
+
+    return {"phases": phases, "total": sum(phase["seconds"] for phase in phases.values())}
+
+
+def git_commit():
+    cp = Command("git", args=["rev-parse", "--short", "HEAD"], cwd=str(Path(__file__).resolve().parent),
+                 check_returncode=False)()
+    return cp.stdout.strip() if cp.returncode == 0 else None
+
+
+def benchmark(args):
+    if os.geteuid() != 0:
+        sys.exit("Loop devices need root")
+
+    logger = Logger("logger-benchmark")
+    if not args.verbose:
+        logger.setLevel(logging.WARNING)
+
+    commit = git_commit()
+    counter = CountingRunner(Command.runner)
+    Command.runner = counter
+    image_size = int(args.image_size * GIB)
+    results = {"commit": commit, "image_size": image_size, "repeat": args.repeat, "layouts": {}}
+
+    with TemporaryDirectory(prefix="sanarch-bench-", dir=args.workdir) as workdir:
+        for layout in args.layouts:
+            runs = [run_layout(layout, image_size, workdir, counter, logger) for _ in range(args.repeat)]
+            results["layouts"][layout] = summary = summarize(runs)
+            print(f'{layout}: {summary["total"]:.2f}s')
+            for name, result in summary["phases"].items():
+                print(f'  {name:<10} {result["seconds"]:7.2f}s  {result["subprocesses"]:3} subprocesses')
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+
+
+def compare(base_path, new_path, threshold) -> bool:
+    base = json.loads(Path(base_path).read_text())
+    new = json.loads(Path(new_path).read_text())
+    print(f'{base.get("commit")} -> {new.get("commit")}')
+
+    regressed = False
+    for layout, result in new["layouts"].items():
+        if layout not in base["layouts"]:
+            print(f'{layout}: not in {base_path}')
+            continue
+
+        print(f'{layout}:')
+        for name, phase in result["phases"].items():
+            before = base["layouts"][layout]["phases"].get(name)
+            if not before:
+                continue
+
+            delta = phase["seconds"] - before["seconds"]
+            ratio = delta / before["seconds"] if before["seconds"] else 0.0
+            slower = delta > MIN_DELTA and ratio > threshold
+            more = phase["subprocesses"] > before["subprocesses"]
+            regressed = regressed or slower or more
+            mark = " REGRESSION" if slower or more else ""
+            print(f'  {name:<10} {before["seconds"]:7.2f}s -> {phase["seconds"]:7.2f}s ({ratio:+.0%})  '
+                  f'{before["subprocesses"]:3} -> {phase["subprocesses"]:3} subprocesses{mark}')
+
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark partitioning, formatting and mounting on loop devices")
+    parser.add_argument('--layouts', type=str, nargs='+', default=list(LAYOUTS), choices=list(LAYOUTS),
+                        help="profile layouts to run")
+    parser.add_argument('--image-size', type=float, default=8, help="size of the sparse images in GiB")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per layout; the median is kept")
+    parser.add_argument('--workdir', type=str, default=None, help="directory for the images and the mountpoints")
+    parser.add_argument('--output', type=str, default=None, help="write the results as json")
+    parser.add_argument('--compare', type=str, nargs=2, default=None, metavar=("BASE", "NEW"),
+                        help="compare two result files instead of running the benchmark")
+    parser.add_argument('--threshold', type=float, default=0.1, help="slowdown of a phase that is a regression")
+    parser.add_argument('--verbose', action='store_true', help="show the installer logs")
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare, args.threshold) else 0)
+
+    benchmark(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+    Benchmark of the mirror ranking against local mirror stand-ins.
+
+    Every local HTTP server has an injected delay before the first byte and a
+    bandwidth limit, and one server in the mirrorlist refuses connections. Like
+    the installer, the mirrors are ranked and the mirrorlist is rewritten; the
+    second ranking of the rewritten mirrorlist must come from the cache.
+
+    Usage
+    ----
+    python -m benchmarks.mirror_ranking --delays 0.3 0 0.1 --rates 8 1 4
+"""
+import argparse
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from sanarch.lib.utils.mirrors import MirrorRanker
+
+MIB = 1024 ** 2
+CHUNK = 16 * 1024
+
+
+def mirror_handler(delay, rate):
+    class MirrorHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            time.sleep(delay)
+            size = MirrorRanker.PROBE_BYTES
+            self.send_response(206)
+            self.send_header("Content-Length", str(size))
+            self.send_header("Connection", "close")
+            self.end_headers()
+
+            sent = 0
+            while sent < size:
+                nbytes = min(CHUNK, size - sent)
+                if rate:
+                    time.sleep(nbytes / rate)
+                self.wfile.write(bytes(nbytes))
+                sent += nbytes
+
+        def log_message(self, format, *args):
+            pass
+
+    return MirrorHandler
+
+
+def unused_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the mirror ranking against delayed local mirrors")
+    parser.add_argument('--delays', type=float, nargs='+', default=[0.3, 0.0, 0.1], help="seconds before the first byte")
+    parser.add_argument('--rates', type=float, nargs='+', default=[8, 1, 4], help="MiB/s per mirror (0: unlimited)")
+    parser.add_argument('--output', type=str, default=None, help="write the results as json")
+    args = parser.parse_args()
+
+    if len(args.delays) != len(args.rates):
+        parser.error("--delays and --rates need the same number of values")
+
+    servers = []
+    for delay, rate in zip(args.delays, args.rates):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), mirror_handler(delay, rate * MIB))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+
+    with TemporaryDirectory(prefix="sanarch-bench-") as tmp:
+        mirrorlist = Path(tmp) / "mirrorlist"
+        lines = [f'Server = http://127.0.0.1:{server.server_address[1]}/$repo/os/$arch\n' for server in servers]
+        lines.append(f'Server = http://127.0.0.1:{unused_port()}/$repo/os/$arch\n')
+        # Disabled by the user; neither probed nor enabled
+        lines.append('#Server = http://127.0.0.1:1/$repo/os/$arch\n')
+        mirrorlist.write_text("".join(lines))
+
+        ranker = MirrorRanker(mirrorlist=str(mirrorlist), cache_path=str(Path(tmp) / "mirrors.json"))
+        for run in ["probed", "cached"]:
+            start = time.monotonic()
+            results = ranker.rank()
+            print(f'{run} in {time.monotonic() - start:.2f}s')
+            ranker.write(results, mirrorlist)
+
+        for number, result in enumerate(results, 1):
+            print(f'{number}. {result}')
+
+        print(mirrorlist.read_text(), end="")
+
+    for server in servers:
+        server.shutdown()
+
+    if args.output:
+        Path(args.output).write_text(json.dumps([{"server": result.server, "ttfb": result.ttfb, "rate": result.rate,
+                                                  "error": result.error} for result in results], indent=2))
+
+
+if __name__ == '__main__':
+    main()
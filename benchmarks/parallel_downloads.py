@@ -0,0 +1,125 @@
+"""
+    Benchmark of the ParallelDownloads tuner against a local mirror stand-in.
+
+    A local HTTP server serves synthetic package files with an injected
+    bandwidth limit per connection, an aggregate limit and a maximum number of
+    connections served at once (like a mirror that throttles). Every transaction
+    downloads the files into a temporary cache the same way pacman does (into
+    .part files), is measured with DownloadMonitor and fed to the tuner.
+
+    Usage
+    ----
+    python -m benchmarks.parallel_downloads --max-connections 4 --initial 18
+"""
+import argparse
+import json
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from sanarch.lib.utils.download import DownloadMonitor, ParallelDownloadTuner
+
+MIB = 1024 ** 2
+CHUNK = 64 * 1024
+
+
+class Throttle:
+    """ Token bucket shared by all the connections of the server """
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next = time.monotonic()
+
+    def consume(self, nbytes):
+        if not self.rate:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            self.next = max(self.next, now) + nbytes / self.rate
+            delay = self.next - nbytes / self.rate - now
+
+        if delay > 0:
+            time.sleep(delay)
+
+
+def mirror_handler(file_size, per_connection_rate, total, slots):
+    class MirrorHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            with slots:
+                connection = Throttle(per_connection_rate)
+                self.send_response(200)
+                self.send_header("Content-Length", str(file_size))
+                self.end_headers()
+
+                sent = 0
+                while sent < file_size:
+                    nbytes = min(CHUNK, file_size - sent)
+                    connection.consume(nbytes)
+                    total.consume(nbytes)
+                    self.wfile.write(bytes(nbytes))
+                    sent += nbytes
+
+        def log_message(self, format, *args):
+            pass
+
+    return MirrorHandler
+
+
+def download(url, cache: Path):
+    name = url.rsplit("/", 1)[-1]
+    partial = cache / f'{name}.part'
+    with urllib.request.urlopen(url) as response, open(partial, "wb") as file:
+        while chunk := response.read(CHUNK):
+            file.write(chunk)
+    partial.rename(cache / name)
+
+
+def transaction(base_url, cache: Path, parallel, files, number):
+    urls = [f'{base_url}/pkg{number}-{idx}-1-x86_64.pkg.tar.zst' for idx in range(files)]
+    with DownloadMonitor(str(cache)) as monitor:
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            list(executor.map(lambda url: download(url, cache), urls))
+
+    return monitor.stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark adaptive ParallelDownloads against a throttled local mirror")
+    parser.add_argument('--transactions', type=int, default=6)
+    parser.add_argument('--files', type=int, default=16, help="packages per transaction")
+    parser.add_argument('--file-size', type=float, default=2, help="MiB per package")
+    parser.add_argument('--per-connection-rate', type=float, default=2, help="MiB/s per connection (0: unlimited)")
+    parser.add_argument('--total-rate', type=float, default=8, help="MiB/s for the whole mirror (0: unlimited)")
+    parser.add_argument('--max-connections', type=int, default=4, help="connections the mirror serves at once")
+    parser.add_argument('--initial', type=int, default=18, help="initial ParallelDownloads")
+    parser.add_argument('--output', type=str, default=None, help="write the results as json")
+    args = parser.parse_args()
+
+    handler = mirror_handler(
+        int(args.file_size * MIB), args.per_connection_rate * MIB,
+        Throttle(args.total_rate * MIB), threading.BoundedSemaphore(args.max_connections))
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_address[1]}'
+
+    tuner = ParallelDownloadTuner(args.initial)
+    results = []
+    with TemporaryDirectory(prefix="sanarch-bench-") as cache:
+        for number in range(args.transactions):
+            parallel = tuner.parallel
+            stats = transaction(base_url, Path(cache), parallel, args.files, number)
+            tuner.update(stats)
+            results.append({"parallel": parallel, "seconds": stats.seconds, "throughput": stats.throughput})
+            print(f'{number + 1}. ParallelDownloads = {parallel:2}: {stats}')
+
+    server.shutdown()
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
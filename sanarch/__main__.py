@@ -1,23 +1,21 @@
 from pathlib import Path
-import json
 from sanarch.archinstaller import ArchInstaller
 from sanarch.lib import parser
 
 def main():
-    CONTEXT_FILE_PATH = "/tmp/archsan/context.json"
-    
     args = parser.init_argparse()
     if not Path(args.config).exists():
         raise Exception(f'Profile: {args.config} does not exist.')
 
-    install_state = None
-    if args.resume and Path(CONTEXT_FILE_PATH).exists():
-        with open(CONTEXT_FILE_PATH) as context_file:
-            data = json.load(context_file)
-            install_state = data["install_state"]
-
-    installer = ArchInstaller(args.config, userpass=args.userpass, rootpass=args.rootpass)
-    installer.install(install_state=install_state)
+    installer = ArchInstaller(args.config, userpass=args.userpass, rootpass=args.rootpass,
+                              image_cache=args.image_cache, image_cache_size=args.image_cache_size,
+                              offline_repo=args.offline_repo, defer_initramfs=args.defer_initramfs, resume=args.resume,
+                              sample_interval=args.sample_resources, record=args.record, replay=args.replay,
+                              replay_latency=args.replay_latency, converge=args.converge)
+    if args.converge:
+        installer.converge()
+    else:
+        installer.install()
     
 
 if __name__ == '__main__':
@@ -1,53 +1,163 @@
 from pathlib import Path
 import shutil
-from tempfile import tempdir
+import time
+from tempfile import tempdir, mkdtemp
 from sanarch.lib.exceptions import CommandError
 from sanarch.lib.utils.pacman import Pacman
 from sanarch.lib.utils.bootloader import Bootloader, Grub, bootloader_helper
+from sanarch.lib.utils.prefetch import PackagePrefetcher
+from sanarch.lib.utils.pkgcache import PackageCache
+from sanarch.lib.utils.imagecache import BaseImageCache
+from sanarch.lib.utils.offline import OfflineRepo
+from sanarch.lib.utils.syncdb import SyncDB, SpaceEstimate
+from sanarch.lib.disk.gpt import size_to_iec
+from sanarch.lib.utils.download import DownloadMonitor, ParallelDownloadTuner
+from sanarch.lib.utils.mirrors import MirrorRanker
+from sanarch.lib.utils.keyring import KeyringProvisioner
+from sanarch.lib.utils.initramfs import DeferredInitramfs
 from sanarch.lib.disk.partition import Partition
 from sanarch.lib.general import BootMode
 from sanarch.lib.command import Command
+from sanarch.lib.chroot import ChrootSession
+from sanarch.lib.scheduler import Scheduler, Step
+from sanarch.lib.journal import Journal
+from sanarch.lib.converge import ConvergePlan, TargetState
+from sanarch.lib.trace import Tracer
+from sanarch.lib.sampler import ResourceSampler
 from sanarch.lib import exceptions
 from sanarch.lib.logger import Logger
+from sanarch.lib.runner import RecordingRunner, ReplayRunner
 from sanarch.lib import linuxcmd
 import os
+import re
 from sanarch.lib.config import Config
 from sanarch.lib.disk.blockdevice import BlockDevice
+from sanarch.lib.disk.mount import MountPlan
 import json
+from concurrent.futures import ThreadPoolExecutor, wait
 
 
 class ArchInstaller:
     LOG_DIR = '/tmp/sanarch'
     LOG_FILENAME = 'arch-install.log'
+    JOURNAL_FILENAME = 'journal.jsonl'
+    LOCK_PACMAN = "pacman-db"
+    # /etc/passwd, /etc/shadow and /etc/group
+    LOCK_ACCOUNTS = "accounts"
     MAJOR_LOOP: int = 7
     MAJOR_ROM: int = 11
-    FSTAB_PATH = "/mnt/etc/fstab"
-    # /mnt is added because chroot command is not executed
+    # Paths in the target; written through target_path() since no chroot command is executed
+    FSTAB_PATH = "/etc/fstab"
     LOCALTIME_PATH = '/etc/localtime'
-    LOCALE_GEN_PATH = '/mnt/etc/locale.gen'
-    LOCALE_LANG_PATH = '/mnt/etc/locale.conf'
-    LOCALE_KEYMAP_PATH = '/mnt/etc/vconsole.conf'
-    HOSTNAME_PATH = '/mnt/etc/hostname'
-    HOSTS_PATH = '/mnt/etc/hosts'
-    SUDOFILE_PATH = '/mnt/etc/sudoers'
-
-    def __init__(self, config_file, *, rootpass = None, userpass = None):
+    LOCALE_GEN_PATH = '/etc/locale.gen'
+    LOCALE_LANG_PATH = '/etc/locale.conf'
+    LOCALE_KEYMAP_PATH = '/etc/vconsole.conf'
+    HOSTNAME_PATH = '/etc/hostname'
+    HOSTS_PATH = '/etc/hosts'
+    SUDOFILE_PATH = '/etc/sudoers'
+    # Files of the target the installer reads itself; snapshotted when recording to seed the root of a replay
+    REPLAY_FILES = [LOCALE_GEN_PATH, HOSTS_PATH, SUDOFILE_PATH, "/etc/pacman.conf", "/etc/default/grub"]
+    # Room for filesystem overhead and the files created after the install
+    SPACE_MARGIN = 1.1
+    # Kernel image and initramfs images that each kernel installs in /boot
+    BOOT_BYTES_PER_KERNEL = 160 * 1024 ** 2
+    KERNEL_REGEX = r'^linux(-lts|-zen|-hardened|-rt|-rt-lts)?$'
+
+    def __init__(self, config_file, *, rootpass = None, userpass = None, image_cache = None, image_cache_size = None,
+                 offline_repo = None, defer_initramfs = False, resume = False, sample_interval = None, record = None,
+                 replay = None, replay_latency = 0.0, converge = False):
         self.boot_mode = BootMode.UNDEFINED
 
-        self.config = Config(config_file)
-        self.pacman = Pacman()
-
         self.blkdevs: list[BlockDevice] = []
         self.logger = Logger("Install-Log",log_dir=self.LOG_DIR, file_name=self.LOG_FILENAME)
+        # Records are written by a background thread; flushed when the install ends
+        self.logger.enable_async_output()
+        # Refuses to resume from the journal of another profile before anything is done;
+        # a converge run keeps the journal of the install
+        self.journal = Journal(Journal.fingerprint(config_file), path=f'{self.LOG_DIR}/{self.JOURNAL_FILENAME}')
+        self.journal.open(resume=resume, append=converge)
+        self.tracer = Tracer(secrets=[rootpass] + list((userpass or {}).values()))
+        Command.tracer = self.tracer
+        self.replay = None
+        if replay:
+            self.check_replay_target(Config(config_file).get_all_devs())
+            self.replay = ReplayRunner(replay, latency=replay_latency, redact=self.tracer.redact)
+            # Nothing of the target is written on the host; mountpoints of the profile are rebased on the new root
+            Command.ROOT_PATH = self.replay.seed(mkdtemp(prefix="sanarch-replay-"))
+            self.logger.info(f"Replaying the commands recorded in {replay} on {Command.ROOT_PATH}")
+            Command.runner = self.replay
+        elif record:
+            # The recording of a resumed install continues the one of the failed run
+            Command.runner = RecordingRunner(record, redact=self.tracer.redact, append=resume)
+
+        self.offline_repo = None
+        if offline_repo:
+            self.offline_repo = OfflineRepo(offline_repo, logger=self.logger)
+            self.offline_repo.build()
+            # Every pacman, on the host and in the chroot, only uses the offline repository
+            Pacman.DEFAULT_CONFIG = self.offline_repo.write_config()
+
+        # Packages in the profile are checked against the repositories before anything is done
+        self.package_index = self.load_package_index()
+        self.config = Config(config_file, package_index=self.package_index)
+        if self.package_index:
+            self.logger.info("Validated the packages in the profile against the sync databases")
+        self.pacman = Pacman()
         self.rootpass = rootpass
         self.userpass = userpass
+        # Output of the streamed commands goes to the log file as well
+        Command.logger = self.logger
+        self.sampler = None
+        if sample_interval:
+            self.sampler = ResourceSampler(self.config.get_all_devs(), interval=sample_interval,
+                                           steps=self.running_steps)
+        self.package_cache = PackageCache()
+        self.chroot_session = ChrootSession(Command.ROOT_PATH, logger=self.logger, binds=[self.package_cache.bind])
+        if self.offline_repo:
+            self.chroot_session.binds.append(self.offline_repo.bind)
+        self.prefetcher = None
+        self.prefetch_monitor = None
+        self.skip_prefetch = False
+        self.download_tuner = ParallelDownloadTuner(linuxcmd.nproc() + 2)
+        self.mirror_ranker = MirrorRanker(logger=self.logger)
+        self.mirrors = None
+        self.initramfs = DeferredInitramfs(Command.ROOT_PATH, logger=self.logger) if defer_initramfs else None
+
+        self.image_cache = None
+        if image_cache:
+            max_size = BaseImageCache.DEFAULT_MAX_SIZE
+            if image_cache_size:
+                max_size = Partition.size_to_bytes(Config.parseSize(image_cache_size))
+            self.image_cache = BaseImageCache(image_cache, max_size=max_size, logger=self.logger)
         # self.logger.disable_console_output()
         
         self.__initBlkDevice()
         
+    def check_replay_target(self, devices: list[str]):
+        # The partition tables are read for real while replaying
+        for device in devices:
+            path = Path(device)
+            if path.is_file():
+                continue
+            if path.is_block_device() and os.major(path.stat().st_rdev) == self.MAJOR_LOOP:
+                continue
+            raise Exception(f"Refusing to replay on {device}; profile devices have to be loop devices or image files")
+
+    @staticmethod
+    def target_path(path) -> str:
+        return f'{Command.ROOT_PATH}{path}'
+
+    def __rebase_mountpoints(self, partitions: list[dict]):
+        for partition in partitions:
+            partition["mountpoint"] = self.replay.rebase(partition["mountpoint"], Command.ROOT_PATH)
+            for subvolume in partition.get("subvolumes") or []:
+                subvolume["mountpoint"] = self.replay.rebase(subvolume["mountpoint"], Command.ROOT_PATH)
+
     def __initBlkDevice(self):
         self.blkdevs = []
         for info in self.config.get_device_info():
+            if self.replay:
+                self.__rebase_mountpoints(info["partitions"])
             bdev_info = self.scan_blockdevice(info["device"]) 
             blk = BlockDevice(
                     name=bdev_info["name"],
@@ -63,6 +173,28 @@ class ArchInstaller:
             self.blkdevs.append(blk)
 
 
+    def load_package_index(self):
+        if self.replay:
+            self.logger.warn("Validation of the packages in the profile is skipped while replaying")
+            return None
+
+        if self.offline_repo:
+            paths = [self.offline_repo.db_path]
+        else:
+            # The databases of the host may be missing or older than the mirrors
+            try:
+                Pacman(arch_chroot=False).refresh_db()
+            except CommandError as e:
+                self.logger.warn(f"Unable to refresh the sync databases; packages are validated against the "
+                                 f"databases already on the host\n{e}")
+            paths = SyncDB.default_paths()
+
+        index = SyncDB.load(paths)
+        if not index:
+            self.logger.warn("No sync databases found! Validation of the packages in the profile is skipped.")
+
+        return index
+
     def scan_blockdevice(self, device: str):
         res = linuxcmd.lsblk_json(device=device)
 
@@ -96,6 +228,31 @@ class ArchInstaller:
         
         return cp.returncode == 0
     
+    def rank_mirrors(self):
+        if self.replay:
+            self.logger.info("Mirrors are not ranked while replaying")
+            return
+
+        self.logger.info("Ranking mirrors")
+        try:
+            results = self.mirror_ranker.rank()
+        except Exception as e:
+            self.logger.warn(f"Unable to rank the mirrors, keeping {MirrorRanker.MIRRORLIST}\n{e}")
+            return
+
+        if not results:
+            self.logger.warn(f"No enabled server in {MirrorRanker.MIRRORLIST}; nothing to rank")
+            return
+
+        reachable = [result for result in results if result.ok]
+        if not reachable:
+            self.logger.warn(f"No mirror responded, keeping {MirrorRanker.MIRRORLIST}")
+            return
+
+        self.mirrors = results
+        self.mirror_ranker.write(results, MirrorRanker.MIRRORLIST)
+        self.logger.info(f"Ranked {len(reachable)} mirrors, fastest: {reachable[0]}")
+
     def update_sys_clock(self):
         try:
             Command("timedatectl", args = ["set-ntp true"], shell=True)()
@@ -109,28 +266,223 @@ class ArchInstaller:
         except Exception as e:
             raise exceptions.UpdateError(e)
 
-    def partition_disk(self):
-        for blkdev in self.blkdevs:
-            try:
+    def __rollback_blockdevice(self, blkdev: BlockDevice):
+        blkdev.load_partition_table_backup()
+        self.journal.forget("partition", blkdev.path)
+        for partition in blkdev.partitions:
+            self.journal.forget("format", partition.path)
+
+    def __partition_blockdevice(self, blkdev: BlockDevice):
+        try:
+            # The backup of a resumed install is still the one of the table before it was partitioned
+            if not self.journal.done("partition", blkdev.path):
                 blkdev.backup_partition_table()
                 remove_partitions = self.config.get_remove_partitions(blkdev.path)
-                blkdev.remove_partitions(remove_partitions)
-                blkdev.write_partition()
-                blkdev.format_partitions()
-                blkdev.mount_partitions()
-            except Exception as e:
-                blkdev.load_partition_table_backup()
-                self.logger.error(f"Unable to partition {blkdev.path}\n---\nError:\n{e}---\n")
-                raise e
+                blkdev.write_partition(remove_partitions)
+                self.journal.record("partition", blkdev.path)
+            else:
+                self.logger.info(f"{blkdev.path} is already partitioned")
+        except Exception as e:
+            self.__rollback_blockdevice(blkdev)
+            self.logger.error(f"Unable to partition {blkdev.path}\n---\nError:\n{e}---\n")
+            raise e
+
+    def __format_blockdevice(self, blkdev: BlockDevice):
+        try:
+            formatted = {partition.path for partition in blkdev.partitions if self.journal.done("format", partition.path)}
+            blkdev.format_partitions(skip=formatted,
+                                     on_formatted=lambda partition: self.journal.record("format", partition.path))
+        except Exception as e:
+            self.__rollback_blockdevice(blkdev)
+            self.logger.error(f"Unable to format {blkdev.path}\n---\nError:\n{e}---\n")
+            raise e
+
+    def mount_partitions(self):
+        # Mount barrier; runs only after every device is partitioned and formatted
+        # so that the mountpoints of all the devices are mounted as a single tree
+        filesystems = [partition.filesystem for blkdev in self.blkdevs for partition in blkdev.partitions]
+        plan = MountPlan.from_filesystems(filesystems)
+
+        try:
+            plan.mount()
+        except Exception as e:
+            plan.umount(check_returncode=False)
+            failed = [entry.source for entry in plan.failed]
+            for blkdev in self.blkdevs:
+                if any(partition.path in failed for partition in blkdev.partitions):
+                    self.__rollback_blockdevice(blkdev)
+
+            self.logger.error(f"Unable to mount {', '.join(failed)}\n---\nError:\n{e}---\n")
+            raise e
+
+        self.logger.info("Successfully mounted all partitions")
+
+    def partition_disk(self):
+        # Planning and verifying the partitions can prompt, so the devices are partitioned one at a time;
+        # partitioning is quick, formatting is what takes time and each device is formatted by its own worker
+        for blkdev in self.blkdevs:
+            self.__partition_blockdevice(blkdev)
+
+        with ThreadPoolExecutor(max_workers=max(len(self.blkdevs), 1)) as executor:
+            workers = [executor.submit(self.__format_blockdevice, blkdev) for blkdev in self.blkdevs]
+            wait(workers)
+
+        errors = [worker.exception() for worker in workers if worker.exception()]
+        if errors:
+            raise errors[0]
+
+        self.mount_partitions()
 
     def setup_parallel_download(self, arch_chroot = True):
-        cpus = linuxcmd.nproc()
-        self.pacman.setup_parallel_download(parallel_downloads=cpus+2, arch_chroot=arch_chroot)
+        # The pacman.conf of the host is left alone while replaying
+        if self.replay and not arch_chroot:
+            return
+
+        self.pacman.setup_parallel_download(parallel_downloads=self.download_tuner.parallel, arch_chroot=arch_chroot)
+
+    def tune_parallel_download(self, stats):
+        self.logger.debug(f"Downloaded {stats}")
+        previous = self.download_tuner.parallel
+        parallel = self.download_tuner.update(stats)
+        if parallel == previous:
+            return
+
+        self.logger.info(f"Changing ParallelDownloads from {previous} to {parallel}")
+        self.setup_parallel_download(arch_chroot=False)
+        if Path(f'{Command.ROOT_PATH}/etc/pacman.conf').exists():
+            self.setup_parallel_download(arch_chroot=True)
+
+    def planned_packages(self, completed = None):
+        # Packages of the steps that are still to be run
+        completed = completed or set()
+        packages = []
+        if "install_base_packages" not in completed:
+            packages += self.config.base_packages
+        if "setup_bootloader" not in completed and self.config.bootloader:
+            packages += bootloader_helper(self.config.bootloader).PACKAGES
+        if "setup_users" not in completed:
+            packages += ["sudo"]
+        if "install_packages" not in completed and self.config.packages:
+            packages += self.config.packages
+
+        return packages
+
+    def check_disk_space(self, completed = None):
+        if not self.package_index:
+            return
+
+        estimate = SpaceEstimate.of(self.package_index, self.planned_packages(completed), cached=self.package_cache.files())
+        self.logger.info(f"{len(estimate.packages)} packages to install: {size_to_iec(estimate.download_bytes)} to download, "
+                         f"{size_to_iec(estimate.installed_bytes)} installed")
+
+        # The cache moves to the target once it is mounted; only the prefetch has to fit on the host
+        cache_free = shutil.disk_usage(self.package_cache.path).free
+        if estimate.download_bytes > cache_free:
+            self.logger.warn(f"Not prefetching, not enough space in the host package cache {self.package_cache.path}: "
+                             f"{size_to_iec(estimate.download_bytes)} needed, {size_to_iec(cache_free)} available")
+            self.skip_prefetch = True
+
+        if completed and "partition_disk" in completed:
+            return
+
+        # Planned mountpoint -> block device and partition
+        mountpoints = {}
+        for blkdev in self.blkdevs:
+            for partition in blkdev.partitions:
+                if not partition.filesystem:
+                    continue
+                for entry in partition.filesystem.mount_entries():
+                    mountpoints[entry.target] = (blkdev, partition)
+
+        # Bytes of the estimate needed on each partition, from the mountpoint holding each path;
+        # the subvolumes of a btrfs partition share its space
+        needed = {}
+        where = {}
+        for path, nbytes in self.space_needed(estimate).items():
+            target = f'{Command.ROOT_PATH}{path}'
+            holders = [mountpoint for mountpoint in mountpoints if os.path.commonpath([mountpoint, target]) == mountpoint]
+            if not holders:
+                continue
+
+            mountpoint = max(holders, key=len)
+            blkdev, partition = mountpoints[mountpoint]
+            needed[partition.path] = needed.get(partition.path, 0) + nbytes
+            where.setdefault(partition.path, (mountpoint, blkdev, partition))
+
+        for path, nbytes in needed.items():
+            mountpoint, blkdev, partition = where[path]
+            nbytes = int(nbytes * self.SPACE_MARGIN)
+            size = blkdev.planned_size(partition, self.config.get_remove_partitions(blkdev.path))
+            self.logger.debug(f"{path} ({mountpoint}): {size_to_iec(nbytes)} needed, {size_to_iec(size)} planned")
+            if nbytes > size:
+                raise Exception(f"{path} ({mountpoint}) is too small: {size_to_iec(nbytes)} needed, "
+                                f"{size_to_iec(size)} planned")
+
+    def space_needed(self, estimate: SpaceEstimate) -> dict[str, int]:
+        """ Where the installed packages take their space; the paths are relative to the new root """
+        kernels = [name for name in estimate.packages if re.match(self.KERNEL_REGEX, name)]
+        # Nearly all of the installed files end up under /usr; the initramfs images are generated in /boot
+        return {"/usr": estimate.installed_bytes, "/boot": len(kernels) * self.BOOT_BYTES_PER_KERNEL,
+                PackageCache.TARGET_PATH: estimate.download_bytes}
+
+    def prefetch_packages(self, completed = None):
+        packages = self.planned_packages(completed)
+        self.setup_parallel_download(arch_chroot=False)
+        self.package_cache.snapshot("start")
+        if self.skip_prefetch:
+            return
+
+        self.prefetcher = PackagePrefetcher(packages, logger=self.logger)
+        self.prefetch_monitor = DownloadMonitor(self.package_cache.path).start()
+        self.prefetcher.start()
+
+    def finish_prefetch(self):
+        # Download errors are only logged; the transactions download what is missing
+        if self.prefetcher:
+            self.prefetcher.wait()
+            self.package_cache.snapshot("prefetched")
+            self.tune_parallel_download(self.prefetch_monitor.stop())
+            self.prefetcher = None
+            self.prefetch_monitor = None
+
+        # The host package cache is left alone while replaying
+        self.package_cache.move_to(Command.ROOT_PATH, move_files=not self.replay)
+
+    def open_chroot(self):
+        # pacman in the chroot shares the host cache with the prefetch; waited for here as well
+        # because install_base_packages is skipped when resuming past it
+        self.finish_prefetch()
+        self.chroot_session.open()
 
     def install_base_packages(self):
+        # pacstrap shares the host cache with the prefetch
+        self.finish_prefetch()
+
         self.logger.info("Installing base packages")
         packages = self.config.base_packages
-        linuxcmd.packstrap(packages)
+
+        # The key depends on the sync databases, which are refreshed by the prefetch
+        variant = "defer-initramfs" if self.initramfs else ""
+        key = self.image_cache.key(packages, variant=variant) if self.image_cache else None
+        if key and self.image_cache.extract(key, Command.ROOT_PATH):
+            self.logger.info("Installed Base Packages from the image cache")
+        else:
+            with DownloadMonitor(self.package_cache.path) as monitor:
+                linuxcmd.packstrap(packages, host_cache=True, config=Pacman.DEFAULT_CONFIG)
+            self.tune_parallel_download(monitor.stats)
+            if key:
+                self.image_cache.store(key, Command.ROOT_PATH)
+
+        if isinstance(Command.runner, RecordingRunner):
+            Command.runner.snapshot(Command.ROOT_PATH, self.REPLAY_FILES)
+
+        if self.offline_repo:
+            # pacman in the chroot reads the configuration from the target
+            self.offline_repo.write_config(Command.ROOT_PATH)
+            self.offline_repo.replace_target_config(Command.ROOT_PATH)
+        elif self.mirrors:
+            self.mirror_ranker.write(self.mirrors, f'{Command.ROOT_PATH}{MirrorRanker.MIRRORLIST}')
+
         self.logger.info("Installed Base Packages")
 
     def generate_fstab(self):
@@ -140,26 +492,25 @@ class ArchInstaller:
         except Exception as e:
             self.logger.warning(f"partprobe unable to inform os about partition table updates\nError => {e}")
 
-        path = Path(self.FSTAB_PATH)
+        path = Path(self.target_path(self.FSTAB_PATH))
         if path.exists():
-            path.replace("/mnt/etc/fstab.bak")
+            path.replace(f'{path}.bak')
 
         self.logger.debug("Generating fstab")
-        args = ['-U', '/mnt']
+        args = ['-U', Command.ROOT_PATH]
 
         with open("/etc/fstab", "r") as fstab_default:
             default_content = fstab_default.readlines()
 
-        with open(self.FSTAB_PATH, "w") as fstab:
+        with open(path, "w") as fstab:
             default_content.append("\n")
             fstab.writelines(default_content)
 
-        with open(self.FSTAB_PATH, "a") as fstab:
+        with open(path, "a") as fstab:
             Command('genfstab', args=args, stdout=fstab)()
 
     def pacman_key_setup(self):
-        Command('pacman-key', args=['--init'])(arch_chroot=True)
-        Command('pacman-key', args=['--populate'])(arch_chroot=True)
+        return KeyringProvisioner(Command.ROOT_PATH, logger=self.logger).provision()
 
 
     def set_time_zone(self):
@@ -185,7 +536,7 @@ class ArchInstaller:
 
     def set_localization(self):
         self.logger.debug("Setting Localization information")
-        path = self.LOCALE_GEN_PATH
+        path = self.target_path(self.LOCALE_GEN_PATH)
         locales = self.config.locales
 
         with open(path, "r") as locale_gen_file:
@@ -204,12 +555,12 @@ class ArchInstaller:
         lgen = Command(name = "locale-gen")
         lgen(arch_chroot=True)
 
-        with open(self.LOCALE_LANG_PATH, "w") as locale_lang_file:
+        with open(self.target_path(self.LOCALE_LANG_PATH), "w") as locale_lang_file:
             line = f'LANG={self.config.locale_lang}\n'
             locale_lang_file.write(line)
         
         if self.config.locale_keymap:
-            with open(self.LOCALE_KEYMAP_PATH, "w") as locale_keymap_file:
+            with open(self.target_path(self.LOCALE_KEYMAP_PATH), "w") as locale_keymap_file:
                 line = f'KEYMAP={self.config.locale_keymap}\n'
                 locale_keymap_file.write(line)
         
@@ -218,13 +569,19 @@ class ArchInstaller:
     def set_network_config(self):
         self.logger.debug("Configuring network")
         hostname = self.config.hostname
-        HOSTS_LINE = f'127.0.0.1\tlocalhost\n::1\t\tlocalhost\n127.0.1.1\t{hostname}\n'
-        with open(self.HOSTNAME_PATH, "w") as hostname_file:
+        with open(self.target_path(self.HOSTNAME_PATH), "w") as hostname_file:
             line = f'{hostname}\n'
             hostname_file.write(line)
 
-        with open(self.HOSTS_PATH, "a") as hosts_file:
-            hosts_file.write(f'\n{HOSTS_LINE}')
+        # Rewritten in place so that a converge run replaces the entry of the old hostname
+        hosts = Path(self.target_path(self.HOSTS_PATH))
+        lines = hosts.read_text().splitlines() if hosts.exists() else []
+        lines = [line for line in lines if line.split()[:1] != ["127.0.1.1"]]
+        for address, tabs in [("127.0.0.1", "\t"), ("::1", "\t\t")]:
+            if not any(line.split()[:2] == [address, "localhost"] for line in lines):
+                lines.append(f'{address}{tabs}localhost')
+        lines.append(f'127.0.1.1\t{hostname}')
+        hosts.write_text("\n".join(lines) + "\n")
         
         self.logger.info("Successfully configured network")
 
@@ -247,7 +604,8 @@ class ArchInstaller:
         if self.config.bootloader:
             self.logger.debug("Installing bootloader")
             bootloader: Bootloader = bootloader_helper(self.config.bootloader)
-            bootloader.install(esp, detect_other_os=self.config.detect_other_os)
+            # The configuration lists the initramfs images, it is generated after them when they are deferred
+            bootloader.install(esp, detect_other_os=self.config.detect_other_os, configure=not self.initramfs)
 
             self.logger.info("Successfully installed bootloader")
         else:
@@ -257,8 +615,9 @@ class ArchInstaller:
         self.logger.debug("Setting sudo previlages for users")
         
         WHEEL_LINE = '%wheel ALL=(ALL:ALL) ALL'
+        path = self.target_path(self.SUDOFILE_PATH)
 
-        with open(self.SUDOFILE_PATH, "r") as sudofile:
+        with open(path, "r") as sudofile:
             lines = sudofile.readlines()
 
         for num, line in enumerate(lines):
@@ -266,15 +625,42 @@ class ArchInstaller:
                 lines[num] = WHEEL_LINE
                 break
         
-        Path(self.SUDOFILE_PATH).replace(f"{self.SUDOFILE_PATH}.bak")
-        with open(self.SUDOFILE_PATH, "w") as sudofile:
+        Path(path).replace(f"{path}.bak")
+        with open(path, "w") as sudofile:
             sudofile.writelines(lines)
         
         self.logger.debug("Updated sudo previlages for users")
 
+    def __create_user(self, user):
+        username = user["name"]
+        # Create the user
+        self.logger.debug(f"Creating user {username}")
+        try:
+            linuxcmd.useradd(username, create_home=user["create-home"], arch_chroot=True)
+        except CommandError as e:
+            if e.return_code == 9:
+                # Log
+                print("user already exists")
+            else:
+                raise e
+        
+        # Set the user password
+        if username in self.userpass.keys():
+            password = self.userpass[username]
+        else:
+            password = None
+            print("Enter the password for", username)
+        
+        linuxcmd.passwd(user=username, password=password, arch_chroot=True)
+        # Add groups to user
+        linuxcmd.user_add_groups(user=username, groups=user["groups"], arch_chroot=True)
+        self.logger.info(f"Created user {username}")
+
     def setup_users(self):
         self.logger.debug("Setting up users")
-        self.pacman.install(["sudo"])
+        if not self.journal.done("packages", Journal.digest(["sudo"])):
+            self.pacman.install(["sudo"])
+            self.journal.record("packages", Journal.digest(["sudo"]))
 
         users = self.config.users
         if not users:
@@ -282,28 +668,12 @@ class ArchInstaller:
         
         for user in users:
             username = user["name"]
-            # Create the user
-            self.logger.debug(f"Creating user {username}")
-            try:
-                linuxcmd.useradd(username, create_home=user["create-home"], arch_chroot=True)
-            except CommandError as e:
-                if e.return_code == 9:
-                    # Log
-                    print("user already exists")
-                else:
-                    raise e
-            
-            # Set the user password
-            if username in self.userpass.keys():
-                password = self.userpass[username]
-            else:
-                password = None
-                print("Enter the password for", username)
-            
-            linuxcmd.passwd(user=username, password=password, arch_chroot=True)
-            # Add groups to user
-            linuxcmd.user_add_groups(user=username, groups=user["groups"], arch_chroot=True)  
-            self.logger.info(f"Created user {username}")
+            if self.journal.done("user", username):
+                self.logger.debug(f"User {username} is already set up")
+                continue
+
+            self.__create_user(user)
+            self.journal.record("user", username)
         
         self.__set_sudo_previlage()
 
@@ -314,9 +684,20 @@ class ArchInstaller:
         if not packages:
             return
 
+        key = Journal.digest(packages)
+        if self.journal.done("packages", key):
+            self.logger.info("Packages are already installed")
+            return
+
         try:
-            self.pacman.install(packages)
+            with DownloadMonitor(self.package_cache.path) as monitor:
+                self.pacman.install(packages)
+            self.tune_parallel_download(monitor.stats)
         except CommandError as e:
+            # The packages were validated against the sync databases; a failure isn't a missing package
+            if self.package_index:
+                raise e
+
             for line in e.msg.splitlines():
                 if "error" in line:
                     res = line.split(":")
@@ -326,6 +707,7 @@ class ArchInstaller:
                         packages.remove(package)
             self.pacman.install(packages)
 
+        self.journal.record("packages", key)
         self.logger.info("Installed packages")
 
     def enable_serivces(self):
@@ -335,13 +717,16 @@ class ArchInstaller:
             return
         
         for service in services:
+            if self.journal.done("service", service):
+                continue
             linuxcmd.enable_sevice(service, arch_chroot=True)
+            self.journal.record("service", service)
         
         self.logger.info("Enabled system services")
 
     def run_after_scripts(self):
-        TEMP_DIR = "/mnt/temp/sanarch/scripts/"
-        dest = Path(TEMP_DIR)
+        TEMP_DIR = "/temp/sanarch/scripts/"
+        dest = Path(self.target_path(TEMP_DIR))
         dest.mkdir(parents=True, exist_ok=True)
 
         scripts = self.config.after_scripts
@@ -353,73 +738,202 @@ class ArchInstaller:
             
             shutil.copy(src, dest)
             script_name = path.split("/")[-1]
-            path = TEMP_DIR.removeprefix("/mnt") + script_name
+            path = TEMP_DIR + script_name
             args = [path]
 
             if script["args"]:
                 args += script["args"]
 
+            key = f'{name} {" ".join([script["path"]] + args[1:])}'
+            if self.journal.done("script", key):
+                self.logger.info(f"Script {key} already ran")
+                continue
+
             self.logger.info(f"Running script {name} {' '.join(args)}")
-            Command(name, args=args, capture_output=False)(arch_chroot=True)
-
-    def update_context(self, curr_install_state):
-        context = {"install_state": curr_install_state}
-        Path("/tmp/sanarch").mkdir(parents=True, exist_ok=True)
-        with open("/tmp/sanarch/context.json", "w") as context_file:
-            json.dump(context, context_file)
-
-    def install(self, install_state = 0):
-        if install_state is None:
-            install_state = 0
-         
-        curr_install_state = install_state
+            Command(name, args=args, stream=True)(arch_chroot=True)
+            self.journal.record("script", key)
+
+    def restore_pacman_config(self):
+        if not self.offline_repo:
+            return
+
+        if self.offline_repo.restore_target_config(Command.ROOT_PATH):
+            self.setup_parallel_download(arch_chroot=True)
+            self.logger.info(f"Restored {OfflineRepo.TARGET_CONFIG_PATH} of the target")
+
+    def finalize_initramfs(self):
+        initramfs = self.initramfs
+        if not initramfs:
+            # Left by an earlier run with --defer-initramfs that stopped before finalizing
+            initramfs = DeferredInitramfs(Command.ROOT_PATH, logger=self.logger)
+            if not initramfs.suppressed() and not initramfs.pending():
+                return
+
+        initramfs.finalize()
+        if self.config.bootloader:
+            bootloader_helper(self.config.bootloader).mkconfig()
+
+    def restore_initramfs(self):
+        # The target must never be left with the mkinitcpio hook overridden
+        initramfs = self.initramfs or DeferredInitramfs(Command.ROOT_PATH, logger=self.logger)
+        if initramfs.suppressed():
+            initramfs.restore()
+            if initramfs.pending():
+                self.logger.warn(f"The initramfs isn't generated yet; it is generated when the install is resumed "
+                                 f"({DeferredInitramfs.PENDING_PATH})")
+
+    def install_steps(self) -> list[Step]:
+        pacman, accounts = self.LOCK_PACMAN, self.LOCK_ACCOUNTS
+
+        def base_packages():
+            self.setup_parallel_download(arch_chroot=False)
+            self.install_base_packages()
+
+        def packages():
+            self.setup_parallel_download(arch_chroot=True)
+            self.install_packages()
+
+        steps = [
+            Step("update_sys_clock", self.update_sys_clock),
+            Step("partition_disk", self.partition_disk),
+            # Package transactions are what run the mkinitcpio hooks, the override is kept in place on every install
+            Step("suppress_initramfs", self.initramfs.suppress if self.initramfs else lambda: None,
+                 requires=["partition_disk"], checkpoint=False),
+            Step("install_base_packages", base_packages,
+                 requires=["update_sys_clock", "partition_disk", "suppress_initramfs"], locks=[pacman]),
+            Step("generate_fstab", self.generate_fstab, requires=["install_base_packages"]),
+            # Opened only after genfstab so that the api filesystems don't end up in the fstab
+            Step("open_chroot", self.open_chroot, requires=["generate_fstab"], checkpoint=False),
+            Step("pacman_key_setup", self.pacman_key_setup, requires=["open_chroot"], locks=[pacman]),
+            Step("set_time_zone", self.set_time_zone, requires=["open_chroot"]),
+            Step("set_localization", self.set_localization, requires=["open_chroot"]),
+            Step("set_network_config", self.set_network_config, requires=["install_base_packages"]),
+            Step("set_root_password", self.set_root_password, requires=["open_chroot"], locks=[accounts]),
+            Step("setup_bootloader", self.setup_bootloader, requires=["pacman_key_setup"], locks=[pacman]),
+            # Install scriptlets and the sysusers hook of package transactions add users as well
+            Step("setup_users", self.setup_users, requires=["pacman_key_setup"], locks=[pacman, accounts]),
+            Step("install_packages", packages, requires=["pacman_key_setup"], locks=[pacman, accounts]),
+            Step("enable_services", self.enable_serivces, requires=["install_packages"]),
+        ]
+        # After-scripts can depend on anything done before them
+        steps.append(Step("run_after_scripts", self.run_after_scripts,
+                          requires=[step.name for step in steps], locks=[pacman, accounts]))
+        # Also finishes what a deferred run left undone when this one doesn't defer
+        steps.append(Step("finalize_initramfs", self.finalize_initramfs,
+                          requires=["run_after_scripts"], locks=[pacman]))
+        # The target uses the offline repository until everything that runs pacman is done
+        steps.append(Step("restore_pacman_config", self.restore_pacman_config,
+                          requires=["finalize_initramfs"], locks=[pacman]))
+
+        return steps
+
+    def converge_plan(self) -> ConvergePlan:
+        mountpoints = []
+        for blkdev in self.blkdevs:
+            for partition in blkdev.partitions:
+                if partition.filesystem:
+                    mountpoints += [f'/{os.path.relpath(entry.target, Command.ROOT_PATH)}'
+                                    for entry in partition.filesystem.mount_entries()]
+
+        state = TargetState.inspect(Command.ROOT_PATH)
+        return ConvergePlan.of(self.config, state, self.planned_packages(), mountpoints, index=self.package_index)
+
+    def converge(self):
+        """ Applies only the changes needed for an existing install to match the profile """
+        start = time.monotonic()
         try:
-            self.verify_efi()
-            self.check_iconnection()
-            if install_state < 1:
-                self.update_sys_clock()
-                curr_install_state += 1
-            if install_state < 2:
-                self.partition_disk()
-                curr_install_state += 1
-            if install_state < 3:
-                self.setup_parallel_download(arch_chroot=False)
-                self.install_base_packages()
-                curr_install_state += 1
-            if install_state < 4:
+            # Mounts whatever isn't mounted yet; nothing is partitioned or formatted
+            MountPlan.from_filesystems(
+                partition.filesystem for blkdev in self.blkdevs for partition in blkdev.partitions).mount()
+            if not Path(f'{Command.ROOT_PATH}{PackageCache.LOCAL_DB_PATH}').is_dir():
+                raise Exception(f"No installed system found in {Command.ROOT_PATH}")
+
+            plan = self.converge_plan()
+            self.logger.info(f"Converging {Command.ROOT_PATH}: {plan}")
+            if not plan:
+                return
+
+            if plan.packages and not self.offline_repo:
+                self.check_iconnection()
+            # Before the chroot session, so that its mounts don't end up in the fstab
+            if plan.fstab:
                 self.generate_fstab()
-                curr_install_state += 1
-                self.pacman_key_setup()
-            if install_state < 5:
-                self.set_time_zone()
-                curr_install_state += 1
-            if install_state < 6:
-                self.set_localization()
-                curr_install_state += 1
-            if install_state < 7:
-                self.set_network_config()
-                curr_install_state += 1
-            if install_state < 8:
-                self.set_root_password()
-                curr_install_state += 1
-            if install_state < 9:
-                self.setup_bootloader()
-                curr_install_state += 1
-            if install_state < 10:
-                self.setup_users()
-                curr_install_state += 1
-            if install_state < 11:
+
+            self.chroot_session.open()
+            if plan.packages:
                 self.setup_parallel_download(arch_chroot=True)
-                self.install_packages()
-                curr_install_state += 1
-            if install_state < 12:
-                self.enable_serivces()
-                curr_install_state += 1
-            if install_state < 13:
-                self.run_after_scripts()
-                curr_install_state += 1
-
-            self.update_context(curr_install_state)
+                self.pacman.install(plan.packages)
+            for user in plan.users:
+                self.__create_user(user)
+            for user, groups in plan.user_groups.items():
+                linuxcmd.user_add_groups(user=user, groups=groups, arch_chroot=True)
+            for service in plan.services:
+                linuxcmd.enable_sevice(service, arch_chroot=True)
+            if plan.network:
+                self.set_network_config()
+            if plan.localization:
+                self.set_localization()
+            if plan.timezone:
+                self.set_time_zone()
+
+            self.logger.info(f"Converged {Command.ROOT_PATH} in {time.monotonic() - start:.1f}s")
+        except Exception as e:
+            import sys
+            self.logger.critical(f'{e}\nExiting...')
+            sys.exit(1)
+        finally:
+            self.chroot_session.close()
+            self.write_trace()
+            self.logger.flush()
+
+    def write_trace(self):
+        self.logger.info(self.tracer.summary())
+        try:
+            self.tracer.write(self.LOG_DIR)
+            self.logger.debug(f"Trace written to {self.LOG_DIR}/{Tracer.TRACE_FILENAME}")
+        except OSError as e:
+            self.logger.warn(f"Unable to write the trace\n{e}")
+
+    def running_steps(self) -> list[str]:
+        steps = self.tracer.running("step")
+        # The prefetch downloads in the background, alongside the steps
+        if self.prefetcher and self.prefetcher.running:
+            steps.append("prefetch")
+        return steps
+
+    def write_resource_report(self):
+        self.sampler.stop()
+        for verdict in self.sampler.verdicts():
+            self.logger.info(str(verdict))
+        try:
+            self.sampler.write(self.LOG_DIR)
+        except OSError as e:
+            self.logger.warn(f"Unable to write the resource samples\n{e}")
+
+    def install(self):
+        completed = self.journal.completed("step")
+        if self.sampler:
+            self.sampler.start()
+        def traced(name, func, *args):
+            with self.tracer.span(name, "step"):
+                return func(*args)
+
+        try:
+            traced("verify_efi", self.verify_efi)
+            if self.offline_repo:
+                self.logger.info(f"Installing from the offline repository {self.offline_repo.path}")
+            else:
+                traced("check_iconnection", self.check_iconnection)
+                traced("rank_mirrors", self.rank_mirrors)
+            traced("check_disk_space", self.check_disk_space, completed)
+            # Downloads in the background while the disks are partitioned
+            traced("prefetch_packages", self.prefetch_packages, completed)
+
+            scheduler = Scheduler(self.install_steps(), completed=completed, logger=self.logger, tracer=self.tracer,
+                                  on_complete=lambda name: self.journal.record("step", name))
+            scheduler.run()
+
+            self.logger.info(self.package_cache.report(Command.ROOT_PATH))
         except exceptions.NoInternet as e:
             import sys
             self.logger.critical("No internet connection")
@@ -428,6 +942,15 @@ class ArchInstaller:
             self.logger.warn(f"Unable to Update System Clock\n---\nError:\n{e}\n---\n")
         except Exception as e:
             self.logger.critical(f'{e}\nExiting...')
-            self.update_context(curr_install_state)
+        finally:
+            if self.prefetch_monitor:
+                self.prefetch_monitor.stop()
+            self.restore_initramfs()
+            self.chroot_session.close()
+            self.package_cache.release()
+            if self.sampler:
+                self.write_resource_report()
+            self.write_trace()
+            self.logger.flush()
         
         
@@ -1,4 +1,5 @@
 from . import command
+from . import chroot
 from . import logger
 from . import general
 from . import exceptions
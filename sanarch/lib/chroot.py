@@ -0,0 +1,117 @@
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+from sanarch.lib.command import Command
+from sanarch.lib.logger import Logger
+
+@dataclass
+class ChrootSession:
+    """
+        A long lived chroot into the target system.
+
+        arch-chroot sets up and tears down the api filesystems on every call.
+        The session mounts them once when opened, and while it is open every
+        Command executed with arch_chroot=True runs through plain chroot,
+        keeping its own exit code and stderr.
+
+        Usage
+        ----
+        with ChrootSession("/mnt"):
+            Command("locale-gen")(arch_chroot=True)
+    """
+    # (source, target relative to root, fstype, options) -- same set of mounts as arch-chroot
+    API_MOUNTS = [
+        ("proc", "proc", "proc", "nosuid,noexec,nodev"),
+        ("sys", "sys", "sysfs", "nosuid,noexec,nodev,ro"),
+        ("efivarfs", "sys/firmware/efi/efivars", "efivarfs", "nosuid,noexec,nodev"),
+        ("udev", "dev", "devtmpfs", "mode=0755,nosuid"),
+        ("devpts", "dev/pts", "devpts", "mode=0620,gid=5,nosuid,noexec"),
+        ("shm", "dev/shm", "tmpfs", "mode=1777,nosuid,nodev"),
+        ("run", "run", "tmpfs", "nosuid,nodev,mode=0755"),
+        ("tmp", "tmp", "tmpfs", "mode=1777,strictatime,nodev,nosuid"),
+    ]
+    RESOLV_CONF = "/etc/resolv.conf"
+
+    root: str = field(default=Command.ROOT_PATH)
+    logger: Logger = field(default=None)
+    # (host directory, directory in the target) bind mounted for the lifetime of the session
+    binds: list[tuple[str, str]] = field(default_factory=list)
+    mounted: list[str] = field(default_factory=list, init=False)
+
+    @property
+    def active(self):
+        return Command.chroot_session is self
+
+    def __mount(self, args, target):
+        # A file is bind mounted on a file; eg: resolv.conf
+        if not Path(target).is_file():
+            Path(target).mkdir(parents=True, exist_ok=True)
+        Command("mount", args=args + [target])()
+        self.mounted.append(target)
+
+    def __mount_api_filesystems(self):
+        for source, target, fstype, options in self.API_MOUNTS:
+            target = os.path.join(self.root, target)
+            if fstype == "efivarfs" and not Path("/sys/firmware/efi/efivars").exists():
+                continue
+
+            self.__mount(["-t", fstype, source, "-o", options], target)
+
+    def __bind_resolv_conf(self):
+        if not Path(self.RESOLV_CONF).exists():
+            return
+
+        # resolv.conf can be a (dangling) symlink to systemd-resolved in the target, leave it alone
+        target = Path(f'{self.root}{self.RESOLV_CONF}')
+        if target.is_symlink():
+            return
+        target.touch(exist_ok=True)
+
+        self.__mount(["--bind", self.RESOLV_CONF], str(target))
+
+    def __bind_dirs(self):
+        for source, target in self.binds:
+            self.__mount(["--bind", source], f'{self.root}{target}')
+
+    def open(self):
+        if self.active:
+            return self
+
+        if Command.chroot_session:
+            raise Exception(f"Another chroot session is active on {Command.chroot_session.root}")
+
+        if self.logger:
+            self.logger.debug(f"Opening chroot session on {self.root}")
+
+        try:
+            self.__mount_api_filesystems()
+            self.__bind_resolv_conf()
+            self.__bind_dirs()
+        except Exception as e:
+            self.__umount_all()
+            raise e
+
+        Command.chroot_session = self
+        return self
+
+    def __umount_all(self):
+        while self.mounted:
+            target = self.mounted.pop()
+            # Lazy unmount so that a process left behind in the chroot can't block the teardown
+            Command("umount", args=["-l", target], check_returncode=False)()
+
+    def close(self):
+        if not self.active:
+            return
+
+        if self.logger:
+            self.logger.debug(f"Closing chroot session on {self.root}")
+
+        Command.chroot_session = None
+        self.__umount_all()
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,13 +1,26 @@
-import subprocess
-
 from dataclasses import dataclass, field
 from typing import Optional
 from sanarch.lib.exceptions import CommandError
+from sanarch.lib.runner import SubprocessRunner
 from typing import Union, TextIO
  
 @dataclass
 class Command:
     ROOT_PATH = "/mnt"
+    # Set by an open ChrootSession; arch_chroot commands then reuse its mounts through plain chroot
+    chroot_session = None
+    # Tracer that times every command executed, if any
+    tracer = None
+    # Logger that the lines of streamed commands are written to, if any
+    logger = None
+    # Lines of a streamed command kept for the CommandError
+    STREAM_TAIL = 200
+    # Seconds after which an unterminated line is written anyway; eg: a prompt
+    STREAM_PARTIAL_TIMEOUT = 0.5
+    # Bytes after which an unterminated line is written anyway; eg: a long line of progress updates
+    STREAM_PARTIAL_MAX = 64 * 1024
+    # Runs every command; eg: a RecordingRunner or a ReplayRunner instead of the processes
+    runner = SubprocessRunner()
 
     """
         A base class to run linux commands
@@ -18,6 +31,10 @@ class Command:
 
         If shell is true, the command will be executed with shell
 
+        If stream is true, stdout and stderr are read line by line as the command
+        runs and written with a timestamp to the console and to the log; only the
+        last STREAM_TAIL lines are kept for the CommandError.
+
         Use the execute method to run the command or cmd_instance()
         --
 
@@ -32,9 +49,10 @@ class Command:
     stderr: Union[TextIO, int] = field(default=None)
     stdin: Union[TextIO, int] = field(default=None)
     chroot: bool = field(default=False)
+    stream: bool = field(default=False)
 
     def __post_init__(self):
-        if self.stdout or self.stderr:
+        if self.stdout or self.stderr or self.stream:
             self.capture_output = False
         
         if self.chroot:
@@ -62,34 +80,36 @@ class Command:
             
             program_name = self.name
             self.args.insert(0, self.name)
-            self.name = "arch-chroot"
-            self.args.insert(0, "/mnt")
+            if self.chroot_session:
+                self.name = "chroot"
+                self.args.insert(0, self.chroot_session.root)
+            else:
+                self.name = "arch-chroot"
+                self.args.insert(0, self.ROOT_PATH)
         else:
             # saving to name because when the command is executed with same instance name is changed to arch-chroot
             program_name = self.name
 
-        try:
-            if self.shell == False:
-                cp = subprocess.run(
-                    self.cmd, capture_output=self.capture_output, text=True, cwd=self.cwd,stdout=self.stdout, 
-                    stderr=self.stderr, stdin=self.stdin,input=input)
-            else:
-                cp = subprocess.run(
-                    self.cmd_str, shell=True, capture_output=self.capture_output, text=True, 
-                    stdout=self.stdout, stderr=self.stderr, stdin=self.stdin, cwd=self.cwd, input=input)
+        if self.tracer:
+            with self.tracer.span(program_name, "command", argv=self.cmd) as span:
+                try:
+                    cp = self.__run(input, program_name)
+                except CommandError as e:
+                    span.exit_code = e.return_code
+                    raise e
+                span.exit_code = cp.returncode
+                span.output_bytes = getattr(cp, "output_bytes", None)
+                if span.output_bytes is None:
+                    span.output_bytes = sum(len(output) for output in [cp.stdout, cp.stderr] if isinstance(output, str))
+            return cp
 
-            if cp != None and self.check_returncode:
-                cp.check_returncode()
-        except Exception as e:
-            if cp is not None:
-                raise CommandError(msg=cp.stderr, cmd=self.cmd_str, return_code=cp.returncode)
-            else:
-                raise CommandError(msg=e, cmd=self.cmd_str, return_code=-1)
+        return self.__run(input, program_name)
 
+    def __run(self, input, program_name):
+        try:
+            return self.runner.run(self, input, program_name)
         finally:
             self.name = program_name
-
-        return cp
         
     def __call__(self, input = None, arch_chroot=False):
         return self.execute(input=input, arch_chroot=arch_chroot)
@@ -14,11 +14,14 @@ class Config:
     DEFAULT_LANG = "en_US.UTF-8"
     DEFAULT_HOSTNAME = "archlinux"
 
-    def __init__(self, config_file):
+    def __init__(self, config_file, package_index = None):
         self.file = config_file
         self.__config = self.load(config_file)
         self.validate_config_params()
 
+        if package_index:
+            self.validate_packages(package_index)
+
     @property
     def partlabel(self):
         try:
@@ -166,6 +169,17 @@ class Config:
         self.validate_partlabel()
         
 
+    def validate_packages(self, package_index):
+        # package_index: SyncDB of the repositories used for the install
+        for key in ["base-packages", "packages"]:
+            packages = self.__config[key]
+            if not packages:
+                continue
+
+            missing = package_index.missing(packages)
+            if missing:
+                raise Exception(f'Packages not found in the repositories: {", ".join(missing)} ({key})')
+
     def validate_dev_params(self):
         for dev in self.partlabel:
             missingkeys = list(set(self.PARTLABEL_KEYS) - set(dev.keys()))
@@ -0,0 +1,177 @@
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional
+from sanarch.lib.command import Command
+from sanarch.lib.config import Config
+from sanarch.lib.utils.pkgcache import PackageCache
+from sanarch.lib.utils.syncdb import SyncDB
+
+@dataclass
+class TargetState:
+    """
+        What is installed and configured in a mounted target, read from its files.
+
+        Usage
+        ----
+        state = TargetState.inspect("/mnt")
+        state.packages["linux"]
+    """
+    # name -> version
+    packages: dict[str, str] = field(default_factory=dict)
+    provides: set[str] = field(default_factory=set)
+    groups: set[str] = field(default_factory=set)
+    # user -> supplementary groups
+    users: dict[str, set[str]] = field(default_factory=dict)
+    services: set[str] = field(default_factory=set)
+    hostname: Optional[str] = field(default=None)
+    locales: set[str] = field(default_factory=set)
+    locale_lang: Optional[str] = field(default=None)
+    locale_keymap: Optional[str] = field(default=None)
+    timezone: Optional[str] = field(default=None)
+    # mountpoints in the fstab
+    mountpoints: set[str] = field(default_factory=set)
+
+    @staticmethod
+    def __read(root, path) -> Optional[str]:
+        path = Path(f'{root}{path}')
+        return path.read_text() if path.is_file() else None
+
+    @staticmethod
+    def __assignments(text) -> dict[str, str]:
+        # KEY=value files; eg: locale.conf, vconsole.conf
+        values = {}
+        for line in (text or "").splitlines():
+            if "=" in line and not line.lstrip().startswith("#"):
+                key, value = line.split("=", 1)
+                values[key.strip()] = value.strip().strip('"')
+
+        return values
+
+    @classmethod
+    def inspect(cls, root = Command.ROOT_PATH) -> "TargetState":
+        state = cls()
+
+        for desc in Path(f'{root}{PackageCache.LOCAL_DB_PATH}').glob("*/desc"):
+            desc = SyncDB.parse_desc(desc.read_text())
+            state.packages[desc["NAME"][0]] = desc["VERSION"][0]
+            state.provides.update(SyncDB.strip_version(provide) for provide in desc.get("PROVIDES", []))
+            state.groups.update(desc.get("GROUPS", []))
+
+        for line in (cls.__read(root, "/etc/passwd") or "").splitlines():
+            if line.strip():
+                state.users[line.split(":")[0]] = set()
+        for line in (cls.__read(root, "/etc/group") or "").splitlines():
+            fields = line.split(":")
+            if len(fields) < 4:
+                continue
+            for user in filter(None, fields[3].split(",")):
+                state.users.setdefault(user, set()).add(fields[0])
+
+        # systemctl enable links the unit in the .wants directories of its targets
+        for link in Path(f'{root}/etc/systemd/system').glob("*.wants/*"):
+            state.services.add(link.name)
+
+        hostname = cls.__read(root, "/etc/hostname")
+        state.hostname = hostname.strip() if hostname else None
+
+        for line in (cls.__read(root, "/etc/locale.gen") or "").splitlines():
+            if line.strip() and not line.startswith("#"):
+                state.locales.add(line.strip())
+        state.locale_lang = cls.__assignments(cls.__read(root, "/etc/locale.conf")).get("LANG")
+        state.locale_keymap = cls.__assignments(cls.__read(root, "/etc/vconsole.conf")).get("KEYMAP")
+
+        localtime = Path(f'{root}/etc/localtime')
+        if localtime.is_symlink():
+            state.timezone = os.readlink(localtime).split("zoneinfo/", 1)[-1]
+
+        for line in (cls.__read(root, "/etc/fstab") or "").splitlines():
+            fields = line.split()
+            if len(fields) >= 2 and not fields[0].startswith("#") and fields[1].startswith("/"):
+                state.mountpoints.add(os.path.normpath(fields[1]))
+
+        return state
+
+    def has_package(self, name, index: SyncDB = None) -> bool:
+        if name in self.packages or name in self.provides:
+            return True
+
+        # A group is installed when all of its packages are
+        if name in self.groups:
+            members = index.groups.get(name, []) if index else []
+            return all(member in self.packages for member in members)
+
+        return False
+
+
+@dataclass
+class ConvergePlan:
+    """
+        What has to change in a target for it to match the profile.
+
+        Only additions are planned: packages, users, groups and services that
+        are in the target but not in the profile are left alone.
+    """
+    packages: list[str] = field(default_factory=list)
+    users: list[dict] = field(default_factory=list)
+    # user -> groups to add the user to
+    user_groups: dict[str, list[str]] = field(default_factory=dict)
+    services: list[str] = field(default_factory=list)
+    network: bool = field(default=False)
+    localization: bool = field(default=False)
+    timezone: bool = field(default=False)
+    fstab: bool = field(default=False)
+
+    @classmethod
+    def of(cls, config: Config, state: TargetState, packages: list[str], mountpoints: list[str],
+           index: SyncDB = None) -> "ConvergePlan":
+        """
+            packages: every package the profile installs
+            mountpoints: mountpoints of the profile relative to the target root
+        """
+        plan = cls()
+        plan.packages = [name for name in dict.fromkeys(packages) if not state.has_package(name, index)]
+
+        for user in config.users or []:
+            if user["name"] not in state.users:
+                plan.users.append(user)
+                continue
+            groups = [group for group in user["groups"] or [] if group not in state.users[user["name"]]]
+            if groups:
+                plan.user_groups[user["name"]] = groups
+
+        # systemctl accepts a unit without its suffix
+        plan.services = [
+            service for service in config.services or []
+            if (service if "." in service else f'{service}.service') not in state.services
+        ]
+        plan.network = state.hostname != config.hostname
+        plan.localization = (
+            not set(config.locales) <= state.locales
+            or state.locale_lang != config.locale_lang
+            or (config.locale_keymap is not None and state.locale_keymap != config.locale_keymap)
+        )
+        timezone = config.timezone
+        plan.timezone = bool(timezone) and state.timezone != f'{timezone["region"]}/{timezone["city"]}'
+        plan.fstab = not {os.path.normpath(mountpoint) for mountpoint in mountpoints} <= state.mountpoints
+        return plan
+
+    def __bool__(self):
+        return bool(self.packages or self.users or self.user_groups or self.services
+                    or self.network or self.localization or self.timezone or self.fstab)
+
+    def __str__(self):
+        changes = []
+        if self.packages:
+            changes.append(f'install {", ".join(self.packages)}')
+        if self.users:
+            changes.append(f'create users {", ".join(user["name"] for user in self.users)}')
+        for user, groups in self.user_groups.items():
+            changes.append(f'add {user} to {", ".join(groups)}')
+        if self.services:
+            changes.append(f'enable {", ".join(self.services)}')
+        for name in ["network", "localization", "timezone", "fstab"]:
+            if getattr(self, name):
+                changes.append(f'update the {name}')
+
+        return "; ".join(changes) if changes else "nothing to do"
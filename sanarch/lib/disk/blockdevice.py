@@ -1,9 +1,14 @@
 from sanarch.lib.config import Config
+from sanarch.lib.disk.gpt import GPTTable
+from sanarch.lib.disk.mount import MountPlan
 from sanarch.lib.disk.partition import Partition
+from sanarch.lib.disk.plan import PartitionPlan
 from sanarch.lib.exceptions import CommandError
-from sanarch.lib.linuxcmd import lsblk_json, wipefs, get_avail_space, sgdisk
+from sanarch.lib.linuxcmd import lsblk_json, wipefs, sgdisk
 from sanarch.lib.logger import Logger
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 from dataclasses import asdict, dataclass, field, InitVar
 from typing import ClassVar
 from pathlib import Path
@@ -14,6 +19,7 @@ class BlockDevice():
     PART_TABLE_BACKUP_DIR: ClassVar[str] = '/tmp/sanarch/'
     PART_KEYS_SHOW: ClassVar[list[str]] = ["name", "path", "size", "label"]
     PART_KEYS_SHOW_FULL: ClassVar[list[str]] = PART_KEYS_SHOW + ["fs", "mountpoint"]
+    FORMAT_WORKERS: ClassVar[int] = 4
 
     name: str
     size: str
@@ -126,7 +132,7 @@ class BlockDevice():
             except ValueError:
                 error_part = None
             # Look
-            proceed = input(f"Error in partition {error_part}. Do you want auto re-partition the disk?(yes/no): ")
+            proceed = self.logger.input(f"Error in partition {error_part}. Do you want auto re-partition the disk?(yes/no): ")
             if proceed.lower() == 'yes' or proceed.lower() == 'y':
                 corrected = False
                 for partition in self.avaliable_partitions:
@@ -139,7 +145,7 @@ class BlockDevice():
                 if not corrected:
                     # Look
                     self.logger.error("Unable to correct the partition error")
-                    dywc = input("Do you want to continue ?(yes/no): ").lower()
+                    dywc = self.logger.input("Do you want to continue ?(yes/no): ").lower()
                     if dywc == 'no' or dywc == 'n':
                         sys.exit()
                     else:
@@ -155,29 +161,35 @@ class BlockDevice():
         return True
         
 
-    def __wipe_and_write_partition(self):
+    def __plan_wipe(self, plan: PartitionPlan):
         self.logger.warn(f"Wiping all data in {self.path}")
-        # wipefs(self.path)
-        sgdisk(self.path, endalign=False, args=['-Z', '-o'])
+        self.avaliable_partitions = []
+        plan.clear()
 
         for partition in self.partitions:
-            partition.write_partition()
+            plan.create(partition)
 
-    def __resolve_partnum_conflict(self, partition:Partition, curr_partition:Partition):
+    @staticmethod
+    def __plan_overwrite(plan: PartitionPlan, curr_partition: Partition, new_partition: Partition):
+        # Same as overwrite_partition with usedefaultsize = False, but only recorded in the plan
+        plan.delete(curr_partition.number)
+        plan.create(new_partition)
+
+    def __resolve_partnum_conflict(self, plan: PartitionPlan, partition:Partition, curr_partition:Partition):
         self.logger.debug(f"Partition {partition.number} already exists in {self.path}")
         if partition.size == '0' and partition.overwrite:
             # Deleting and creating the partition so that all the partition with the specified parameters are created
-            self.overwrite_partition(curr_partition, new_partition=partition, usedefaultsize=False, logger=self.logger)
+            self.__plan_overwrite(plan, curr_partition, partition)
         elif partition.size == '0' and not partition.overwrite:
             # Log
             # Check if only default size option is different
             curr_partition.size = '0'
             if partition != curr_partition:
                 # Look
-                proceed = input(f'Parition-{partition.number} have different parameters with the existing one.\n\
+                proceed = self.logger.input(f'Parition-{partition.number} have different parameters with the existing one.\n\
                     Do you want to overwrite the partition? (yes/no): ')
                 if proceed.lower() in 'yes':
-                    self.overwrite_partition(curr_partition, new_partition=partition, usedefaultsize=False, logger=self.logger)
+                    self.__plan_overwrite(plan, curr_partition, partition)
                 else:
                     # Log
                     print("Change the configuration and continue")
@@ -193,93 +205,163 @@ class BlockDevice():
             elif partition.overwrite:
                 # Look
                 # Log - Optionally check if it is larger than the disk size
-                self.overwrite_partition(curr_partition, new_partition=partition, usedefaultsize=False, logger=self.logger)
+                self.__plan_overwrite(plan, curr_partition, partition)
             else:
                 raise Exception(f'No overwrite option specified for Partition-{partition.number}.\
                     \nPartition already exists.')
 
         elif partition < curr_partition:
             if partition.overwrite:
-                self.overwrite_partition(curr_partition, new_partition=partition, usedefaultsize=False, logger=self.logger)
+                self.__plan_overwrite(plan, curr_partition, partition)
             else:
                 raise Exception(f'No overwrite option specified for Partition-{partition.number}.\
                     \nPartition already exists.')
 
-    def write_partition(self):
-        self.logger.info(f"Partitioning {self.path}")
+        elif partition.type_guid != curr_partition.type_guid:
+            # Same size but a different typecode; only the type has to change
+            plan.retype(partition.number, partition.type)
+
+    def plan_partitions(self, remove_partitions: list[int] = None) -> PartitionPlan:
+        """
+            Diff the partitions in the profile against the current partition table
+            without changing anything on the disk.
+        """
+        plan = PartitionPlan(self.path)
         if self.skip_partition:
-            self.logger.debug(f"Ignoring partitioning {self.path}")
-            return
+            return plan
 
         if self.wipe:
-            self.__wipe_and_write_partition()
-        else:
-            self.logger.debug(f"Scanning current partitions in {self.path}")            
-            self.avaliable_partitions = self.load_current_partitions()
-
-            for partition in self.partitions:
-                found = False
-                for curr_partition in self.avaliable_partitions:
-                    # if curr_partition in self.part_info["remove-partitions"]:
-                    #     curr_partition.delete_partition()
-                    #     break
-
-                    if partition == curr_partition:
-                        self.logger.debug(f"Partition {curr_partition.number} already exists in {self.path}")
-                        found = True
-                        if partition.overwrite:
-                            self.overwrite_partition(curr_partition, new_partition=partition, usedefaultsize=False, logger=self.logger)
-                        else:
-                            self.logger.debug(f"Using existing partition {curr_partition.number} for {self.path}")
-                        
-                        break
+            self.__plan_wipe(plan)
+            return plan
+
+        self.logger.debug(f"Scanning current partitions in {self.path}")
+        table = GPTTable.read(self.path)
+        self.avaliable_partitions = self.load_current_partitions(table)
+        # Free space left on the disk once the operations planned so far are applied
+        free = table.free_bytes()
+
+        for partnum in remove_partitions or []:
+            entry = table.get(partnum)
+            if not entry:
+                self.logger.warn(f"{partnum} doesn't exist in {self.path}. Ignoring.")
+                continue
 
-                    elif partition.number == curr_partition.number:
-                        found = True
-                        self.__resolve_partnum_conflict(partition, curr_partition)
-                        break
- 
-                if not found:
-                    # If check exists option is specified in the config; checks if the partition exists
-                    if partition.check_exists:
-                        raise Exception(f"Partition {partition.number} doesn't exist.")
-
-                    avail_size_raw = get_avail_space(self.path)
-                    avail_size = Config.parseSize(avail_size_raw)
-                    no_space_msg = f'No space available for Partition-{partition.number}'
-
-                    # Minimum partition size should atleast be 2mib for the partition to aligned right
-                    if partition.size == '0':
-                        if Partition.cmp_size(avail_size, Partition.MIN_SIZE) == 1:
-                            partition.write_partition()
-                        else:
-                            raise Exception(no_space_msg)
+            self.logger.debug(f"Removing partitions {partnum}")
+            plan.delete(entry.number)
+            free += entry.sectors * table.sector_size
+            self.avaliable_partitions = [part for part in self.avaliable_partitions if part.number != entry.number]
+
+        for partition in self.partitions:
+            found = False
+            for curr_partition in self.avaliable_partitions:
+                if partition == curr_partition:
+                    self.logger.debug(f"Partition {curr_partition.number} already exists in {self.path}")
+                    found = True
+                    if partition.overwrite:
+                        self.__plan_overwrite(plan, curr_partition, partition)
                     else:
-                        if Partition.cmp_size(avail_size, partition.size) >= 0 and\
-                            Partition.cmp_size(avail_size, Partition.MIN_SIZE) == 1:
-                            partition.write_partition()
-                        else:
-                            # Log
-                            raise Exception(no_space_msg)
+                        self.logger.debug(f"Using existing partition {curr_partition.number} for {self.path}")
+
+                    break
 
+                elif partition.number == curr_partition.number:
+                    found = True
+                    self.__resolve_partnum_conflict(plan, partition, curr_partition)
+                    break
+
+            if found:
+                continue
+
+            # If check exists option is specified in the config; checks if the partition exists
+            if partition.check_exists:
+                raise Exception(f"Partition {partition.number} doesn't exist.")
+
+            # Minimum partition size should atleast be 2mib for the partition to aligned right
+            size = Partition.size_to_bytes(partition.size)
+            if free <= Partition.size_to_bytes(Partition.MIN_SIZE) or free < size:
+                raise Exception(f'No space available for Partition-{partition.number}')
+
+            plan.create(partition)
+            free = free - size if size else 0
+
+        return plan
+
+    def planned_size(self, partition: Partition, remove_partitions: list[int] = None) -> int:
+        """
+            Size of a planned partition in bytes. A partition of size '0' that is kept on the disk
+            keeps its current size; the new ones share what is left of the disk.
+        """
+        table = GPTTable.read(self.path)
+        removed = {int(partnum) for partnum in remove_partitions or []}
+        # Partition number -> size of the partitions on the disk once it is partitioned
+        sizes = {} if self.wipe else {entry.number: entry.sectors * table.sector_size
+                                      for entry in table.partitions if entry.number not in removed}
+        for part in self.partitions:
+            if Partition.size_to_bytes(part.size):
+                sizes[part.number] = Partition.size_to_bytes(part.size)
+
+        if partition.number in sizes:
+            return sizes[partition.number]
+
+        rest = [part for part in self.partitions if part.number not in sizes]
+        usable = (table.last_usable_lba - table.first_usable_lba + 1) * table.sector_size
+        return max(usable - sum(sizes.values()), 0) // len(rest)
+
+    def apply_partition_plan(self, plan: PartitionPlan):
+        self.logger.debug(f"Partition plan for {plan}")
+        plan.apply()
         self.verify_disk()
 
-    def format_partitions(self):
+    def write_partition(self, remove_partitions: list[int] = None):
+        self.logger.info(f"Partitioning {self.path}")
+        if self.skip_partition:
+            self.logger.debug(f"Ignoring partitioning {self.path}")
+            return
+
+        self.apply_partition_plan(self.plan_partitions(remove_partitions))
+
+    def __format_partition(self, partition: Partition):
+        start = time.monotonic()
+        partition.format()
+        elapsed = time.monotonic() - start
+        self.logger.debug(f"Formatted {partition.path} in {elapsed:.2f}s")
+
+    def format_partitions(self, skip: set[str] = None, on_formatted = None):
+        """
+            skip: paths of the partitions that are already formatted
+            on_formatted: called with each partition as soon as it is formatted
+        """
         self.logger.debug(f"Formatting partitions in {self.path}")
-        for partition in self.partitions:
-            partition.format()
-        
-        self.logger.info(f"Successfully formatted partitions in {self.path}")
+        start = time.monotonic()
+        skip = skip or set()
+        for path in sorted(skip):
+            self.logger.debug(f"{path} is already formatted")
+
+        def format_partition(partition):
+            self.__format_partition(partition)
+            if on_formatted:
+                on_formatted(partition)
+
+        # The partition table is already written, so the filesystems can be created independently
+        partitions = [partition for partition in self.partitions if partition.path not in skip]
+        with ThreadPoolExecutor(max_workers=self.FORMAT_WORKERS) as executor:
+            jobs = {executor.submit(format_partition, partition): partition for partition in partitions}
+            wait(jobs)
+
+        for job in jobs:
+            if job.exception():
+                raise job.exception()
+
+        self.logger.info(f"Successfully formatted partitions in {self.path} in {time.monotonic() - start:.2f}s")
 
     def mount_partitions(self):
-        partitions = sorted(self.partitions, key=lambda partition: partition.filesystem.mountpoint.count("/"))
         self.logger.debug(f"Mounting partitions in {self.path}")
-        for partition in partitions:
-            partition.mount()
+        plan = MountPlan.from_filesystems(partition.filesystem for partition in self.partitions)
+        plan.mount()
         
         self.logger.info(f"Successfully mounted partitions in {self.path}")
 
-    def load_current_partitions(self) -> list[Partition]:
+    def load_current_partitions(self, table: GPTTable = None) -> list[Partition]:
         res = lsblk_json(device=self.path)
         info = json.loads(res.stdout)
         if "blockdevices" not in info:
@@ -293,7 +375,11 @@ class BlockDevice():
         else:
             curr_partitions_info = []
 
-        part_typecodes = Partition.get_part_typecodes(self.path)
+        if table:
+            part_typecodes = table.typecodes()
+        else:
+            part_typecodes = Partition.get_part_typecodes(self.path)
+
         for partition in curr_partitions_info:
             partnum = partition["path"][-1]
             partcode = part_typecodes[partnum]
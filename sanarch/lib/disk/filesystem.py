@@ -1,7 +1,10 @@
 from abc import ABC, abstractmethod
 from dataclasses import dataclass, field
 from sanarch.lib.command import Command
+from sanarch.lib.disk.mount import MountEntry, MountPlan
 from pathlib import Path
+import os
+from tempfile import mkdtemp
 from typing import Optional
 
 def filesystem_helper(fstype, path, mountpoint, force_format, mountoptions, subvolumes):
@@ -26,16 +29,21 @@ class FileSystem(ABC):
     mountoptions: Optional[str] = field(default=None)
 
     
+    def mount_entries(self) -> list[MountEntry]:
+        """
+            Mounts needed for this filesystem
+        """
+        if not self.mountpoint:
+            raise Exception("Invalid mountpoint")
+
+        return [MountEntry(self.devpath, self.mountpoint)]
+
     def mount(self):
         """ 
             Mount the partition to the specified mountpoint  
         """
         # Creates the mountpoint directory if it doesn't exist.
-        if not self.mountpoint:
-            raise Exception("Invalid mountpoint")
-
-        Path(self.mountpoint).mkdir(parents=True, exist_ok=True)
-        return Command('mount', args=[self.devpath, self.mountpoint])()
+        MountPlan(self.mount_entries()).mount()
     
     def umount(self, check_returncode = True):
         """
@@ -55,21 +63,29 @@ class Btrfs(FileSystem):
         if not self.subvolumes:
             raise Exception("No subvolumes")
 
-        super().mount()
+        # Mounted on a private directory rather than the mountpoint, so that formatting
+        # can run alongside the other partitions before anything is mounted on the target
+        topdir = mkdtemp(prefix="sanarch-btrfs-")
+        mounted = False
         try:
+            Command('mount', args=[self.devpath, topdir])()
+            mounted = True
             for subvol in self.subvolumes:
-                csubvol_args = ['sub', 'cr', f'{self.mountpoint}/{subvol["name"]}']
-                Command('btrfs', args=csubvol_args, cwd=self.mountpoint)()
-        except Exception as e:
-            raise e
+                csubvol_args = ['sub', 'cr', f'{topdir}/{subvol["name"]}']
+                Command('btrfs', args=csubvol_args, cwd=topdir)()
         finally:
-            super().umount()
+            if mounted:
+                super().umount()
+            # Not reached when the umount fails; rmdir never deletes the content of the filesystem
+            os.rmdir(topdir)
     
-    def mount(self):
+    def mount_entries(self) -> list[MountEntry]:
+        entries = []
         for subvol in self.subvolumes:
-            args = ['-o', f'{self.mountoptions},subvol={subvol["name"]}', self.devpath, subvol["mountpoint"]]
-            Path(subvol["mountpoint"]).mkdir(parents=True, exist_ok=True)
-            Command('mount', args=args)()
+            options = ','.join(option for option in [self.mountoptions, f'subvol={subvol["name"]}'] if option)
+            entries.append(MountEntry(self.devpath, subvol["mountpoint"], options))
+
+        return entries
 
     def format(self):
         if self.label:
@@ -0,0 +1,426 @@
+import os
+import stat
+import struct
+import uuid
+import zlib
+from dataclasses import dataclass, field
+from typing import ClassVar, Optional
+from sanarch.lib.exceptions import GPTError
+
+# sgdisk typecodes for the partition type GUIDs sanarch deals with
+TYPECODES = {
+    "C12A7328-F81F-11D2-BA4B-00A0C93EC93B": "EF00",  # EFI system partition
+    "21686148-6449-6E6F-744E-656564454649": "EF02",  # BIOS boot partition
+    "BC13C2FF-59E6-4262-A352-B275FD6F7172": "EA00",  # XBOOTLDR
+    "0FC63DAF-8483-4772-8E79-3D69D8477DE4": "8300",  # Linux filesystem
+    "0657FD6D-A4AB-43C4-84E5-0933C84B4F4F": "8200",  # Linux swap
+    "933AC7E1-2EB4-4F13-B844-0E14E2AEF915": "8302",  # Linux /home
+    "4F68BCE3-E8CD-4DB1-96E7-FBCAF984B709": "8304",  # Linux x86-64 root
+    "CA7D7CCB-63ED-4C53-861C-1742536059CC": "8309",  # Linux LUKS
+    "E6D6D379-F507-44C2-A23C-238F2A3DF928": "8E00",  # Linux LVM
+    "A19D880F-05FC-4D3B-A006-743F0F84911E": "FD00",  # Linux RAID
+    "E3C9E316-0B5C-4DB8-817D-F92DF00215AE": "0C01",  # Microsoft reserved
+    "EBD0A0A2-B9E5-4433-87C0-68B6B72699C7": "0700",  # Microsoft basic data
+    "DE94BBA4-06D1-4D40-A16A-BFD50179D6AC": "2700",  # Windows RE
+    "024DEE41-33E7-11D3-9D69-0008C781F39F": "EF01",  # MBR partition scheme
+    "8DA63339-0007-60C0-C436-083AC8230908": "8301",  # Linux reserved
+    "44479540-F297-41B2-9AF7-D131D5F0458A": "8303",  # Linux x86 root
+    "B921B045-1DF0-41C3-AF44-4C6F280D3FAE": "8305",  # Linux ARM64 root
+    "3B8F8425-20E0-4F3B-907F-1A25A76F98E8": "8306",  # Linux /srv
+    "69DAD710-2CE4-4E3C-B16C-21A1D49ABED3": "8307",  # Linux ARM32 root
+    "7FFEC5C9-2D00-49B7-8941-3EA10A5586B7": "8308",  # Linux dm-crypt
+    "4D21B016-B534-45C2-A9FB-5C16E091FD2D": "8310",  # Linux /var
+    "7EC6F557-3BC5-4ACA-B293-16EF5DF639D1": "8311",  # Linux /var/tmp
+    "773F91EF-66D4-49B5-BD83-D683BF40AD16": "8312",  # Linux user's home
+    "AF9B60A0-1431-4F62-BC68-3311714A69AD": "4200",  # Windows LDM data
+    "5808C8AA-7E8F-42E0-85D2-E1E90434CFB3": "4201",  # Windows LDM metadata
+    "E75CAF8F-F680-4CEE-AFA3-B001E56EFC2D": "4202",  # Windows Storage Spaces
+    "D3BFE2DE-3DAF-11DF-BA40-E3A556D89593": "8400",  # Intel Rapid Start
+    "FE3A2A5D-4F32-41A7-B725-ACCC3285A309": "7F00",  # ChromeOS kernel
+    "3CB8E202-3B7E-47DD-8A3C-7FF2A13CFCEC": "7F01",  # ChromeOS root
+    "2E0A753D-9E48-43B0-8337-B15192CB1B5E": "7F02",  # ChromeOS reserved
+    "516E7CB4-6ECF-11D6-8FF8-00022D09712B": "A500",  # FreeBSD disklabel
+    "83BD6B9D-7F41-11DC-BE0B-001560B84F0F": "A501",  # FreeBSD boot
+    "516E7CB5-6ECF-11D6-8FF8-00022D09712B": "A502",  # FreeBSD swap
+    "516E7CB6-6ECF-11D6-8FF8-00022D09712B": "A503",  # FreeBSD UFS
+    "516E7CBA-6ECF-11D6-8FF8-00022D09712B": "A504",  # FreeBSD ZFS
+    "516E7CB8-6ECF-11D6-8FF8-00022D09712B": "A505",  # FreeBSD Vinum/RAID
+    "824CC7A0-36A8-11E3-890A-952519AD3F61": "A600",  # OpenBSD disklabel
+    "49F48D32-B10E-11DC-B99B-0019D1879648": "A901",  # NetBSD swap
+    "49F48D5A-B10E-11DC-B99B-0019D1879648": "A902",  # NetBSD FFS
+    "55465300-0000-11AA-AA11-00306543ECAC": "A800",  # Apple UFS
+    "426F6F74-0000-11AA-AA11-00306543ECAC": "AB00",  # Apple boot
+    "48465300-0000-11AA-AA11-00306543ECAC": "AF00",  # Apple HFS/HFS+
+    "52414944-0000-11AA-AA11-00306543ECAC": "AF01",  # Apple RAID
+    "52414944-5F4F-11AA-AA11-00306543ECAC": "AF02",  # Apple RAID offline
+    "4C616265-6C00-11AA-AA11-00306543ECAC": "AF03",  # Apple label
+    "53746F72-6167-11AA-AA11-00306543ECAC": "AF05",  # Apple Core Storage
+    "7C3457EF-0000-11AA-AA11-00306543ECAC": "AF0A",  # Apple APFS
+    "6A82CB45-1DD2-11B2-99A6-080020736631": "BF00",  # Solaris boot
+    "6A85CF4D-1DD2-11B2-99A6-080020736631": "BF01",  # Solaris root
+    "6A87C46F-1DD2-11B2-99A6-080020736631": "BF02",  # Solaris swap
+    "6A8B642B-1DD2-11B2-99A6-080020736631": "BF03",  # Solaris backup
+    "6A898CC3-1DD2-11B2-99A6-080020736631": "BF04",  # Solaris /usr
+    "6A8EF2E9-1DD2-11B2-99A6-080020736631": "BF05",  # Solaris /var
+    "6A90BA39-1DD2-11B2-99A6-080020736631": "BF06",  # Solaris /home
+    "6A9283A5-1DD2-11B2-99A6-080020736631": "BF07",  # Solaris alternate sector
+    "AA31E02A-400F-11DB-9590-000C2911D1B8": "FB00",  # VMware VMFS
+    "9198EFFC-31C0-11DB-8F78-000C2911D1B8": "FB01",  # VMware reserved
+    "9D275380-40AD-11DB-BF97-000C2911D1B8": "FC00",  # VMware kcore crash protection
+    "42465331-3BA3-10F1-802A-4861696B7521": "EB00",  # Haiku BFS
+}
+TYPEGUIDS = {code: guid for guid, code in TYPECODES.items()}
+# MBR partition type -> sgdisk typecode, for the partitions of a disk without a GPT
+MBR_TYPECODES = {
+    0x07: "0700", 0x0B: "0700", 0x0C: "0700", 0x27: "2700", 0x82: "8200", 0x83: "8300",
+    0x8E: "8E00", 0xEF: "EF00", 0xFD: "FD00",
+}
+MBR_EXTENDED = [0x05, 0x0F, 0x85]
+
+def typecode(type_guid: str) -> str:
+    """ sgdisk typecode of a type GUID, the GUID itself if it has none """
+    return TYPECODES.get(type_guid.upper(), type_guid.upper())
+
+def type_guid(code: str) -> str:
+    """ Type GUID of a sgdisk typecode; GUIDs are passed through """
+    code = code.upper()
+    if code in TYPEGUIDS:
+        return TYPEGUIDS[code]
+
+    try:
+        return str(uuid.UUID(code)).upper()
+    except ValueError:
+        raise GPTError(f"Unknown partition typecode: {code}")
+
+def size_to_iec(nbytes: int) -> str:
+    """ Human readable size in the same format as sgdisk (eg: 12.5 GiB) """
+    if nbytes < 1024:
+        return f'{nbytes} bytes'
+
+    value = float(nbytes)
+    for unit in ["KiB", "MiB", "GiB", "TiB", "PiB"]:
+        value /= 1024
+        if value < 1024 or unit == "PiB":
+            return f'{value:.1f} {unit}'
+
+
+@dataclass
+class GPTEntry:
+    ENTRY_FORMAT: ClassVar[str] = "<16s16sQQQ72s"
+
+    number: int
+    type_guid: str
+    unique_guid: str
+    first_lba: int
+    last_lba: int
+    attributes: int = field(default=0)
+    name: str = field(default="")
+
+    @property
+    def typecode(self):
+        return typecode(self.type_guid)
+
+    @property
+    def sectors(self):
+        return self.last_lba - self.first_lba + 1
+
+    @classmethod
+    def unpack(cls, number, raw: bytes) -> Optional["GPTEntry"]:
+        type_raw, unique_raw, first_lba, last_lba, attributes, name_raw = struct.unpack_from(cls.ENTRY_FORMAT, raw)
+        # Unused entries have a zero type GUID
+        if type_raw == bytes(16):
+            return None
+
+        name = name_raw.decode("utf-16-le").split("\0", 1)[0]
+        return cls(
+            number=number,
+            type_guid=str(uuid.UUID(bytes_le=type_raw)).upper(),
+            unique_guid=str(uuid.UUID(bytes_le=unique_raw)).upper(),
+            first_lba=first_lba,
+            last_lba=last_lba,
+            attributes=attributes,
+            name=name,
+        )
+
+    def pack(self, entry_size) -> bytes:
+        raw = struct.pack(
+            self.ENTRY_FORMAT,
+            uuid.UUID(self.type_guid).bytes_le,
+            uuid.UUID(self.unique_guid).bytes_le,
+            self.first_lba,
+            self.last_lba,
+            self.attributes,
+            self.name.encode("utf-16-le")[:72],
+        )
+        return raw.ljust(entry_size, b"\0")
+
+
+@dataclass
+class GPTTable:
+    """
+        GUID partition table read straight from a block device or a disk image.
+
+        Usage
+        ----
+        table = GPTTable.read("/dev/sda")
+        table.typecodes()     # {"1": "EF00", "2": "8300"}
+        table.free_extents()  # [(first_lba, last_lba), ...]
+    """
+    SIGNATURE: ClassVar[bytes] = b"EFI PART"
+    REVISION: ClassVar[int] = 0x00010000
+    HEADER_FORMAT: ClassVar[str] = "<8sIIIIQQQQ16sQIII"
+    HEADER_SIZE: ClassVar[int] = 92
+    SECTOR_SIZES: ClassVar[list[int]] = [512, 4096]
+    DEFAULT_ENTRIES: ClassVar[int] = 128
+    DEFAULT_ENTRY_SIZE: ClassVar[int] = 128
+    ALIGNMENT: ClassVar[int] = 2048 # sectors; 1MiB with 512 byte sectors like sgdisk
+    BLKSSZGET: ClassVar[int] = 0x1268
+    BLKGETSIZE64: ClassVar[int] = 0x80081272
+    BLKRRPART: ClassVar[int] = 0x125f
+
+    path: str
+    sector_size: int
+    total_sectors: int
+    disk_guid: str
+    first_usable_lba: int
+    last_usable_lba: int
+    entries_lba: int = field(default=2)
+    num_entries: int = field(default=DEFAULT_ENTRIES)
+    entry_size: int = field(default=DEFAULT_ENTRY_SIZE)
+    partitions: list[GPTEntry] = field(default_factory=list)
+
+    @staticmethod
+    def __device_geometry(fd):
+        mode = os.fstat(fd).st_mode
+        if not stat.S_ISBLK(mode):
+            return None, os.fstat(fd).st_size
+
+        import fcntl
+        buf = fcntl.ioctl(fd, GPTTable.BLKSSZGET, struct.pack("I", 0))
+        sector_size = struct.unpack("I", buf)[0]
+        buf = fcntl.ioctl(fd, GPTTable.BLKGETSIZE64, struct.pack("Q", 0))
+        return sector_size, struct.unpack("Q", buf)[0]
+
+    @classmethod
+    def read(cls, path) -> "GPTTable":
+        with open(path, "rb", buffering=0) as disk:
+            fd = disk.fileno()
+            sector_size, size = cls.__device_geometry(fd)
+            sector_sizes = [sector_size] if sector_size else cls.SECTOR_SIZES
+
+            # The protective MBR, the header and a default sized entry array in a single read
+            span = max(sector_sizes) * 2 + cls.DEFAULT_ENTRIES * cls.DEFAULT_ENTRY_SIZE
+            raw = os.pread(fd, span, 0)
+
+            for sector_size in sector_sizes:
+                if raw[sector_size:sector_size + 8] == cls.SIGNATURE:
+                    break
+            else:
+                return cls.__from_mbr(path, raw)
+
+            if raw[510:512] != b"\x55\xaa":
+                raise GPTError(f"Invalid protective MBR on {path}")
+
+            header = raw[sector_size:sector_size + cls.HEADER_SIZE]
+            (_, revision, header_size, header_crc, _, current_lba, _, first_usable, last_usable,
+                disk_guid, entries_lba, num_entries, entry_size, entries_crc) = struct.unpack(cls.HEADER_FORMAT, header)
+
+            check = raw[sector_size:sector_size + header_size]
+            check = check[:16] + bytes(4) + check[20:]
+            if zlib.crc32(check) != header_crc:
+                raise GPTError(f"GPT header checksum mismatch on {path}")
+
+            if current_lba != 1:
+                raise GPTError(f"Primary GPT header on {path} is not at LBA 1")
+
+            entries_size = num_entries * entry_size
+            entries_offset = entries_lba * sector_size
+            if entries_offset + entries_size <= len(raw):
+                entries = raw[entries_offset:entries_offset + entries_size]
+            else:
+                entries = os.pread(fd, entries_size, entries_offset)
+
+            if zlib.crc32(entries) != entries_crc:
+                raise GPTError(f"GPT partition entries checksum mismatch on {path}")
+
+        partitions = []
+        for idx in range(num_entries):
+            entry = GPTEntry.unpack(idx + 1, entries[idx * entry_size:(idx + 1) * entry_size])
+            if entry:
+                partitions.append(entry)
+
+        return cls(
+            path=str(path),
+            sector_size=sector_size,
+            total_sectors=size // sector_size,
+            disk_guid=str(uuid.UUID(bytes_le=disk_guid)).upper(),
+            first_usable_lba=first_usable,
+            last_usable_lba=last_usable,
+            entries_lba=entries_lba,
+            num_entries=num_entries,
+            entry_size=entry_size,
+            partitions=partitions,
+        )
+
+    @classmethod
+    def __from_mbr(cls, path, raw: bytes) -> "GPTTable":
+        """
+            Table of a blank or MBR-only disk: the MBR partitions are kept at the same
+            sectors, like sgdisk converting the disk, and everything else is free
+        """
+        table = cls.new(path)
+        if raw[510:512] != b"\x55\xaa":
+            return table
+
+        for idx in range(4):
+            _, mbr_type, first_lba, sectors = struct.unpack_from("<B3xB3xII", raw, 446 + idx * 16)
+            if mbr_type == 0 or mbr_type == 0xEE or not sectors:
+                continue
+            if mbr_type in MBR_EXTENDED:
+                raise GPTError(f"{path} has an MBR partition table with logical partitions; convert it to GPT first")
+
+            table.partitions.append(GPTEntry(
+                number=idx + 1,
+                # Types sgdisk has no code for are taken as Linux filesystems
+                type_guid=type_guid(MBR_TYPECODES.get(mbr_type, "8300")),
+                unique_guid=str(uuid.uuid4()).upper(),
+                first_lba=first_lba,
+                last_lba=first_lba + sectors - 1,
+            ))
+
+        return table
+
+    @classmethod
+    def new(cls, path, sector_size = 512) -> "GPTTable":
+        """ Empty table for a device or an image file (same as sgdisk -o) """
+        with open(path, "rb", buffering=0) as disk:
+            device_sector_size, size = cls.__device_geometry(disk.fileno())
+
+        sector_size = device_sector_size or sector_size
+        total_sectors = size // sector_size
+        entries_sectors = cls.DEFAULT_ENTRIES * cls.DEFAULT_ENTRY_SIZE // sector_size
+        return cls(
+            path=str(path),
+            sector_size=sector_size,
+            total_sectors=total_sectors,
+            disk_guid=str(uuid.uuid4()).upper(),
+            first_usable_lba=2 + entries_sectors,
+            last_usable_lba=total_sectors - 2 - entries_sectors,
+        )
+
+    def get(self, number) -> Optional[GPTEntry]:
+        for entry in self.partitions:
+            if entry.number == int(number):
+                return entry
+
+        return None
+
+    def typecodes(self) -> dict[str, str]:
+        return {str(entry.number): entry.typecode for entry in self.partitions}
+
+    def free_extents(self) -> list[tuple[int, int]]:
+        """ Unallocated (first_lba, last_lba) ranges between the first and last usable LBA """
+        extents = []
+        next_free = self.first_usable_lba
+        for entry in sorted(self.partitions, key=lambda entry: entry.first_lba):
+            if entry.first_lba > next_free:
+                extents.append((next_free, entry.first_lba - 1))
+            next_free = max(next_free, entry.last_lba + 1)
+
+        if next_free <= self.last_usable_lba:
+            extents.append((next_free, self.last_usable_lba))
+
+        return extents
+
+    def free_bytes(self) -> int:
+        return sum(last - first + 1 for first, last in self.free_extents()) * self.sector_size
+
+    def delete(self, number):
+        entry = self.get(number)
+        if not entry:
+            raise GPTError(f"Partition {number} is out of range on {self.path}")
+
+        self.partitions.remove(entry)
+
+    def create(self, number, sectors = 0, type_code = "8300", name = "") -> GPTEntry:
+        """ Create a partition at the start of the largest free extent, like sgdisk -n number:0:+size """
+        if self.get(number):
+            raise GPTError(f"Partition {number} already exists on {self.path}")
+
+        if not 1 <= int(number) <= self.num_entries:
+            raise GPTError(f"Partition {number} is out of range on {self.path}")
+
+        extents = []
+        for first, last in self.free_extents():
+            first = -(-first // self.ALIGNMENT) * self.ALIGNMENT
+            if first <= last:
+                extents.append((first, last))
+
+        if not extents:
+            raise GPTError(f"No free space on {self.path}")
+
+        first, last = max(extents, key=lambda extent: extent[1] - extent[0])
+        if sectors:
+            if first + sectors - 1 > last:
+                raise GPTError(f"Not enough free space for partition {number} on {self.path}")
+            last = first + sectors - 1
+
+        entry = GPTEntry(
+            number=int(number),
+            type_guid=type_guid(type_code),
+            unique_guid=str(uuid.uuid4()).upper(),
+            first_lba=first,
+            last_lba=last,
+            name=name or "",
+        )
+        self.partitions.append(entry)
+        return entry
+
+    def __entries_raw(self) -> bytes:
+        raw = bytearray(self.num_entries * self.entry_size)
+        for entry in self.partitions:
+            offset = (entry.number - 1) * self.entry_size
+            raw[offset:offset + self.entry_size] = entry.pack(self.entry_size)
+
+        return bytes(raw)
+
+    def __header_raw(self, current_lba, backup_lba, entries_lba, entries_crc) -> bytes:
+        def pack(header_crc):
+            return struct.pack(
+                self.HEADER_FORMAT, self.SIGNATURE, self.REVISION, self.HEADER_SIZE, header_crc, 0,
+                current_lba, backup_lba, self.first_usable_lba, self.last_usable_lba,
+                uuid.UUID(self.disk_guid).bytes_le, entries_lba, self.num_entries, self.entry_size, entries_crc,
+            )
+
+        header = pack(zlib.crc32(pack(0)))
+        return header.ljust(self.sector_size, b"\0")
+
+    def __protective_mbr(self) -> bytes:
+        sectors = min(self.total_sectors - 1, 0xFFFFFFFF)
+        mbr = bytearray(self.sector_size)
+        # Single partition of type 0xEE covering the whole disk
+        mbr[446:462] = struct.pack("<B3sB3sII", 0, b"\x00\x02\x00", 0xEE, b"\xff\xff\xff", 1, sectors)
+        mbr[510:512] = b"\x55\xaa"
+        return bytes(mbr)
+
+    def write(self, reread = True):
+        """ Write the protective MBR, both headers and both entry arrays """
+        entries = self.__entries_raw()
+        entries_crc = zlib.crc32(entries)
+        entries_sectors = len(entries) // self.sector_size
+        backup_lba = self.total_sectors - 1
+        backup_entries_lba = backup_lba - entries_sectors
+
+        with open(self.path, "r+b", buffering=0) as disk:
+            fd = disk.fileno()
+            os.pwrite(fd, self.__protective_mbr(), 0)
+            os.pwrite(fd, self.__header_raw(1, backup_lba, self.entries_lba, entries_crc), self.sector_size)
+            os.pwrite(fd, entries, self.entries_lba * self.sector_size)
+            os.pwrite(fd, entries, backup_entries_lba * self.sector_size)
+            os.pwrite(fd, self.__header_raw(backup_lba, 1, backup_entries_lba, entries_crc), backup_lba * self.sector_size)
+            os.fsync(fd)
+
+            if reread and stat.S_ISBLK(os.fstat(fd).st_mode):
+                import fcntl
+                # Inform the kernel about the new table
+                fcntl.ioctl(fd, self.BLKRRPART)
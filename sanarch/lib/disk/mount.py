@@ -0,0 +1,139 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import ClassVar, Optional
+from sanarch.lib.command import Command
+
+@dataclass(eq=False)
+class MountEntry:
+    source: str
+    target: str
+    options: Optional[str] = field(default=None)
+    children: list["MountEntry"] = field(default_factory=list, repr=False)
+
+    def __post_init__(self):
+        self.target = os.path.normpath(self.target)
+
+    @property
+    def args(self) -> list[str]:
+        if self.options:
+            return ['-o', self.options, self.source, self.target]
+
+        return [self.source, self.target]
+
+    @property
+    def is_mounted(self) -> bool:
+        """ Whether the same source is already mounted on the target; eg: by an install that is resumed """
+        source = os.path.realpath(self.source)
+        with open("/proc/self/mounts") as mounts:
+            for line in mounts:
+                fields = line.split()
+                # Spaces in the paths are escaped as \040
+                if fields[1].replace("\\040", " ") == self.target and os.path.realpath(fields[0]) == source:
+                    return True
+
+        return False
+
+    def mount(self):
+        Path(self.target).mkdir(parents=True, exist_ok=True)
+        return Command('mount', args=self.args)()
+
+    def umount(self, check_returncode = True):
+        # By target since the subvolumes of a btrfs filesystem share the same source
+        return Command('umount', args=[self.target], check_returncode=check_returncode)()
+
+
+@dataclass
+class MountPlan:
+    """
+        Tree of every mountpoint, where each entry is the child of the entry
+        mounted on its closest parent directory.
+
+        Entries are mounted level by level, siblings in parallel, and unmounted
+        in the reverse order.
+
+        Usage
+        ----
+        plan = MountPlan.from_filesystems([partition.filesystem for partition in partitions])
+        plan.mount()
+    """
+    WORKERS: ClassVar[int] = 8
+
+    entries: list[MountEntry]
+    roots: list[MountEntry] = field(default_factory=list, init=False)
+    mounted: list[MountEntry] = field(default_factory=list, init=False)
+    failed: list[MountEntry] = field(default_factory=list, init=False)
+
+    def __post_init__(self):
+        targets = [entry.target for entry in self.entries]
+        duplicates = {target for target in targets if targets.count(target) > 1}
+        if duplicates:
+            raise Exception(f"Multiple filesystems mounted on {', '.join(sorted(duplicates))}")
+
+        for entry in self.entries:
+            parent = self.__parent(entry)
+            if parent:
+                parent.children.append(entry)
+            else:
+                self.roots.append(entry)
+
+    @classmethod
+    def from_filesystems(cls, filesystems) -> "MountPlan":
+        entries = []
+        for filesystem in filesystems:
+            if filesystem:
+                entries += filesystem.mount_entries()
+
+        return cls(entries)
+
+    def __parent(self, entry: MountEntry) -> Optional[MountEntry]:
+        parents = [
+            other for other in self.entries
+            if other is not entry and os.path.commonpath([other.target, entry.target]) == other.target
+        ]
+        if not parents:
+            return None
+
+        # Closest parent has the longest mountpoint
+        return max(parents, key=lambda parent: len(parent.target))
+
+    @property
+    def levels(self) -> list[list[MountEntry]]:
+        levels = []
+        level = self.roots
+        while level:
+            levels.append(level)
+            level = [child for entry in level for child in entry.children]
+
+        return levels
+
+    def __run_level(self, level: list[MountEntry], action):
+        with ThreadPoolExecutor(max_workers=self.WORKERS) as executor:
+            jobs = {executor.submit(action, entry): entry for entry in level}
+            wait(jobs)
+
+        return {entry: job.exception() for job, entry in jobs.items()}
+
+    def mount(self):
+        for level in self.levels:
+            self.mounted += [entry for entry in level if entry.is_mounted]
+            level = [entry for entry in level if entry not in self.mounted]
+            results = self.__run_level(level, MountEntry.mount)
+            self.mounted += [entry for entry, error in results.items() if not error]
+            self.failed = [entry for entry, error in results.items() if error]
+
+            # Children can't be mounted once their parent failed
+            if self.failed:
+                raise results[self.failed[0]]
+
+    def umount(self, check_returncode = True):
+        levels = self.levels
+        for level in reversed(levels):
+            level = [entry for entry in level if entry in self.mounted]
+            results = self.__run_level(level, lambda entry: entry.umount(check_returncode=check_returncode))
+            self.mounted = [entry for entry in self.mounted if entry not in level or results[entry]]
+
+            errors = [error for error in results.values() if error]
+            if errors and check_returncode:
+                raise errors[0]
@@ -1,6 +1,9 @@
 from dataclasses import dataclass, field, InitVar
 from sanarch.lib.disk.filesystem import FileSystem, filesystem_helper
-from sanarch.lib.linuxcmd import sgdisk, awk
+from sanarch.lib.disk.gpt import GPTTable
+from sanarch.lib.disk import gpt
+from sanarch.lib.exceptions import GPTError
+from sanarch.lib.linuxcmd import sgdisk
 from typing import ClassVar
 
 @dataclass(eq=True)
@@ -14,7 +17,7 @@ class Partition:
     size: str = field(compare=True)
     number: int = field(compare=True)
     path:str = field(default=None, compare=True)
-    type: str = field(default="0", compare=True)
+    type: str = field(default="0", compare=False)
     typename: str = field(default=None, compare=False)
     name: str = field(default=None, compare=True)
     label: str = field(default=None, compare=False)
@@ -28,6 +31,7 @@ class Partition:
     overwrite: bool = field(default=False, compare=False)
     check_exists: bool = field(default=False, compare=False)
     filesystem: FileSystem = field(default=None, init=False, compare=False)
+    type_guid: str = field(default=None, init=False, compare=True)
 
     def __post_init__(self, mountpoint, fs, force_format, mountoptions, subvolumes):      
         if not self.path:
@@ -50,6 +54,13 @@ class Partition:
         if self.type:
             self.type = self.type.lower()
 
+        # Types are compared by GUID, the typecode is only for display and sgdisk
+        if self.type and self.type != "0":
+            try:
+                self.type_guid = gpt.type_guid(self.type)
+            except GPTError:
+                self.type_guid = self.type.upper()
+
         if fs:
             self.filesystem = filesystem_helper(fs, self.path, mountpoint, force_format, mountoptions, subvolumes)
         
@@ -57,21 +68,8 @@ class Partition:
 
     @staticmethod
     def get_part_typecodes(device) -> dict[str, str]:
-        # sgdisk = Command('sgdisk', args=[f'-p {device}'], shell=True)
-        sg_res = sgdisk(device, endalign=False,args=['-p'])
-        awk_pattern = f"'{{if(NF == 0) {{ flag=1 }}}} {{ if(flag == 1 && NF != 0 && $0 !~ /Number/) {{ print $1, $6 }}}}'"
-
-        awk_res = awk(args=['-v flag=0',awk_pattern], shell=True, input=sg_res.stdout)
-        part_codes_str = awk_res.stdout.split('\n')
-
-        part_typecodes = {}
-
-        for part_code_str in part_codes_str:
-            if part_code_str:
-                num_code = part_code_str.split(' ')
-                part_typecodes[num_code[0]] = num_code[1]
-
-        return part_typecodes
+        # Partition number -> sgdisk typecode; eg: {"1": "EF00"}
+        return GPTTable.read(device).typecodes()
     
     @staticmethod
     def get_part_typecode(device, partnum):
@@ -101,6 +99,16 @@ class Partition:
             else:
                 return -1
 
+    @classmethod
+    def size_to_bytes(cls, size: str) -> int:
+        # Size in the single letter format; '0' (rest of the free space) is 0 bytes
+        size = size.lower().removeprefix('+')
+        if size == '0':
+            return 0
+
+        exponent = cls.SIZE_UNITS.index(size[-1])
+        return int(float(size[:-1]) * 1024 ** exponent)
+
     def __gt__(self, other):
         res = self.cmp_size(self.size, other.size)
         return res == 1
@@ -0,0 +1,101 @@
+from dataclasses import dataclass, field
+from typing import ClassVar
+from sanarch.lib.linuxcmd import sgdisk
+
+@dataclass
+class PartitionOp:
+    CLEAR: ClassVar[str] = "clear"
+    DELETE: ClassVar[str] = "delete"
+    CREATE: ClassVar[str] = "create"
+    RETYPE: ClassVar[str] = "retype"
+
+    action: str
+    number: int = field(default=None)
+    size: str = field(default=None)
+    type: str = field(default=None)
+    name: str = field(default=None)
+
+    @property
+    def sgdisk_args(self) -> list[str]:
+        match self.action:
+            case self.CLEAR:
+                return ['-o']
+            case self.DELETE:
+                return [f'-d {self.number}']
+            case self.CREATE:
+                args = [f'-n {self.number}:0:{self.size}']
+                if self.type:
+                    args += [f'-t {self.number}:{self.type}']
+                if self.name:
+                    args += [f'-c {self.number}:{self.name}']
+                return args
+            case self.RETYPE:
+                return [f'-t {self.number}:{self.type}']
+            case _:
+                raise Exception(f"Invalid partition operation: {self.action}")
+
+    def __str__(self):
+        match self.action:
+            case self.CLEAR:
+                return "clear partition table"
+            case self.CREATE:
+                return f'create partition {self.number} (size: {self.size}, type: {self.type})'
+            case self.RETYPE:
+                return f'retype partition {self.number} (type: {self.type})'
+            case _:
+                return f'{self.action} partition {self.number}'
+
+
+@dataclass
+class PartitionPlan:
+    """
+        Ordered list of operations to bring the partition table of a device
+        to the one in the profile.
+
+        The whole plan is committed with a single sgdisk invocation, so the
+        table is written and re-read by the kernel only once.
+    """
+    device: str
+    ops: list[PartitionOp] = field(default_factory=list)
+
+    def clear(self):
+        self.ops.append(PartitionOp(PartitionOp.CLEAR))
+
+    def delete(self, number):
+        self.ops.append(PartitionOp(PartitionOp.DELETE, number=number))
+
+    def create(self, partition):
+        self.ops.append(PartitionOp(
+            PartitionOp.CREATE, number=partition.number, size=partition.size, type=partition.type, name=partition.name))
+
+    def retype(self, number, type):
+        self.ops.append(PartitionOp(PartitionOp.RETYPE, number=number, type=type))
+
+    @property
+    def creates(self):
+        return any(op.action == PartitionOp.CREATE for op in self.ops)
+
+    @property
+    def sgdisk_args(self) -> list[str]:
+        args = []
+        for op in self.ops:
+            args += op.sgdisk_args
+
+        return args
+
+    def apply(self):
+        if not self.ops:
+            return None
+
+        # sgdisk applies the options in the order they are given
+        return sgdisk(self.device, endalign=self.creates, args=self.sgdisk_args)
+
+    def __bool__(self):
+        return len(self.ops) > 0
+
+    def __str__(self):
+        if not self.ops:
+            return f'{self.device}: no changes'
+
+        lines = [f'{self.device}:'] + [f'\t{num}. {op}' for num, op in enumerate(self.ops, start=1)]
+        return '\n'.join(lines)
@@ -17,8 +17,15 @@ class UpdateError(Exception):
 
 
 class CommandError(Exception):
-    def __init__(self, msg, cmd, return_code):
+    def __init__(self, msg, cmd, return_code, output = None):
         super().__init__(msg)
         self.msg = msg
         self.cmd = cmd
-        self.return_code = return_code
\ No newline at end of file
+        self.return_code = return_code
+        # Last lines of the output of a streamed command, stdout and stderr interleaved
+        self.output = output
+
+class GPTError(Exception):
+    def __init__(self, msg):
+        super().__init__(msg)
+        self.msg = msg
@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import ClassVar
+
+@dataclass
+class Journal:
+    """
+        Write ahead journal of the operations completed by an install.
+
+        Every operation is appended as a json line and fsync'd before the
+        install moves on, so a resumed install knows exactly what was done
+        before it stopped. The first line holds the fingerprint of the profile;
+        a journal written for another profile is refused.
+
+        Usage
+        ----
+        journal = Journal(Journal.fingerprint("profiles/default.yaml"))
+        journal.open(resume=True)
+        if not journal.done("format", "/dev/sda2"):
+            ...
+            journal.record("format", "/dev/sda2")
+    """
+    PATH: ClassVar[str] = "/tmp/sanarch/journal.jsonl"
+
+    profile: str
+    path: str = field(default=PATH)
+    operations: set[tuple[str, str]] = field(default_factory=set, init=False)
+    lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
+
+    @staticmethod
+    def fingerprint(config_file) -> str:
+        with open(config_file, "rb") as profile:
+            return hashlib.sha256(profile.read()).hexdigest()
+
+    @staticmethod
+    def digest(items) -> str:
+        """ Short key of a set of items; eg: the packages of a transaction """
+        return hashlib.sha256("\n".join(sorted(items)).encode()).hexdigest()[:16]
+
+    def __fsync_dir(self):
+        fd = os.open(Path(self.path).parent, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def __load(self):
+        with open(self.path) as journal:
+            lines = journal.read().splitlines()
+
+        entries = []
+        for num, line in enumerate(lines):
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # Only the last line can be torn by a crash while it was appended
+                if num != len(lines) - 1:
+                    raise Exception(f"Corrupted journal {self.path} at line {num + 1}")
+                # Dropped so that the next entry starts on a line of its own
+                with open(self.path, "rb+") as journal:
+                    journal.truncate(journal.read().rstrip(b"\n").rfind(b"\n") + 1)
+
+        if not entries or entries[0].get("profile") != self.profile:
+            raise Exception(f"The journal {self.path} was written for another profile; "
+                            "run without --resume to start over")
+
+        for entry in entries[1:]:
+            if "forget" in entry:
+                self.operations.discard((entry["forget"], entry["key"]))
+            else:
+                self.operations.add((entry["op"], entry["key"]))
+
+    def __append(self, entry):
+        with self.lock:
+            with open(self.path, "a") as journal:
+                journal.write(f'{json.dumps(entry)}\n')
+                journal.flush()
+                os.fsync(journal.fileno())
+
+    def open(self, resume = False, append = False):
+        """ append: an existing journal is left as it is and not loaded; eg: a --converge run """
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self.operations = set()
+        if append and Path(self.path).exists():
+            return self
+
+        if resume and Path(self.path).exists():
+            self.__load()
+            return self
+
+        with open(self.path, "w") as journal:
+            journal.write(f'{json.dumps({"profile": self.profile, "created": time.time()})}\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+        self.__fsync_dir()
+        return self
+
+    def done(self, op, key) -> bool:
+        return (op, key) in self.operations
+
+    def completed(self, op) -> set[str]:
+        return {key for kind, key in self.operations if kind == op}
+
+    def record(self, op, key):
+        self.__append({"op": op, "key": key, "time": time.time()})
+        with self.lock:
+            self.operations.add((op, key))
+
+    def forget(self, op, key):
+        """ Marks an operation as undone; eg: a partition table that was rolled back """
+        if not self.done(op, key):
+            return
+
+        self.__append({"forget": op, "key": key, "time": time.time()})
+        with self.lock:
+            self.operations.discard((op, key))
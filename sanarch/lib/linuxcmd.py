@@ -1,5 +1,6 @@
 from sanarch.lib.command import Command, CommandError
 from sanarch.lib import logger
+from sanarch.lib.disk.gpt import GPTTable, size_to_iec
 from pathlib import Path
 
 def lsblk(args = None, shell = False, input = None):
@@ -56,16 +57,9 @@ def awk(args: list = None, shell = False, input = None):
     return cmd(input=input)
 
 def get_avail_space(device):
-    sg_res = sgdisk(device, endalign=False, args=[f'-p'])
-
-    awk_pattern = f"'/free space/ {{print $7, $8}}'"
-    awk_res = awk(args=[awk_pattern], shell=True, input=sg_res.stdout)
-
-    size = ''
-    if awk_res.stdout:
-        size = awk_res.stdout[1:-2]
-
-    return size
+    # Total free space in the same format as sgdisk -p; eg: 12.5 GiB
+    table = GPTTable.read(device)
+    return size_to_iec(table.free_bytes())
 
 def mount(device, mountpoint):
     cmd = Command("mount", args=[device, mountpoint])
@@ -76,9 +70,13 @@ def umount_all():
     return cmd()
 
 
-def packstrap(packages):
-    args = ['/mnt'] + packages
-    return Command('pacstrap', args=args, capture_output=False)()
+def packstrap(packages, host_cache = False, config = None):
+    # -c: use the package cache of the host rather than the one in the target
+    args = ['-c'] if host_cache else []
+    if config:
+        args += ['-C', config]
+    args += [Command.ROOT_PATH] + packages
+    return Command('pacstrap', args=args, stream=True)()
 
 
 def nproc():
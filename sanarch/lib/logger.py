@@ -1,4 +1,8 @@
+import atexit
+import json
 import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
 import sys
 
@@ -15,9 +19,78 @@ class CustomStreamHandler(logging.StreamHandler):
         self.name = name
         
 
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"time": round(record.created, 3), "level": record.levelname, "logger": record.name,
+                 "thread": record.threadName, "message": record.getMessage()}
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+class AsyncQueueHandler(QueueHandler):
+    OVERFLOW_DROP = "drop"
+    OVERFLOW_BLOCK = "block"
+
+    def __init__(self, queue, overflow = OVERFLOW_DROP):
+        super().__init__(queue)
+        if overflow not in [self.OVERFLOW_DROP, self.OVERFLOW_BLOCK]:
+            raise Exception(f"Unknown log queue overflow policy: {overflow}")
+        self.overflow = overflow
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Formatted by the handlers, on the listener thread
+        return record
+
+    def enqueue(self, record):
+        # Warnings and errors are never dropped
+        if self.overflow == self.OVERFLOW_BLOCK or record.levelno >= logging.WARNING:
+            self.queue.put(record)
+            return
+
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Called with the handler lock held
+            self.dropped += 1
+
+class AsyncQueueListener(QueueListener):
+    def __init__(self, queue, logger):
+        super().__init__(queue)
+        self.logger = logger
+
+    def handle(self, record):
+        for handler in self.logger.queued_handlers():
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def enqueue_sentinel(self):
+        # put_nowait would fail on a full queue
+        self.queue.put(self._sentinel)
+
+
 class Logger(logging.getLoggerClass()):
     """
         A Logger class to log information to console and files.
+
+        The text log file gets a JSON-lines twin with the same records, eg:
+        arch-install.log and arch-install.jsonl.
+
+        In async mode the records are put in a bounded queue and formatted and
+        written by a listener thread, to the console as well as to the log files,
+        so logging doesn't wait on the terminal or the disk. The queue is flushed
+        before a prompt (Logger.input) and before the output of a streamed command,
+        so the console keeps its order with them. When the queue is full debug and
+        info records are dropped, or the caller waits with the block overflow
+        policy; warnings and errors always wait. The queue is drained on
+        disable_async_output and at exit.
+
+        Usage
+        ----
+        logger = Logger(name, log_dir, file_name)
+        logger.enable_async_output()
+        ...
+        logger.disable_async_output()
     """
 
     DEBUG_HANDLER_NAME = "debug"
@@ -26,6 +99,8 @@ class Logger(logging.getLoggerClass()):
     STDERR_FORMAT = '[ERR] %(message)s'
     WARN_FORMAT = '[WARNING] %(message)s'
     FILE_FORMAT = '%(asctime)s - %(levelname)s : %(message)s'
+    JSON_SUFFIX = '.jsonl'
+    QUEUE_SIZE = 10000
 
     def __init__(self, name, log_dir = None, file_name = None):
         super().__init__(name)
@@ -58,8 +133,12 @@ class Logger(logging.getLoggerClass()):
         # Enable console
         self.enable_console_output()
 
+        self.queue_handler = None
+        self.listener = None
+
         # Setup log-file directory and path
         self.file_handler = None
+        self.json_handler = None
         if log_dir and file_name:
             self.init_file_handler(log_dir, file_name)
 
@@ -72,6 +151,8 @@ class Logger(logging.getLoggerClass()):
             # Backup log file if one already exists
             if target.exists():
                 target.replace(target.with_suffix('.log.bak'))
+            if target.with_suffix(self.JSON_SUFFIX).exists():
+                target.with_suffix(self.JSON_SUFFIX).replace(target.with_suffix(f'{self.JSON_SUFFIX}.bak'))
         except Exception as e:
             print(f"Unable to backup log file\n{e}")
             
@@ -88,6 +169,11 @@ class Logger(logging.getLoggerClass()):
         self.file_handler = logging.FileHandler(self.log_file)
         self.file_handler.setLevel(logging.DEBUG)
         self.file_handler.setFormatter(logging.Formatter(self.FILE_FORMAT))
+
+        # Same records, one JSON object per line
+        self.json_handler = logging.FileHandler(self.log_file.with_suffix(self.JSON_SUFFIX))
+        self.json_handler.setLevel(logging.DEBUG)
+        self.json_handler.setFormatter(JsonFormatter())
         
         # Enable file handler
         self.enable_file_output()
@@ -119,10 +205,12 @@ class Logger(logging.getLoggerClass()):
 
         if not self.has_file_handler():
             self.addHandler(self.file_handler)
+            self.addHandler(self.json_handler)
 
     def disable_file_output(self):
         if self.file_handler and self.has_file_handler():
             self.removeHandler(self.file_handler)
+            self.removeHandler(self.json_handler)
     
     def enable_debug_handler(self):
         if not self.has_debug_handler():
@@ -131,3 +219,54 @@ class Logger(logging.getLoggerClass()):
     def disable_debug_handler(self):
         if self.has_debug_handler():
             self.removeHandler(self.debug_handler)
+
+    def queued_handlers(self) -> list[logging.Handler]:
+        """ Enabled handlers that are written by the listener thread in async mode """
+        handlers = [self.debug_handler, self.stdout_handler, self.warn_handler, self.stderr_handler,
+                    self.file_handler, self.json_handler]
+        return [handler for handler in handlers if handler in self.handlers]
+
+    def callHandlers(self, record):
+        if not self.queue_handler:
+            return super().callHandlers(record)
+
+        queued = self.queued_handlers()
+        for handler in self.handlers:
+            if handler not in queued and record.levelno >= handler.level:
+                handler.handle(record)
+        if queued:
+            self.queue_handler.handle(record)
+
+    def enable_async_output(self, queue_size = QUEUE_SIZE, overflow = AsyncQueueHandler.OVERFLOW_DROP):
+        if self.queue_handler:
+            return
+
+        records = queue.Queue(maxsize=queue_size)
+        self.listener = AsyncQueueListener(records, self)
+        self.listener.start()
+        self.queue_handler = AsyncQueueHandler(records, overflow)
+        atexit.register(self.disable_async_output)
+
+    def flush(self):
+        """ Waits for the queued records to be written """
+        if self.queue_handler:
+            self.queue_handler.queue.join()
+        for handler in self.handlers:
+            handler.flush()
+
+    def input(self, prompt = "") -> str:
+        """ Prompts once the queued records are on the console """
+        self.flush()
+        return input(prompt)
+
+    def disable_async_output(self):
+        if not self.queue_handler:
+            return
+
+        # Records logged from now on are written directly
+        queue_handler, self.queue_handler = self.queue_handler, None
+        self.listener.stop()
+        self.listener = None
+        atexit.unregister(self.disable_async_output)
+        if queue_handler.dropped:
+            self.warning(f"{queue_handler.dropped} records were dropped from the log files, the log queue was full")
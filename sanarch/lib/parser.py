@@ -21,3 +21,12 @@ def init_argparse_arguments(parser: argparse.ArgumentParser):
     parser.add_argument('rootpass', type=str, help="password for the root user")
     parser.add_argument('userpass', nargs="*", type=str, help="password for non-root user | Format: {username}:{password} |")
     parser.add_argument('--resume', action='store_true', help="resume installation from the last success point")
+    parser.add_argument('--image-cache', type=str, default=None, metavar="DIR", help="cache the base system image in DIR and reuse it on later installs")
+    parser.add_argument('--image-cache-size', type=str, default=None, metavar="SIZE", help="maximum size of the base image cache (eg: 8g) | Default: 8g |")
+    parser.add_argument('--offline-repo', type=str, default=None, metavar="DIR", help="install without network from the packages in DIR")
+    parser.add_argument('--defer-initramfs', action='store_true', help="generate the initramfs once at the end of the install instead of in every package transaction")
+    parser.add_argument('--converge', action='store_true', help="apply only the changes needed for the system installed in /mnt to match the profile")
+    parser.add_argument('--sample-resources', type=float, nargs='?', const=1.0, default=None, metavar="SECONDS", help="sample the cpu, disk and network usage every SECONDS and tell which one limited each step | Default: 1 |")
+    parser.add_argument('--record', type=str, default=None, metavar="FILE", help="record every command run, its input, result and duration to FILE")
+    parser.add_argument('--replay', type=str, default=None, metavar="FILE", help="serve the commands from a recording made with --record instead of running them")
+    parser.add_argument('--replay-latency', type=float, default=0.0, metavar="SECONDS", help="seconds added to every replayed command | Default: 0 |")
@@ -0,0 +1,313 @@
+import json
+import os
+import re
+import selectors
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, ClassVar, Optional
+from sanarch.lib.exceptions import CommandError
+
+if TYPE_CHECKING:
+    from sanarch.lib.command import Command
+
+class Runner(ABC):
+    """
+        Runs the commands built by Command; set Command.runner to change how
+        every command of the installer is run.
+    """
+
+    @abstractmethod
+    def run(self, command: "Command", input, program_name) -> subprocess.CompletedProcess:
+        """
+            program_name: the program run, without the chroot wrapper
+            Raises CommandError when the command fails and command.check_returncode is set
+        """
+        pass
+
+
+class SubprocessRunner(Runner):
+    """ Runs the commands on the host """
+    # A carriage return ends a line as well; eg: the progress updates of a download.
+    # One at the end of the output read so far is kept, in case it is followed by a newline
+    LINE_END: ClassVar[re.Pattern] = re.compile(rb'\r\n|\n|\r(?!\Z)')
+
+    @staticmethod
+    def __emit(command: "Command", program_name, line: bytes, console):
+        text = line.decode(errors="replace").rstrip("\r\n")
+        console.write(f'{time.strftime("%H:%M:%S")} {text}\n')
+        console.flush()
+        if command.logger:
+            command.logger.debug(f'{program_name}: {text}')
+        return text
+
+    def __stream(self, command: "Command", input, program_name):
+        # The queued records go to the console before the output of the command
+        if command.logger:
+            command.logger.flush()
+
+        process = subprocess.Popen(
+            command.cmd_str if command.shell else command.cmd, shell=command.shell, cwd=command.cwd,
+            stdin=subprocess.PIPE if input is not None else command.stdin, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        if input is not None:
+            process.stdin.write(input.encode())
+            process.stdin.close()
+
+        tail = deque(maxlen=command.STREAM_TAIL)
+        errors = deque(maxlen=command.STREAM_TAIL)
+        output_bytes = 0
+        selector = selectors.DefaultSelector()
+        partial = {}
+        for pipe, console in [(process.stdout, sys.stdout), (process.stderr, sys.stderr)]:
+            os.set_blocking(pipe.fileno(), False)
+            selector.register(pipe, selectors.EVENT_READ, console)
+            partial[pipe] = b""
+
+        def emit(pipe, console, line):
+            text = self.__emit(command, program_name, line, console)
+            tail.append(text)
+            if pipe is process.stderr:
+                errors.append(text)
+
+        try:
+            while selector.get_map():
+                events = selector.select(timeout=command.STREAM_PARTIAL_TIMEOUT)
+                if not events:
+                    for key in selector.get_map().values():
+                        if partial[key.fileobj]:
+                            emit(key.fileobj, key.data, partial[key.fileobj])
+                            partial[key.fileobj] = b""
+                    continue
+
+                for key, _ in events:
+                    pipe = key.fileobj
+                    data = os.read(pipe.fileno(), 64 * 1024)
+                    if not data:
+                        selector.unregister(pipe)
+                        if partial[pipe]:
+                            emit(pipe, key.data, partial[pipe])
+                        continue
+
+                    output_bytes += len(data)
+                    *lines, partial[pipe] = self.LINE_END.split(partial[pipe] + data)
+                    if len(partial[pipe]) >= command.STREAM_PARTIAL_MAX:
+                        lines.append(partial[pipe])
+                        partial[pipe] = b""
+                    for line in lines:
+                        emit(pipe, key.data, line)
+        finally:
+            selector.close()
+            returncode = process.wait()
+            process.stdout.close()
+            process.stderr.close()
+
+        cp = subprocess.CompletedProcess(process.args, returncode, stdout=None, stderr="\n".join(errors))
+        cp.output_bytes = output_bytes
+        if returncode != 0 and command.check_returncode:
+            raise CommandError(msg=cp.stderr or "\n".join(tail), cmd=command.cmd_str, return_code=returncode,
+                               output="\n".join(tail))
+
+        return cp
+
+    def run(self, command: "Command", input, program_name):
+        if command.stream:
+            try:
+                return self.__stream(command, input, program_name)
+            except CommandError as e:
+                raise e
+            except Exception as e:
+                raise CommandError(msg=e, cmd=command.cmd_str, return_code=-1)
+
+        cp = None
+        try:
+            if command.shell == False:
+                cp = subprocess.run(
+                    command.cmd, capture_output=command.capture_output, text=True, cwd=command.cwd,
+                    stdout=command.stdout, stderr=command.stderr, stdin=command.stdin, input=input)
+            else:
+                cp = subprocess.run(
+                    command.cmd_str, shell=True, capture_output=command.capture_output, text=True,
+                    stdout=command.stdout, stderr=command.stderr, stdin=command.stdin, cwd=command.cwd, input=input)
+
+            if cp != None and command.check_returncode:
+                cp.check_returncode()
+        except Exception as e:
+            if cp is not None:
+                raise CommandError(msg=cp.stderr, cmd=command.cmd_str, return_code=cp.returncode)
+            else:
+                raise CommandError(msg=e, cmd=command.cmd_str, return_code=-1)
+
+        return cp
+
+
+@dataclass
+class RecordingRunner(Runner):
+    """
+        Runs the commands with another runner and appends every command, its
+        stdin, its result and its duration to a JSON-lines file, as it goes.
+        snapshot() adds the content of files of the target, which a ReplayRunner
+        seeds its root with.
+
+        Usage
+        ----
+        Command.runner = RecordingRunner("/tmp/sanarch/commands.jsonl", redact=tracer.redact)
+        Command.runner.snapshot("/mnt", ["/etc/locale.gen"])
+    """
+    path: str
+    runner: Runner = field(default_factory=SubprocessRunner)
+    # Applied to the argv, the stdin and the output before they are written; eg: Tracer.redact
+    redact: Callable[[list[str]], list[str]] = field(default=lambda argv: argv)
+    # Continue an existing recording; eg: when the install is resumed
+    append: bool = field(default=False)
+    origin: float = field(default_factory=time.monotonic, init=False)
+    lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
+
+    def __post_init__(self):
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        if not self.append:
+            open(self.path, "w").close()
+
+    def __redact(self, text):
+        return self.redact([text])[0] if isinstance(text, str) else None
+
+    def __write(self, record):
+        with self.lock, open(self.path, "a") as recording:
+            recording.write(f'{json.dumps(record)}\n')
+
+    def snapshot(self, root, paths: list[str]):
+        """ paths: relative to root; the ones that don't exist are skipped """
+        files = {path: Path(f'{root}{path}').read_text() for path in paths if Path(f'{root}{path}').is_file()}
+        self.__write({"files": files, "root": root})
+
+    def run(self, command: "Command", input, program_name):
+        record = {
+            "argv": self.redact(command.cmd), "root": command.ROOT_PATH, "program": program_name, "cwd": command.cwd,
+            "shell": command.shell,
+            "stream": command.stream, "input": self.__redact(input),
+            "start": round(time.monotonic() - self.origin, 6),
+        }
+        start = time.monotonic()
+        try:
+            cp = self.runner.run(command, input, program_name)
+            record.update({
+                "returncode": cp.returncode, "stdout": self.__redact(cp.stdout), "stderr": self.__redact(cp.stderr),
+                "output_bytes": getattr(cp, "output_bytes", None),
+            })
+            return cp
+        except CommandError as e:
+            record.update({"returncode": e.return_code, "error": self.__redact(str(e.msg)),
+                           "output": self.__redact(e.output)})
+            raise e
+        finally:
+            record["duration"] = round(time.monotonic() - start, 6)
+            self.__write(record)
+
+
+@dataclass
+class ReplayRunner(Runner):
+    """
+        Serves the results of a RecordingRunner file instead of running the
+        commands, to exercise the install flow without disks or network.
+
+        Commands are matched by argv, with the root of the target and the
+        random part of the temporary directories ignored; the recordings of the
+        same argv are served in order and the last one is repeated. An argv that
+        was not recorded fails with a CommandError. Each command sleeps latency
+        seconds plus time_scale times its recorded duration (1 replays in real
+        time).
+
+        Only commands are replayed: what the installer reads and writes itself
+        (eg: the partition tables, /etc/hostname of the target, /proc/self/mounts,
+        the journal) is real. The installer replays on a temporary root seeded
+        with the files snapshotted in the recording, and refuses to replay
+        unless the devices of the profile are loop devices or image files.
+
+        Usage
+        ----
+        Command.runner = ReplayRunner("/tmp/sanarch/commands.jsonl", latency=0.01)
+        Command.ROOT_PATH = Command.runner.seed(tempfile.mkdtemp(prefix="sanarch-replay-"))
+    """
+    # eg: /tmp/sanarch-btrfs-k2j4_x9a
+    TEMP_DIR: ClassVar[re.Pattern] = re.compile(rf'({re.escape(tempfile.gettempdir())}/sanarch-[a-z]+-)\w+')
+    # Root of the recordings written before the root was recorded
+    DEFAULT_ROOT: ClassVar[str] = "/mnt"
+
+    path: str
+    latency: float = field(default=0.0)
+    time_scale: float = field(default=0.0)
+    redact: Callable[[list[str]], list[str]] = field(default=lambda argv: argv)
+    # argv -> recordings not served yet
+    recordings: dict[tuple, deque] = field(default_factory=dict, init=False)
+    last: dict[tuple, dict] = field(default_factory=dict, init=False)
+    # Path in the recorded root -> content
+    files: dict[str, str] = field(default_factory=dict, init=False)
+    # Root of the target when the commands were recorded; eg: mountpoints of the profile are in it
+    root: str = field(default=DEFAULT_ROOT, init=False)
+    lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
+
+    def __post_init__(self):
+        with open(self.path) as recording:
+            for line in recording:
+                if not line.strip():
+                    continue
+
+                record = json.loads(line)
+                self.root = record.get("root", self.DEFAULT_ROOT)
+                if "files" in record:
+                    self.files.update(record["files"])
+                else:
+                    self.recordings.setdefault(self.__key(record["argv"], self.root), deque()).append(record)
+
+    def __key(self, argv, root) -> tuple:
+        root = re.compile(rf'(?<![^\s=]){re.escape(root)}(?=/|\s|$)')
+        return tuple(self.TEMP_DIR.sub(r"\1*", root.sub("{root}", arg)) for arg in argv)
+
+    def seed(self, root) -> str:
+        """ Writes the snapshotted files in root, which stands for the recorded root """
+        for path, content in self.files.items():
+            file = Path(f'{root}{path}')
+            file.parent.mkdir(parents=True, exist_ok=True)
+            file.write_text(content)
+
+        return root
+
+    def rebase(self, path, root) -> str:
+        """ path in the recorded root -> the same path in root """
+        if path == self.root or path.startswith(f'{self.root}/'):
+            return f'{root}{path[len(self.root):]}'
+
+        return path
+
+    def __next(self, command: "Command") -> Optional[dict]:
+        key = self.__key(self.redact(command.cmd), command.ROOT_PATH)
+        with self.lock:
+            records = self.recordings.get(key)
+            if records:
+                self.last[key] = records.popleft()
+            return self.last.get(key)
+
+    def run(self, command: "Command", input, program_name):
+        record = self.__next(command)
+        if record is None:
+            raise CommandError(msg=f"Not in the recording {self.path}", cmd=command.cmd_str, return_code=-1)
+
+        delay = self.latency + self.time_scale * record["duration"]
+        if delay > 0:
+            time.sleep(delay)
+
+        if "error" in record:
+            raise CommandError(msg=record["error"], cmd=command.cmd_str, return_code=record["returncode"],
+                               output=record.get("output"))
+
+        cp = subprocess.CompletedProcess(command.cmd_str if command.shell else command.cmd, record["returncode"],
+                                         stdout=record["stdout"], stderr=record["stderr"])
+        if record.get("output_bytes") is not None:
+            cp.output_bytes = record["output_bytes"]
+        return cp
@@ -0,0 +1,208 @@
+import json
+import os
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from threading import Event, Thread
+from typing import Callable, ClassVar, Optional
+
+@dataclass
+class Sample:
+    time: float # seconds since the sampler started
+    steps: list[str]
+    cpu: float # busy fraction of all the cpus
+    iowait: float
+    disk_read: float # bytes/s
+    disk_write: float # bytes/s
+    disk_util: float # busy fraction of the busiest device
+    net_rx: float # bytes/s
+    net_tx: float # bytes/s
+
+
+@dataclass
+class StepVerdict:
+    step: str
+    samples: int
+    cpu: float
+    iowait: float
+    disk_util: float
+    disk_rate: float
+    net_rate: float
+    bound: Optional[str] = field(default=None) # cpu, disk, network or None
+
+    def __str__(self):
+        mb = 1000 ** 2
+        match self.bound:
+            case "cpu":
+                verdict = f'CPU-bound at {self.cpu:.0%} CPU'
+            case "disk":
+                verdict = f'disk-bound at {self.disk_rate / mb:.1f} MB/s ({self.disk_util:.0%} busy)'
+            case "network":
+                verdict = f'network-bound at {self.net_rate / mb:.1f} MB/s'
+            case _:
+                verdict = (f'not saturated (CPU {self.cpu:.0%}, disk {self.disk_rate / mb:.1f} MB/s, '
+                           f'network {self.net_rate / mb:.1f} MB/s)')
+
+        return f'{self.step} was {verdict}'
+
+
+@dataclass
+class ResourceSampler:
+    """
+        Samples the cpu, the target disks and the network in the background, and
+        tags every sample with the install steps running at that moment.
+
+        verdicts() tells for each step which resource was saturated: the cpu or
+        a disk when they were busy most of the time, and the network when the
+        step was receiving close to the fastest rate seen during the install (the
+        link or the mirror is the limit, whichever is slower).
+
+        Usage
+        ----
+        sampler = ResourceSampler(["/dev/sda"], steps=lambda: tracer.running("step")).start()
+        ...
+        sampler.stop()
+        sampler.write("/tmp/sanarch")
+    """
+    FILENAME: ClassVar[str] = "resources.json"
+    SECTOR_SIZE: ClassVar[int] = 512
+    CPU_BOUND: ClassVar[float] = 0.85
+    DISK_BOUND: ClassVar[float] = 0.8
+    # Fraction of the peak network rate
+    NETWORK_BOUND: ClassVar[float] = 0.7
+    # Below this the network isn't considered a bottleneck, whatever the peak
+    MIN_NETWORK_RATE: ClassVar[float] = 256 * 1024
+    COLUMNS: ClassVar[list[str]] = ["time", "cpu", "iowait", "disk_read", "disk_write", "disk_util", "net_rx", "net_tx"]
+
+    devices: list[str]
+    interval: float = field(default=1.0)
+    steps: Callable[[], list[str]] = field(default=lambda: [])
+    samples: list[Sample] = field(default_factory=list, init=False)
+    thread: Thread = field(default=None, init=False)
+    stopped: Event = field(default_factory=Event, init=False)
+
+    def __post_init__(self):
+        # /dev/sda -> sda, following /dev/disk/by-* links
+        self.devices = [os.path.basename(os.path.realpath(device)) for device in self.devices]
+
+    @staticmethod
+    def __cpu() -> tuple[int, int, int]:
+        with open("/proc/stat") as stat:
+            values = [int(value) for value in stat.readline().split()[1:]]
+
+        # user nice system idle iowait irq softirq steal; guest time is already in user
+        total = sum(values[:8])
+        return total, values[3], values[4]
+
+    def __disks(self) -> tuple[int, int, dict[str, int]]:
+        read = written = 0
+        ticks = {}
+        with open("/proc/diskstats") as diskstats:
+            for line in diskstats:
+                fields = line.split()
+                if fields[2] not in self.devices:
+                    continue
+                read += int(fields[5]) * self.SECTOR_SIZE
+                written += int(fields[9]) * self.SECTOR_SIZE
+                # Milliseconds spent doing I/O
+                ticks[fields[2]] = int(fields[12])
+
+        return read, written, ticks
+
+    @staticmethod
+    def __network() -> tuple[int, int]:
+        rx = tx = 0
+        with open("/proc/net/dev") as netdev:
+            for line in netdev.readlines()[2:]:
+                interface, values = line.split(":", 1)
+                if interface.strip() == "lo":
+                    continue
+                values = values.split()
+                rx += int(values[0])
+                tx += int(values[8])
+
+        return rx, tx
+
+    def __read(self):
+        return time.monotonic(), self.__cpu(), self.__disks(), self.__network()
+
+    def __sample(self):
+        start = time.monotonic()
+        previous = self.__read()
+        while not self.stopped.wait(self.interval):
+            current = self.__read()
+            now, (total, idle, iowait), (read, written, ticks), (rx, tx) = current
+            then, (p_total, p_idle, p_iowait), (p_read, p_written, p_ticks), (p_rx, p_tx) = previous
+            elapsed = now - then
+            cpu_time = max(total - p_total, 1)
+            busy = max((ticks[name] - p_ticks.get(name, ticks[name])) for name in ticks) if ticks else 0
+
+            self.samples.append(Sample(
+                time=now - start,
+                steps=self.steps(),
+                cpu=1 - ((idle - p_idle) + (iowait - p_iowait)) / cpu_time,
+                iowait=(iowait - p_iowait) / cpu_time,
+                disk_read=(read - p_read) / elapsed,
+                disk_write=(written - p_written) / elapsed,
+                disk_util=min(busy / (elapsed * 1000), 1.0),
+                net_rx=(rx - p_rx) / elapsed,
+                net_tx=(tx - p_tx) / elapsed,
+            ))
+            previous = current
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = Thread(target=self.__sample, name="resource-sampler", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.thread:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+
+    def verdicts(self) -> list[StepVerdict]:
+        peak_rx = max((sample.net_rx for sample in self.samples), default=0)
+        by_step: dict[str, list[Sample]] = {}
+        for sample in self.samples:
+            for step in sample.steps:
+                by_step.setdefault(step, []).append(sample)
+
+        verdicts = []
+        for step, samples in by_step.items():
+            def mean(attr):
+                return sum(getattr(sample, attr) for sample in samples) / len(samples)
+
+            verdict = StepVerdict(
+                step=step, samples=len(samples), cpu=mean("cpu"), iowait=mean("iowait"), disk_util=mean("disk_util"),
+                disk_rate=mean("disk_read") + mean("disk_write"), net_rate=mean("net_rx"),
+            )
+            scores = {
+                "cpu": verdict.cpu / self.CPU_BOUND,
+                "disk": verdict.disk_util / self.DISK_BOUND,
+                "network": verdict.net_rate / (peak_rx * self.NETWORK_BOUND)
+                           if verdict.net_rate >= self.MIN_NETWORK_RATE else 0.0,
+            }
+            bound = max(scores, key=scores.get)
+            verdict.bound = bound if scores[bound] >= 1 else None
+            verdicts.append(verdict)
+
+        return sorted(verdicts, key=lambda verdict: -verdict.samples)
+
+    def write(self, directory):
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        report = {
+            "interval": self.interval,
+            "devices": self.devices,
+            "columns": self.COLUMNS + ["steps"],
+            "samples": [
+                [round(getattr(sample, column), 3) for column in self.COLUMNS] + [sample.steps]
+                for sample in self.samples
+            ],
+            "steps": {verdict.step: {"bound": verdict.bound, "verdict": str(verdict), "samples": verdict.samples}
+                      for verdict in self.verdicts()},
+        }
+        with open(directory / self.FILENAME, "w") as resources:
+            json.dump(report, resources)
@@ -0,0 +1,137 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Callable, ClassVar, Optional
+from sanarch.lib.logger import Logger
+from sanarch.lib.trace import Tracer
+
+@dataclass
+class Step:
+    name: str
+    func: Callable
+    # Names of the steps that have to be completed first
+    requires: list[str] = field(default_factory=list)
+    # Resources used exclusively; steps sharing a lock never run at the same time
+    locks: list[str] = field(default_factory=list)
+    # Completed checkpointed steps are skipped on resume, the others run on every install
+    checkpoint: bool = field(default=True)
+
+
+@dataclass
+class Scheduler:
+    """
+        Runs the install steps as a graph: a step starts as soon as the steps it
+        requires are done and none of its locks is held, so independent steps
+        run at the same time.
+
+        Steps are checkpointed by name; the ones in completed are not run again,
+        and on_complete is called with the name of every checkpointed step once
+        it is done, so the progress can be saved.
+
+        Usage
+        ----
+        scheduler = Scheduler([
+            Step("partition", partition_disk),
+            Step("base", install_base, requires=["partition"], locks=["pacman"]),
+        ], completed={"partition"})
+        scheduler.run()
+    """
+    WORKERS: ClassVar[int] = 4
+
+    steps: list[Step]
+    completed: set[str] = field(default_factory=set)
+    on_complete: Optional[Callable[[str], None]] = field(default=None)
+    logger: Logger = field(default=None)
+    workers: int = field(default=WORKERS)
+    # Times every step that runs, if set
+    tracer: Optional[Tracer] = field(default=None)
+    # name -> seconds taken by each step that ran
+    timings: dict[str, float] = field(default_factory=dict, init=False)
+
+    def __post_init__(self):
+        if not self.logger:
+            self.logger = Logger("logger-scheduler")
+
+        self.completed = set(self.completed)
+        self.__validate()
+
+    def __validate(self):
+        names = [step.name for step in self.steps]
+        duplicates = {name for name in names if names.count(name) > 1}
+        if duplicates:
+            raise Exception(f"Duplicate install steps: {', '.join(sorted(duplicates))}")
+
+        for step in self.steps:
+            unknown = [name for name in step.requires if name not in names]
+            if unknown:
+                raise Exception(f"Install step {step.name} requires unknown steps: {', '.join(unknown)}")
+
+        # Kahn's algorithm; whatever is left has a cycle
+        remaining = {step.name: set(step.requires) for step in self.steps}
+        while remaining:
+            ready = [name for name, requires in remaining.items() if not requires]
+            if not ready:
+                raise Exception(f"Cyclic dependency between the install steps: {', '.join(sorted(remaining))}")
+            for name in ready:
+                del remaining[name]
+            for requires in remaining.values():
+                requires.difference_update(ready)
+
+    def __run_step(self, step: Step):
+        start = time.monotonic()
+        if self.tracer:
+            with self.tracer.span(step.name, "step"):
+                step.func()
+        else:
+            step.func()
+        return time.monotonic() - start
+
+    def run(self):
+        done = {step.name for step in self.steps if step.checkpoint and step.name in self.completed}
+        for name in sorted(done):
+            self.logger.debug(f"Skipping completed step {name}")
+
+        pending = [step for step in self.steps if step.name not in done]
+        running: dict[Future, Step] = {}
+        held = set()
+        error = None
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="step") as executor:
+            while pending or running:
+                if not error:
+                    # In declaration order, so that the order of the steps is the tie breaker
+                    for step in list(pending):
+                        if len(running) >= self.workers:
+                            break
+                        if all(name in done for name in step.requires) and not held.intersection(step.locks):
+                            pending.remove(step)
+                            held.update(step.locks)
+                            self.logger.debug(f"Starting step {step.name}")
+                            running[executor.submit(self.__run_step, step)] = step
+
+                if not running:
+                    if error:
+                        break
+                    raise Exception(f"Install steps can't be scheduled: {', '.join(step.name for step in pending)}")
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    step = running.pop(future)
+                    held.difference_update(step.locks)
+                    try:
+                        self.timings[step.name] = future.result()
+                    except Exception as e:
+                        self.logger.error(f"Step {step.name} failed")
+                        # The steps already running are left to finish; nothing new is started
+                        error = error or e
+                        continue
+
+                    done.add(step.name)
+                    self.logger.debug(f"Finished step {step.name} in {self.timings[step.name]:.1f}s")
+                    if step.checkpoint:
+                        self.completed.add(step.name)
+                        if self.on_complete:
+                            self.on_complete(step.name)
+
+        if error:
+            raise error
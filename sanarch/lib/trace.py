@@ -0,0 +1,142 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import ClassVar, Optional
+
+@dataclass
+class Span:
+    name: str
+    category: str
+    start: float # seconds since the tracer started
+    end: float = field(default=None)
+    argv: Optional[list[str]] = field(default=None)
+    exit_code: Optional[int] = field(default=None)
+    output_bytes: Optional[int] = field(default=None)
+    error: Optional[str] = field(default=None)
+    thread: int = field(default_factory=threading.get_ident)
+
+    @property
+    def duration(self) -> float:
+        return (self.end or self.start) - self.start
+
+
+@dataclass
+class Tracer:
+    """
+        Collects timing spans of the install steps and of every command.
+
+        Spans are written as a ranked summary, a trace.json in the Chrome trace
+        event format (chrome://tracing, ui.perfetto.dev) and a metrics.jsonl with
+        one span per line, which can be diffed between installs. Secrets are
+        redacted from the argv of the commands.
+
+        Usage
+        ----
+        tracer = Tracer(secrets=[password])
+        with tracer.span("partition_disk", "step"):
+            ...
+        tracer.write("/tmp/sanarch")
+    """
+    TRACE_FILENAME: ClassVar[str] = "trace.json"
+    METRICS_FILENAME: ClassVar[str] = "metrics.jsonl"
+    REDACTED: ClassVar[str] = "***"
+    # Options whose value is a secret; short options like -p mean something else to most programs (eg: mkdir -p)
+    SECRET_OPTIONS: ClassVar[list[str]] = ["--password", "--passphrase"]
+
+    secrets: list[str] = field(default_factory=list)
+    spans: list[Span] = field(default_factory=list, init=False)
+    origin: float = field(default_factory=time.monotonic, init=False)
+    wall_origin: float = field(default_factory=time.time, init=False)
+    threads: dict[int, str] = field(default_factory=dict, init=False)
+    # Spans that are still running
+    open_spans: list[Span] = field(default_factory=list, init=False)
+    lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
+
+    def redact(self, argv: list[str]) -> list[str]:
+        redacted = []
+        secret_value = False
+        for arg in map(str, argv):
+            if secret_value:
+                arg = self.REDACTED
+            for secret in self.secrets:
+                if secret:
+                    arg = arg.replace(secret, self.REDACTED)
+            redacted.append(arg)
+            secret_value = arg in self.SECRET_OPTIONS
+
+        return redacted
+
+    @contextmanager
+    def span(self, name, category, argv = None):
+        span = Span(name, category, time.monotonic() - self.origin, argv=self.redact(argv) if argv else None)
+        with self.lock:
+            self.open_spans.append(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = str(e) or type(e).__name__
+            raise
+        finally:
+            span.end = time.monotonic() - self.origin
+            with self.lock:
+                self.open_spans.remove(span)
+                self.threads.setdefault(span.thread, threading.current_thread().name)
+                self.spans.append(span)
+
+    def running(self, category) -> list[str]:
+        with self.lock:
+            return [span.name for span in self.open_spans if span.category == category]
+
+    def summary(self, top = 10) -> str:
+        steps = sorted((span for span in self.spans if span.category == "step"), key=lambda span: -span.duration)
+        commands: dict[str, list[Span]] = {}
+        for span in self.spans:
+            if span.category == "command":
+                commands.setdefault(span.name, []).append(span)
+        ranked = sorted(commands.items(), key=lambda item: -sum(span.duration for span in item[1]))
+
+        lines = ["Slowest steps:"]
+        lines += [f'  {span.duration:8.1f}s  {span.name}{" (failed)" if span.error else ""}' for span in steps[:top]]
+        lines.append("Slowest commands:")
+        for name, spans in ranked[:top]:
+            total = sum(span.duration for span in spans)
+            lines.append(f'  {total:8.1f}s  {name} x{len(spans)} (max {max(span.duration for span in spans):.1f}s)')
+
+        return "\n".join(lines)
+
+    def trace_events(self) -> dict:
+        pid = os.getpid()
+        events = [
+            {"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+            for tid, name in self.threads.items()
+        ]
+        for span in self.spans:
+            args = {key: value for key, value in asdict(span).items()
+                    if key in ["argv", "exit_code", "output_bytes", "error"] and value is not None}
+            events.append({
+                "name": span.name, "cat": span.category, "ph": "X", "pid": pid, "tid": span.thread,
+                "ts": int(span.start * 1e6), "dur": int(span.duration * 1e6), "args": args,
+            })
+
+        return {"traceEvents": events, "displayTimeUnit": "ms", "otherData": {"start": self.wall_origin}}
+
+    def write(self, directory):
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        with self.lock:
+            spans = sorted(self.spans, key=lambda span: span.start)
+
+        with open(directory / self.TRACE_FILENAME, "w") as trace:
+            json.dump(self.trace_events(), trace)
+
+        with open(directory / self.METRICS_FILENAME, "w") as metrics:
+            for span in spans:
+                metric = {"name": span.name, "category": span.category, "start": round(span.start, 3),
+                          "duration": round(span.duration, 3)}
+                metric.update({key: value for key, value in asdict(span).items()
+                               if key in ["argv", "exit_code", "output_bytes", "error"] and value is not None})
+                metrics.write(f'{json.dumps(metric)}\n')
@@ -15,10 +15,15 @@ def bootloader_helper(bootloader):
 @dataclass
 class Bootloader(ABC):
     TARGET: ClassVar[str] = "x86_64-efi"
+    PACKAGES: ClassVar[list[str]] = []
 
     @abstractmethod
-    def install(self, esp,*, detect_other_os = False):
-        """ Installs the bootloader """
+    def install(self, esp,*, detect_other_os = False, configure = True):
+        """ Installs the bootloader; configure = False leaves the configuration to a later mkconfig """
+
+    @abstractmethod
+    def mkconfig(self):
+        """ Generates the configuration from the kernels and initramfs installed """
 
 @dataclass
 class Grub(Bootloader):
@@ -42,10 +47,10 @@ class Grub(Bootloader):
 
 
     def grub_install(self, esp):
-        Path(f'/mnt/self.INSTALL_DIR').mkdir(parents=True, exist_ok=True)
+        Path(f'{Command.ROOT_PATH}/self.INSTALL_DIR').mkdir(parents=True, exist_ok=True)
 
         args = [f'--target={self.TARGET}', f'--bootloader-id={self.BOOTLOADER_ID}', f'--efi-directory={esp}']
-        grub = Command(name = "grub-install", args=args, capture_output=False)
+        grub = Command(name = "grub-install", args=args, stream=True)
         grub(arch_chroot=True)
 
 
@@ -63,8 +68,8 @@ class Grub(Bootloader):
             grubfile.writelines(lines)        
 
 
-    def install(self, esp, *, detect_other_os = False):
-        DEFAULT_CONFIG_FILE = "/mnt/etc/default/grub"
+    def install(self, esp, *, detect_other_os = False, configure = True):
+        DEFAULT_CONFIG_FILE = f'{Command.ROOT_PATH}/etc/default/grub'
 
         if not esp:
             raise Exception("No esp specified")
@@ -78,4 +83,5 @@ class Grub(Bootloader):
             self.update_config(DEFAULT_CONFIG_FILE, "#GRUB_DISABLE_OS_PROBER=false", "GRUB_DISABLE_OS_PROBER=false", match_exact= False)
 
         # Create the configuration files
-        self.mkconfig()
+        if configure:
+            self.mkconfig()
@@ -0,0 +1,183 @@
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from threading import Event, Thread
+from typing import ClassVar
+
+@dataclass
+class DownloadStats:
+    bytes: int = field(default=0)
+    seconds: float = field(default=0.0)
+    peak_connections: int = field(default=0)
+    # Mean rate of a single download while it was in progress (bytes/s)
+    per_connection: float = field(default=0.0)
+
+    @property
+    def throughput(self) -> float:
+        return self.bytes / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        mib = 1024 ** 2
+        return (f'{self.bytes / mib:.1f} MiB in {self.seconds:.1f}s ({self.throughput / mib:.2f} MiB/s, '
+                f'{self.per_connection / mib:.2f} MiB/s per connection, {self.peak_connections} connections)')
+
+
+@dataclass
+class DownloadMonitor:
+    """
+        Measures the downloads of a pacman transaction from the package cache.
+
+        pacman doesn't print its progress when the output isn't a terminal, so the
+        partial (.part) files in the cache are sampled instead: each one is a
+        connection, and their growth plus the packages that completed is the
+        aggregate throughput.
+
+        Usage
+        ----
+        with DownloadMonitor("/var/cache/pacman/pkg") as monitor:
+            pacman.install(packages)
+        monitor.stats
+    """
+    INTERVAL: ClassVar[float] = 0.25
+
+    path: str
+    stats: DownloadStats = field(default=None, init=False)
+    thread: Thread = field(default=None, init=False)
+    stopped: Event = field(default_factory=Event, init=False)
+
+    def __files(self):
+        cache = Path(self.path)
+        if not cache.is_dir():
+            return {}, {}
+
+        partial = {}
+        complete = {}
+        # pacman >= 6.1 downloads into a download-* directory inside the cache
+        for file in list(cache.glob("*.part")) + list(cache.glob("download-*/*.part")):
+            try:
+                partial[file.name] = file.stat().st_size
+            except FileNotFoundError:
+                pass
+
+        for file in cache.glob("*.pkg.tar.*"):
+            if file.name.endswith(".part") or file.name.endswith(".sig"):
+                continue
+            try:
+                complete[file.name] = file.stat().st_size
+            except FileNotFoundError:
+                pass
+
+        return partial, complete
+
+    def __sample(self):
+        _, baseline = self.__files()
+        start = time.monotonic()
+        # name -> (first seen, first size, last seen, last size)
+        connections = {}
+        peak = 0
+        downloaded = 0
+
+        while True:
+            stopped = self.stopped.wait(self.INTERVAL)
+            now = time.monotonic()
+            partial, complete = self.__files()
+
+            for name, size in partial.items():
+                first_seen, first_size, _, _ = connections.get(name, (now, size, now, size))
+                connections[name] = (first_seen, first_size, now, size)
+
+            peak = max(peak, len(partial))
+            new = sum(size for name, size in complete.items() if name not in baseline)
+            downloaded = new + sum(partial.values())
+
+            if stopped:
+                break
+
+        rates = [
+            (last_size - first_size) / (last_seen - first_seen)
+            for first_seen, first_size, last_seen, last_size in connections.values() if last_seen > first_seen
+        ]
+        self.stats = DownloadStats(
+            bytes=downloaded,
+            seconds=time.monotonic() - start,
+            peak_connections=peak,
+            per_connection=sum(rates) / len(rates) if rates else 0.0,
+        )
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = Thread(target=self.__sample, name="download-monitor", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> DownloadStats:
+        self.stopped.set()
+        self.thread.join()
+        return self.stats
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+@dataclass
+class ParallelDownloadTuner:
+    """
+        Picks ParallelDownloads between transactions from the measured throughput.
+
+        Starting from the initial value it tries halving and doubling the number of
+        connections, keeps going in the direction that is faster by more than
+        IMPROVEMENT and settles on the smallest value that is within IMPROVEMENT of
+        the best throughput seen.
+    """
+    MIN: ClassVar[int] = 1
+    MAX: ClassVar[int] = 16
+    # Transactions downloading less than this are too short to measure
+    MIN_BYTES: ClassVar[int] = 8 * 1024 ** 2
+    IMPROVEMENT: ClassVar[float] = 0.1
+
+    parallel: int
+    # ParallelDownloads -> best aggregate throughput measured with it
+    measured: dict[int, float] = field(default_factory=dict)
+    # Most connections ever open at once in a transaction that didn't fill all the slots;
+    # eg: a mirror that only serves a few connections at a time
+    ceiling: int = field(default=None)
+
+    def __post_init__(self):
+        self.parallel = min(max(self.parallel, self.MIN), self.MAX)
+
+    def __faster(self, this, other) -> bool:
+        return self.measured[this] > self.measured[other] * (1 + self.IMPROVEMENT)
+
+    def update(self, stats: DownloadStats) -> int:
+        if stats.bytes < self.MIN_BYTES:
+            return self.parallel
+
+        # Unused slots say nothing about the benefit of more connections
+        used = min(self.parallel, max(stats.peak_connections, 1))
+        self.measured[used] = max(self.measured.get(used, 0.0), stats.throughput)
+        if used < self.parallel:
+            self.ceiling = max(self.ceiling or 0, used)
+
+        tried = sorted(self.measured)
+        best = max(tried, key=lambda parallel: self.measured[parallel])
+        # The smallest number of connections that is about as fast as the best
+        settled = min(parallel for parallel in tried if not self.__faster(best, parallel))
+
+        if len(tried) == 1:
+            candidate = best // 2 if stats.peak_connections >= self.parallel else best
+        elif settled == tried[-1]:
+            candidate = settled * 2
+        elif settled == tried[0]:
+            candidate = settled // 2
+        else:
+            candidate = settled
+
+        candidate = min(max(candidate, self.MIN), self.ceiling or self.MAX, self.MAX)
+        if candidate in self.measured and candidate != settled:
+            candidate = settled
+
+        self.parallel = candidate
+        return self.parallel
@@ -0,0 +1,127 @@
+import hashlib
+import os
+import shutil
+import subprocess
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import ClassVar, Optional
+from sanarch.lib.command import Command
+from sanarch.lib.logger import Logger
+
+@dataclass
+class BaseImageCache:
+    """
+        Cache of the target root right after pacstrap, stored as zstd compressed tar archives.
+
+        Archives are content addressed by the sorted package list and the sync databases
+        of the host, so a cached image is only used when pacstrap would install exactly
+        the same package versions. The least recently used archives are evicted once the
+        cache grows beyond max_size bytes.
+
+        Only the root filesystem is archived; the filesystems mounted below it (eg: the ESP,
+        /home, the btrfs subvolumes) are left out, so restoring an image never writes to them.
+
+        Usage
+        ----
+        cache = BaseImageCache("/var/cache/sanarch")
+        key = cache.key(packages)
+        if not cache.extract(key, "/mnt"):
+            pacstrap ...
+            cache.store(key, "/mnt")
+    """
+    SYNC_DB_DIR: ClassVar[str] = "/var/lib/pacman/sync"
+    SUFFIX: ClassVar[str] = ".tar.zst"
+    EXCLUDES: ClassVar[list[str]] = ["./var/cache/pacman/pkg/*", "./tmp/*", "./run/*"]
+    DEFAULT_MAX_SIZE: ClassVar[int] = 8 * 1024 ** 3
+
+    path: str
+    max_size: int = field(default=DEFAULT_MAX_SIZE)
+    logger: Logger = field(default=None)
+
+    def __post_init__(self):
+        if not self.logger:
+            self.logger = Logger("logger-imagecache")
+
+        Path(self.path).mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def __compressor():
+        # pzstd writes independent frames, which it can also decompress in parallel
+        if shutil.which("pzstd"):
+            return f'pzstd -p {os.cpu_count() or 1}'
+
+        return 'zstd -T0'
+
+    def key(self, packages: list[str], sync_db_dir = None, variant = "") -> str:
+        # variant: anything else that changes the image; eg: the initramfs generation being deferred
+        digest = hashlib.sha256(variant.encode())
+        for package in sorted(set(packages)):
+            digest.update(f'{package}\n'.encode())
+
+        for db in sorted(Path(sync_db_dir or self.SYNC_DB_DIR).glob("*.db")):
+            digest.update(db.name.encode())
+            digest.update(hashlib.sha256(db.read_bytes()).digest())
+
+        return digest.hexdigest()
+
+    def archive(self, key) -> Path:
+        return Path(self.path) / f'{key}{self.SUFFIX}'
+
+    def lookup(self, key) -> Optional[Path]:
+        archive = self.archive(key)
+        return archive if archive.is_file() else None
+
+    def extract(self, key, root) -> bool:
+        archive = self.lookup(key)
+        if not archive:
+            self.logger.debug(f"No base image cached for {key[:12]}")
+            return False
+
+        start = time.monotonic()
+        args = ['-I', self.__compressor(), '-xpf', str(archive), '-C', root,
+                '--xattrs', '--xattrs-include=*', '--acls', '--numeric-owner']
+        Command('tar', args=args)()
+        # Marks the archive as recently used for eviction
+        archive.touch()
+
+        self.logger.info(f"Extracted cached base image {key[:12]} in {time.monotonic() - start:.1f}s")
+        return True
+
+    def store(self, key, root):
+        archive = self.archive(key)
+        partial = archive.with_name(f'{archive.name}.part')
+        start = time.monotonic()
+
+        excludes = [f'--exclude={exclude}' for exclude in self.EXCLUDES]
+        args = ['-I', self.__compressor(), '-cpf', str(partial), '-C', root, '--one-file-system',
+                '--xattrs', '--xattrs-include=*', '--acls', '--numeric-owner'] + excludes + ['.']
+        try:
+            Command('tar', args=args)()
+            self.verify(partial)
+            partial.replace(archive)
+        finally:
+            partial.unlink(missing_ok=True)
+
+        self.logger.info(f"Stored base image {key[:12]} ({archive.stat().st_size // 1024 ** 2} MiB) in {time.monotonic() - start:.1f}s")
+        self.evict(keep=archive)
+
+    def verify(self, archive: Path):
+        """ Reads the whole archive back; raises a CommandError if it is truncated or corrupted """
+        Command('tar', args=['-I', self.__compressor(), '-tf', str(archive)], stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE)()
+
+    def evict(self, keep: Path = None):
+        archives = sorted(Path(self.path).glob(f'*{self.SUFFIX}'), key=lambda archive: archive.stat().st_mtime)
+        total = sum(archive.stat().st_size for archive in archives)
+
+        # Oldest first
+        for archive in archives:
+            if total <= self.max_size:
+                break
+            if archive == keep:
+                continue
+
+            total -= archive.stat().st_size
+            self.logger.debug(f"Evicting base image {archive.name}")
+            archive.unlink()
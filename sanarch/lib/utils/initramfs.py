@@ -0,0 +1,160 @@
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import ClassVar
+from sanarch.lib.command import Command
+from sanarch.lib.logger import Logger
+
+@dataclass
+class DeferredInitramfs:
+    """
+        Defers the initramfs generation of the target to a single pass at the end of the install.
+
+        While suppressed, the mkinitcpio pacman hook of the target is overridden by a hook
+        with the same triggers that only records its targets, and a mkinitcpio shim ahead
+        in PATH records the presets requested by the after-scripts. finalize() restores
+        both and builds the presets of every kernel that needs it, kernels in parallel.
+
+        restore() alone removes the override and the shim when the install stops before
+        finalize(); the pending targets are kept for the finalize() of the next run.
+
+        Usage
+        ----
+        initramfs = DeferredInitramfs("/mnt")
+        initramfs.suppress()
+        pacstrap ...
+        initramfs.finalize()
+    """
+    HOOK_PATH: ClassVar[str] = "/etc/pacman.d/hooks/90-mkinitcpio-install.hook"
+    SHIM_PATH: ClassVar[str] = "/usr/local/bin/mkinitcpio"
+    PENDING_PATH: ClassVar[str] = "/var/lib/sanarch/initramfs.pending"
+    INSTALL_SCRIPT: ClassVar[str] = "/usr/share/libalpm/scripts/mkinitcpio"
+    MODULES_DIR: ClassVar[str] = "/usr/lib/modules"
+    WORKERS: ClassVar[int] = 4
+    # Same triggers as the hook shipped by mkinitcpio
+    HOOK: ClassVar[str] = f"""[Trigger]
+Type = Path
+Operation = Install
+Operation = Upgrade
+Target = usr/lib/modules/*/vmlinuz
+Target = usr/lib/initcpio/*
+Target = usr/lib/firmware/*
+Target = usr/src/*/dkms.conf
+
+[Trigger]
+Type = Path
+Operation = Remove
+Operation = Upgrade
+Target = usr/lib/initcpio/*
+Target = usr/lib/firmware/*
+Target = usr/src/*/dkms.conf
+
+[Trigger]
+Type = Package
+Operation = Install
+Operation = Upgrade
+Target = mkinitcpio
+Target = mkinitcpio-git
+
+[Action]
+Description = Deferring the initcpio generation (sanarch)...
+When = PostTransaction
+NeedsTargets
+Exec = /bin/sh -c 'mkdir -p {Path(PENDING_PATH).parent} && cat >> {PENDING_PATH}'
+"""
+    SHIM: ClassVar[str] = f"""#!/bin/sh
+# Installed by sanarch while the initramfs generation is deferred
+for arg in "$@"; do
+    case "$arg" in
+        -P|--allpresets|-p|--preset|-p*|--preset=*)
+            mkdir -p {Path(PENDING_PATH).parent}
+            echo "mkinitcpio $*" >> {PENDING_PATH}
+            exit 0;;
+    esac
+done
+exec /usr/bin/mkinitcpio "$@"
+"""
+    VMLINUZ_REGEX: ClassVar[str] = r'^usr/lib/modules/([^/]+)/vmlinuz$'
+
+    root: str = field(default=Command.ROOT_PATH)
+    logger: Logger = field(default=None)
+
+    def __post_init__(self):
+        if not self.logger:
+            self.logger = Logger("logger-initramfs")
+
+    def __path(self, path) -> Path:
+        return Path(f'{self.root}{path}')
+
+    def suppress(self):
+        hook = self.__path(self.HOOK_PATH)
+        hook.parent.mkdir(parents=True, exist_ok=True)
+        hook.write_text(self.HOOK)
+
+        shim = self.__path(self.SHIM_PATH)
+        shim.parent.mkdir(parents=True, exist_ok=True)
+        shim.write_text(self.SHIM)
+        shim.chmod(0o755)
+
+    def restore(self):
+        self.__path(self.HOOK_PATH).unlink(missing_ok=True)
+        self.__path(self.SHIM_PATH).unlink(missing_ok=True)
+
+    def suppressed(self) -> bool:
+        return self.__path(self.HOOK_PATH).exists() or self.__path(self.SHIM_PATH).exists()
+
+    def pending(self) -> list[str]:
+        pending = self.__path(self.PENDING_PATH)
+        if not pending.exists():
+            return []
+
+        return [line.strip() for line in pending.read_text().splitlines() if line.strip()]
+
+    def kernels(self) -> dict[str, str]:
+        """ Kernel version -> pkgbase of every kernel installed in the target """
+        kernels = {}
+        for pkgbase in self.__path(self.MODULES_DIR).glob("*/pkgbase"):
+            kernels[pkgbase.parent.name] = pkgbase.read_text().strip()
+
+        return kernels
+
+    def changed_kernels(self) -> list[str]:
+        pending = self.pending()
+        kernels = self.kernels()
+        versions = set()
+        for line in pending:
+            match = re.match(self.VMLINUZ_REGEX, line)
+            if not match:
+                # Firmware, hooks, dkms modules, mkinitcpio itself or an explicit preset: every kernel
+                return sorted(kernels)
+            versions.add(match.group(1))
+
+        return sorted(version for version in versions if version in kernels)
+
+    def __generate(self, version):
+        start = time.monotonic()
+        # Installs the kernel image in /boot and builds the presets of its pkgbase
+        Command(self.INSTALL_SCRIPT, args=["install"])(input=f'usr/lib/modules/{version}/vmlinuz\n', arch_chroot=True)
+        return time.monotonic() - start
+
+    def finalize(self) -> dict[str, float]:
+        self.restore()
+        versions = self.changed_kernels()
+        if not versions:
+            self.logger.info("No initramfs to generate")
+            return {}
+
+        kernels = self.kernels()
+        self.logger.info(f"Generating the initramfs of {', '.join(kernels[version] for version in versions)}")
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.WORKERS) as executor:
+            timings = dict(zip(versions, executor.map(self.__generate, versions)))
+
+        for version, seconds in timings.items():
+            self.logger.debug(f"Generated the initramfs of {kernels[version]} ({version}) in {seconds:.1f}s")
+        self.logger.info(f"Generated {len(timings)} initramfs in {time.monotonic() - start:.1f}s")
+
+        self.__path(self.PENDING_PATH).unlink(missing_ok=True)
+        return timings
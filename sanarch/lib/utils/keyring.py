@@ -0,0 +1,125 @@
+import hashlib
+import shutil
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import ClassVar, Optional
+from sanarch.lib.command import Command
+from sanarch.lib.logger import Logger
+from sanarch.lib.utils.pkgcache import PackageCache
+from sanarch.lib.utils.syncdb import SyncDB
+
+@dataclass
+class KeyringProvisioner:
+    """
+        Provisions the pacman keyring of the target from the host.
+
+        The live environment already has an initialised and populated keyring. When
+        the host and the target have the same version of archlinux-keyring, the
+        keyring of the host is reused: verified if pacstrap already copied it, copied
+        otherwise. pacman-key --init and --populate only run when the versions differ
+        or the host keyring isn't initialised. The time taken by each path is kept
+        in timings.
+
+        Usage
+        ----
+        keyring = KeyringProvisioner("/mnt")
+        keyring.provision()  # "verified", "copied" or "populated"
+    """
+    GNUPG_DIR: ClassVar[str] = "/etc/pacman.d/gnupg"
+    KEYRING_PACKAGE: ClassVar[str] = "archlinux-keyring"
+    # gpg-agent sockets and lock files are specific to the host
+    IGNORE: ClassVar[tuple[str, ...]] = ("S.*", "*.lock", ".#*", "random_seed")
+
+    root: str = field(default=Command.ROOT_PATH)
+    host_root: str = field(default="")
+    logger: Logger = field(default=None)
+    # path -> seconds
+    timings: dict[str, float] = field(default_factory=dict, init=False)
+
+    def __post_init__(self):
+        if not self.logger:
+            self.logger = Logger("logger-keyring")
+
+    @classmethod
+    def keyring_version(cls, root) -> Optional[str]:
+        local_db = Path(f'{root}{PackageCache.LOCAL_DB_PATH}')
+        for entry in local_db.glob(f'{cls.KEYRING_PACKAGE}-*/desc'):
+            desc = SyncDB.parse_desc(entry.read_text())
+            if desc.get("NAME") == [cls.KEYRING_PACKAGE]:
+                return desc["VERSION"][0]
+
+        return None
+
+    @property
+    def host_gnupg(self) -> Path:
+        return Path(f'{self.host_root}{self.GNUPG_DIR}')
+
+    @property
+    def target_gnupg(self) -> Path:
+        return Path(f'{self.root}{self.GNUPG_DIR}')
+
+    @staticmethod
+    def initialised(gnupg: Path) -> bool:
+        return (gnupg / "trustdb.gpg").exists() and any((gnupg / ring).exists() for ring in ["pubring.gpg", "pubring.kbx"])
+
+    def __digest(self, gnupg: Path) -> str:
+        ignored = shutil.ignore_patterns(*self.IGNORE)
+        digest = hashlib.sha256()
+        for file in sorted(gnupg.rglob("*")):
+            if not file.is_file() or file.is_symlink() or ignored(str(file.parent), [file.name]):
+                continue
+            digest.update(str(file.relative_to(gnupg)).encode())
+            digest.update(file.read_bytes())
+
+        return digest.hexdigest()
+
+    def reusable(self) -> bool:
+        host_version = self.keyring_version(self.host_root)
+        target_version = self.keyring_version(self.root)
+        if not host_version or host_version != target_version:
+            self.logger.debug(f"{self.KEYRING_PACKAGE} {host_version} on the host, {target_version} in the target")
+            return False
+
+        return self.initialised(self.host_gnupg)
+
+    def verify(self) -> bool:
+        return self.initialised(self.target_gnupg) and self.__digest(self.host_gnupg) == self.__digest(self.target_gnupg)
+
+    def copy(self):
+        if self.target_gnupg.exists():
+            shutil.rmtree(self.target_gnupg)
+
+        shutil.copytree(self.host_gnupg, self.target_gnupg, symlinks=True, ignore=shutil.ignore_patterns(*self.IGNORE))
+        if not self.verify():
+            raise Exception(f"Keyring copied to {self.target_gnupg} doesn't match {self.host_gnupg}")
+
+    def populate(self):
+        Command('pacman-key', args=['--init'])(arch_chroot=True)
+        Command('pacman-key', args=['--populate'])(arch_chroot=True)
+
+    def __timed(self, name, func):
+        start = time.monotonic()
+        result = func()
+        self.timings[name] = time.monotonic() - start
+        return result
+
+    def provision(self) -> str:
+        if self.__timed("check", self.reusable):
+            if self.__timed("verify", self.verify):
+                method = "verified"
+            else:
+                try:
+                    self.__timed("copy", self.copy)
+                    method = "copied"
+                except Exception as e:
+                    self.logger.warn(f"Unable to copy the host keyring: {e}")
+                    self.__timed("populate", self.populate)
+                    method = "populated"
+        else:
+            self.__timed("populate", self.populate)
+            method = "populated"
+
+        timings = ", ".join(f'{name} {seconds:.2f}s' for name, seconds in self.timings.items())
+        self.logger.info(f"Pacman keyring {method} ({timings})")
+        return method
@@ -0,0 +1,201 @@
+import asyncio
+import json
+import re
+import ssl
+import time
+import urllib.parse
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import ClassVar, Optional
+from sanarch.lib.logger import Logger
+
+@dataclass
+class MirrorResult:
+    server: str
+    ttfb: Optional[float] = field(default=None) # seconds
+    rate: Optional[float] = field(default=None) # bytes/s
+    error: Optional[str] = field(default=None)
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def seconds(self, nbytes) -> float:
+        """ Expected time to download nbytes from the mirror """
+        return self.ttfb + nbytes / self.rate if self.ok else float("inf")
+
+    def __str__(self):
+        if not self.ok:
+            return f'{self.server}: {self.error}'
+
+        return f'{self.server}: {self.ttfb * 1000:.0f} ms, {self.rate / 1024 ** 2:.2f} MiB/s'
+
+
+@dataclass
+class MirrorRanker:
+    """
+        Ranks the enabled servers in a mirrorlist by probing them all concurrently.
+        Commented servers are neither probed nor enabled; write() keeps them commented.
+        The servers that didn't respond are commented out by write() with an
+        UNREACHABLE mark, and are probed again by the next rank().
+
+        Each server is asked for the first PROBE_BYTES of the core database, and
+        servers are ordered by the time they would take to serve a package of
+        RANK_BYTES (time to first byte plus the transfer). The results are cached
+        for TTL seconds so a resumed install doesn't probe again.
+
+        Usage
+        ----
+        ranker = MirrorRanker()
+        results = ranker.rank()
+        ranker.write(results, "/mnt/etc/pacman.d/mirrorlist")
+    """
+    MIRRORLIST: ClassVar[str] = "/etc/pacman.d/mirrorlist"
+    CACHE_PATH: ClassVar[str] = "/tmp/sanarch/mirrors.json"
+    PROBE_REPO: ClassVar[str] = "core"
+    ARCH: ClassVar[str] = "x86_64"
+    PROBE_BYTES: ClassVar[int] = 256 * 1024
+    RANK_BYTES: ClassVar[int] = 2 * 1024 ** 2
+    TIMEOUT: ClassVar[float] = 5.0
+    CONCURRENCY: ClassVar[int] = 16
+    TTL: ClassVar[int] = 3600
+    UNREACHABLE: ClassVar[str] = "# unreachable"
+    SERVER_REGEX: ClassVar[str] = r'^\s*Server\s*=\s*(\S+)'
+    UNREACHABLE_SERVER_REGEX: ClassVar[str] = rf'^\s*#\s*Server\s*=\s*(\S+)\s*{UNREACHABLE}'
+    DISABLED_SERVER_REGEX: ClassVar[str] = rf'^\s*#\s*Server\s*=\s*(\S+)(?!\S)(?!\s*{UNREACHABLE})'
+
+    mirrorlist: str = field(default=MIRRORLIST)
+    cache_path: str = field(default=CACHE_PATH)
+    logger: Logger = field(default=None)
+
+    def __post_init__(self):
+        if not self.logger:
+            self.logger = Logger("logger-mirrors")
+
+    def __find(self, regex) -> list[str]:
+        text = Path(self.mirrorlist).read_text()
+        return list(dict.fromkeys(re.findall(regex, text, flags=re.MULTILINE)))
+
+    def servers(self) -> list[str]:
+        """ Enabled servers and the ones a previous write() found unreachable """
+        return list(dict.fromkeys(self.__find(self.SERVER_REGEX) + self.__find(self.UNREACHABLE_SERVER_REGEX)))
+
+    def disabled_servers(self) -> list[str]:
+        return self.__find(self.DISABLED_SERVER_REGEX)
+
+    def probe_url(self, server) -> str:
+        base = server.replace("$repo", self.PROBE_REPO).replace("$arch", self.ARCH)
+        return f'{base.rstrip("/")}/{self.PROBE_REPO}.db'
+
+    async def __get(self, url) -> tuple[float, float]:
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ["http", "https"]:
+            raise Exception(f"unsupported scheme {parts.scheme}")
+
+        https = parts.scheme == "https"
+        port = parts.port or (443 if https else 80)
+        path = parts.path or "/"
+
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        reader, writer = await asyncio.open_connection(
+            parts.hostname, port, ssl=ssl.create_default_context() if https else None)
+        try:
+            request = (f'GET {path} HTTP/1.1\r\nHost: {parts.hostname}\r\n'
+                       f'User-Agent: sanarch\r\nRange: bytes=0-{self.PROBE_BYTES - 1}\r\nConnection: close\r\n\r\n')
+            writer.write(request.encode())
+            await writer.drain()
+
+            status = await reader.readline()
+            first_byte = loop.time()
+            code = int(status.split()[1])
+            if code not in [200, 206]:
+                raise Exception(f"HTTP {code}")
+
+            while (await reader.readline()) not in [b"\r\n", b"\n", b""]:
+                pass
+
+            received = 0
+            while received < self.PROBE_BYTES:
+                chunk = await reader.read(64 * 1024)
+                if not chunk:
+                    break
+                received += len(chunk)
+
+            end = loop.time()
+        finally:
+            writer.close()
+
+        if not received:
+            raise Exception("empty response")
+
+        return first_byte - start, received / max(end - first_byte, 1e-6)
+
+    async def probe(self, server, semaphore = None) -> MirrorResult:
+        semaphore = semaphore or asyncio.Semaphore(1)
+        async with semaphore:
+            try:
+                ttfb, rate = await asyncio.wait_for(self.__get(self.probe_url(server)), self.TIMEOUT)
+                return MirrorResult(server, ttfb=ttfb, rate=rate)
+            except asyncio.TimeoutError:
+                return MirrorResult(server, error="timed out")
+            except Exception as e:
+                return MirrorResult(server, error=str(e) or type(e).__name__)
+
+    async def probe_all(self, servers) -> list[MirrorResult]:
+        semaphore = asyncio.Semaphore(self.CONCURRENCY)
+        return list(await asyncio.gather(*[self.probe(server, semaphore) for server in servers]))
+
+    def __load_cache(self, servers) -> Optional[list[MirrorResult]]:
+        path = Path(self.cache_path)
+        if not path.exists():
+            return None
+
+        try:
+            cache = json.loads(path.read_text())
+        except ValueError:
+            return None
+
+        if time.time() - cache["time"] > self.TTL or sorted(cache["servers"]) != sorted(servers):
+            return None
+
+        return [MirrorResult(**result) for result in cache["results"]]
+
+    def __save_cache(self, servers, results):
+        path = Path(self.cache_path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        cache = {"time": time.time(), "servers": servers, "results": [asdict(result) for result in results]}
+        path.write_text(json.dumps(cache))
+
+    def rank(self) -> list[MirrorResult]:
+        servers = self.servers()
+        results = self.__load_cache(servers)
+        if results is not None:
+            self.logger.debug(f"Using the mirror ranking cached in {self.cache_path}")
+            return results
+
+        self.logger.debug(f"Probing {len(servers)} mirrors")
+        results = asyncio.run(self.probe_all(servers))
+        results.sort(key=lambda result: result.seconds(self.RANK_BYTES))
+        self.__save_cache(servers, results)
+
+        for result in results:
+            self.logger.debug(str(result))
+
+        return results
+
+    def write(self, results: list[MirrorResult], path = MIRRORLIST):
+        ranked = {result.server for result in results}
+        disabled = [server for server in self.disabled_servers() if server not in ranked]
+        path = Path(path)
+        if path.exists():
+            path.replace(path.with_name(f'{path.name}.bak'))
+
+        lines = [f"## Ranked by sanarch: expected time to download {self.RANK_BYTES // 1024 ** 2} MiB\n"]
+        lines += [f'Server = {result.server}\n' for result in results if result.ok]
+        lines += [f'#Server = {result.server} {self.UNREACHABLE}\n' for result in results if not result.ok]
+        lines += [f'#Server = {server}\n' for server in disabled]
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as mirrorlist:
+            mirrorlist.writelines(lines)
@@ -0,0 +1,109 @@
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import ClassVar
+from sanarch.lib.command import Command
+from sanarch.lib.logger import Logger
+
+@dataclass
+class OfflineRepo:
+    """
+        Local pacman repository built from a directory of package files.
+
+        The same pacman.conf, pointing only at this repository, is written to the host
+        and the target. The directory is bind mounted at the same path inside the target,
+        so pacstrap, pacman on the host and pacman in the chroot all use it.
+
+        While installing, it also replaces the pacman.conf of the target so that the
+        after-scripts running pacman themselves use it; the original is restored at the end.
+
+        Usage
+        ----
+        repo = OfflineRepo("/srv/packages")
+        repo.build()
+        repo.write_config()
+        repo.replace_target_config(root)
+        ...
+        repo.restore_target_config(root)
+    """
+    NAME: ClassVar[str] = "offline"
+    CONFIG_PATH: ClassVar[str] = "/etc/pacman-offline.conf"
+    TARGET_CONFIG_PATH: ClassVar[str] = "/etc/pacman.conf"
+    BACKUP_SUFFIX: ClassVar[str] = ".sanarch"
+    PACKAGE_GLOB: ClassVar[str] = "*.pkg.tar.*"
+
+    path: str
+    logger: Logger = field(default=None)
+
+    def __post_init__(self):
+        if not self.logger:
+            self.logger = Logger("logger-offline")
+
+        self.path = str(Path(self.path).resolve())
+        if not Path(self.path).is_dir():
+            raise Exception(f"Offline repository: {self.path} does not exist.")
+
+    @property
+    def db_path(self) -> Path:
+        return Path(self.path) / f'{self.NAME}.db.tar.gz'
+
+    @property
+    def bind(self) -> tuple[str, str]:
+        return (self.path, self.path)
+
+    def packages(self) -> list[Path]:
+        return sorted(pkg for pkg in Path(self.path).glob(self.PACKAGE_GLOB) if not pkg.name.endswith(".sig"))
+
+    def is_stale(self) -> bool:
+        if not self.db_path.exists():
+            return True
+
+        db_mtime = self.db_path.stat().st_mtime
+        return any(pkg.stat().st_mtime > db_mtime for pkg in self.packages())
+
+    def build(self):
+        packages = self.packages()
+        if not packages:
+            raise Exception(f"No packages found in the offline repository: {self.path}")
+
+        if not self.is_stale():
+            self.logger.debug(f"Using the existing repository database {self.db_path}")
+            return
+
+        self.logger.info(f"Indexing {len(packages)} packages in {self.path}")
+        Command('repo-add', args=['--quiet', str(self.db_path)] + [str(pkg) for pkg in packages])()
+
+    @property
+    def config(self) -> str:
+        return (
+            "[options]\n"
+            "Architecture = auto\n"
+            "SigLevel = Optional TrustAll\n"
+            "LocalFileSigLevel = Optional\n"
+            "\n"
+            f"[{self.NAME}]\n"
+            f"Server = file://{self.path}\n"
+        )
+
+    def write_config(self, root = ""):
+        config_path = Path(f'{root}{self.CONFIG_PATH}')
+        config_path.parent.mkdir(parents=True, exist_ok=True)
+        config_path.write_text(self.config)
+        return str(config_path)
+
+    def replace_target_config(self, root):
+        config_path = Path(f'{root}{self.TARGET_CONFIG_PATH}')
+        backup_path = Path(f'{config_path}{self.BACKUP_SUFFIX}')
+        # A resumed install already replaced it; the backup is the original
+        if config_path.exists() and not backup_path.exists():
+            config_path.replace(backup_path)
+
+        config_path.write_text(self.config)
+
+    def restore_target_config(self, root):
+        config_path = Path(f'{root}{self.TARGET_CONFIG_PATH}')
+        backup_path = Path(f'{config_path}{self.BACKUP_SUFFIX}')
+        if not backup_path.exists():
+            return False
+
+        backup_path.replace(config_path)
+        return True
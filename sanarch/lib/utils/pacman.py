@@ -1,14 +1,24 @@
-from subprocess import PIPE
 from dataclasses import dataclass, field
+from typing import ClassVar
 from sanarch.lib.command import Command
 
 @dataclass
 class Pacman:
+    # pacman.conf used by every Pacman that is not given one; eg: the offline repository
+    DEFAULT_CONFIG: ClassVar[str] = None
+
     arch_chroot: bool = field(default=True)
+    config: str = field(default=None)
     pacman: Command = field(default=None, init=False)
 
     def __post_init__(self):
-        self.pacman = Command(name="pacman", capture_output=False, stderr=PIPE)
+        self.pacman = Command(name="pacman", stream=True)
+        if not self.config:
+            self.config = self.DEFAULT_CONFIG
+
+    @property
+    def config_args(self):
+        return ["--config", self.config] if self.config else []
 
     def __empty_args(self):
         self.pacman.args = []
@@ -17,24 +27,34 @@ class Pacman:
         if not packages:
             packages = []
 
-        args = ["-S", "--noconfirm"] + packages
+        args = self.config_args + ["-S", "--noconfirm"] + packages
         self.pacman.args = args
 
         self.pacman(arch_chroot=self.arch_chroot)
         self.__empty_args()
 
+    def download(self, packages = None, refresh = True):
+        """ Download the packages into the cache without installing them """
+        if not packages:
+            packages = []
+
+        args = self.config_args + ["-Syw" if refresh else "-Sw", "--noconfirm"] + packages
+        # Own command so that a download running in the background doesn't share the arguments
+        # of the install command, and its output doesn't interleave with the console
+        return Command(name="pacman", args=args)(arch_chroot=self.arch_chroot)
+
     def refresh_db(self, force = False):
         if not force:
-            self.pacman.args = ["-Sy"]
+            self.pacman.args = self.config_args + ["-Sy"]
         else:
-            self.pacman.args = ["-Syy"]
+            self.pacman.args = self.config_args + ["-Syy"]
         
         self.pacman(arch_chroot=self.arch_chroot)
         self.__empty_args()
 
     def setup_parallel_download(self, parallel_downloads = 1, arch_chroot = True):
         if arch_chroot:
-            file = "/mnt/etc/pacman.conf"
+            file = f'{Command.ROOT_PATH}/etc/pacman.conf'
         else:
             file = "/etc/pacman.conf"
         
@@ -0,0 +1,96 @@
+import shutil
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import ClassVar
+from sanarch.lib.command import Command
+
+@dataclass
+class PackageCache:
+    """
+        The single package cache used for the whole install.
+
+        The host cache is used by the prefetch and pacstrap (-c), and is bind mounted
+        on the cache directory of the target while the chroot session is open, so the
+        pacman transactions inside the chroot and the after-scripts use it as well.
+
+        The host cache of the live ISO lives in a small copy-on-write overlay, so once
+        the target is mounted its cache directory is bind mounted over the host cache
+        and the packages are downloaded onto the target from then on.
+    """
+    TARGET_PATH: ClassVar[str] = "/var/cache/pacman/pkg"
+    LOCAL_DB_PATH: ClassVar[str] = "/var/lib/pacman/local"
+
+    path: str = field(default="/var/cache/pacman/pkg")
+    snapshots: dict[str, set[str]] = field(default_factory=dict, init=False)
+    target: str = field(default=None, init=False)
+
+    @property
+    def bind(self) -> tuple[str, str]:
+        return (self.path, self.TARGET_PATH)
+
+    def files(self) -> set[str]:
+        cache = Path(self.path)
+        if not cache.is_dir():
+            return set()
+
+        return {
+            pkg.name for pkg in cache.iterdir()
+            if ".pkg.tar" in pkg.name and not pkg.name.endswith((".sig", ".part"))
+        }
+
+    def move_to(self, root, move_files = True):
+        """ move_files: move what is already in the host cache to the target as well """
+        if self.target:
+            return
+
+        target = Path(f'{root}{self.TARGET_PATH}')
+        target.mkdir(parents=True, exist_ok=True)
+        cache = Path(self.path)
+        if move_files and cache.is_dir():
+            for file in cache.iterdir():
+                if file.is_file():
+                    shutil.move(file, target / file.name)
+
+        Command("mount", args=["--bind", str(target), self.path])()
+        self.target = str(target)
+
+    def release(self):
+        if not self.target:
+            return
+
+        Command("umount", args=["-l", self.path], check_returncode=False)()
+        self.target = None
+
+    def snapshot(self, name):
+        self.snapshots[name] = self.files()
+
+    @staticmethod
+    def installed(root) -> set[str]:
+        # Entries of the local db are named {pkgname}-{pkgver}-{pkgrel}
+        local_db = Path(f'{root}{PackageCache.LOCAL_DB_PATH}')
+        if not local_db.is_dir():
+            return set()
+
+        return {entry.name for entry in local_db.iterdir() if entry.is_dir()}
+
+    def stats(self, root, start = "start", prefetched = "prefetched") -> dict[str, int]:
+        """
+            prefetched: packages downloaded by the prefetch
+            misses: packages downloaded by the transactions themselves
+            hits: packages installed in the target without being downloaded by its transaction
+        """
+        before = self.snapshots.get(start, set())
+        after_prefetch = self.snapshots.get(prefetched, before)
+        misses = self.files() - after_prefetch
+        installed = self.installed(root)
+        missed = {pkg for pkg in installed if any(file.startswith(f'{pkg}-') for file in misses)}
+
+        return {
+            "prefetched": len(after_prefetch - before),
+            "hits": len(installed - missed),
+            "misses": len(misses),
+        }
+
+    def report(self, root) -> str:
+        stats = self.stats(root)
+        return f'Package cache {self.path}: {stats["hits"]} hits, {stats["misses"]} misses, {stats["prefetched"]} prefetched'
@@ -0,0 +1,90 @@
+import time
+from dataclasses import dataclass, field
+from threading import Thread
+from sanarch.lib.exceptions import CommandError
+from sanarch.lib.logger import Logger
+from sanarch.lib.utils.pacman import Pacman
+
+@dataclass
+class PackagePrefetcher:
+    """
+        Downloads packages into the host package cache in the background
+        (pacman -Syw), so that the later transactions install from the cache.
+
+        Packages pacman can't find are left out and the others are downloaded;
+        whatever isn't prefetched is downloaded by the transaction that needs it.
+
+        Usage
+        ----
+        prefetcher = PackagePrefetcher(packages, logger=logger)
+        prefetcher.start()
+        ...
+        prefetcher.wait()
+    """
+    packages: list[str]
+    logger: Logger = field(default=None)
+    error: Exception = field(default=None, init=False)
+    elapsed: float = field(default=None, init=False)
+    thread: Thread = field(default=None, init=False)
+
+    def __post_init__(self):
+        if not self.logger:
+            self.logger = Logger("logger-prefetch")
+
+        # Keep the first occurrence of every package
+        self.packages = list(dict.fromkeys(self.packages))
+
+    @staticmethod
+    def __not_found(error: CommandError) -> list[str]:
+        # eg: error: target not found: foo
+        missing = []
+        for line in str(error.msg).splitlines():
+            fields = line.split(":")
+            if len(fields) >= 3 and fields[1].strip().lower() == "target not found":
+                missing.append(fields[2].strip())
+        return missing
+
+    def __run(self):
+        start = time.monotonic()
+        try:
+            packages = self.packages
+            try:
+                Pacman(arch_chroot=False).download(packages)
+            except CommandError as e:
+                # A single unknown package fails the whole download
+                missing = self.__not_found(e)
+                packages = [package for package in packages if package not in missing]
+                if not missing or not packages:
+                    raise e
+                self.logger.warn(f"Not prefetching packages that weren't found: {', '.join(missing)}")
+                Pacman(arch_chroot=False).download(packages, refresh=False)
+                self.packages = packages
+        except Exception as e:
+            self.error = e
+        finally:
+            self.elapsed = time.monotonic() - start
+
+    @property
+    def running(self) -> bool:
+        return bool(self.thread and self.thread.is_alive())
+
+    def start(self):
+        if not self.packages or self.thread:
+            return
+
+        self.logger.debug(f"Prefetching {len(self.packages)} packages into the host cache")
+        self.thread = Thread(target=self.__run, name="prefetch", daemon=True)
+        self.thread.start()
+
+    def wait(self) -> bool:
+        if not self.thread:
+            return False
+
+        self.thread.join()
+        if self.error:
+            # Nothing is lost; the packages will be downloaded by the transaction that needs them
+            self.logger.warn(f"Unable to prefetch packages\n---\nError:\n{self.error}\n---\n")
+            return False
+
+        self.logger.info(f"Prefetched {len(self.packages)} packages in {self.elapsed:.1f}s")
+        return True
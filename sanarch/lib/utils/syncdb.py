@@ -0,0 +1,171 @@
+import re
+import tarfile
+from dataclasses import dataclass, field
+from io import BytesIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import ClassVar, Optional
+from sanarch.lib.command import Command
+
+@dataclass
+class SyncPackage:
+    name: str
+    version: str
+    repo: str
+    filename: str = field(default=None)
+    csize: int = field(default=0) # download size
+    isize: int = field(default=0) # installed size
+    depends: list[str] = field(default_factory=list)
+    provides: list[str] = field(default_factory=list)
+    groups: list[str] = field(default_factory=list)
+
+
+@dataclass
+class SyncDB:
+    """
+        In memory index of the pacman sync databases (core.db, extra.db, ...),
+        read straight from the database tarballs.
+
+        Usage
+        ----
+        index = SyncDB.load()
+        index.missing(["base", "linux", "no-such-package"])  # ["no-such-package"]
+    """
+    SYNC_DB_DIR: ClassVar[str] = "/var/lib/pacman/sync"
+    # Order of the repositories in the default pacman.conf; the first repository providing a package wins
+    REPO_ORDER: ClassVar[list[str]] = ["core", "extra", "multilib"]
+    ZSTD_MAGIC: ClassVar[bytes] = b"\x28\xb5\x2f\xfd"
+
+    packages: dict[str, SyncPackage] = field(default_factory=dict)
+    providers: dict[str, list[str]] = field(default_factory=dict)
+    groups: dict[str, list[str]] = field(default_factory=dict)
+
+    @staticmethod
+    def strip_version(depend: str) -> str:
+        # eg: glibc>=2.38 -> glibc, sh: description -> sh
+        return re.split(r'[<>=:]', depend, maxsplit=1)[0].strip()
+
+    @staticmethod
+    def parse_desc(text: str) -> dict[str, list[str]]:
+        desc = {}
+        key = None
+        for line in text.splitlines():
+            if line.startswith('%') and line.endswith('%'):
+                key = line.strip('%')
+                desc[key] = []
+            elif line and key:
+                desc[key].append(line)
+
+        return desc
+
+    @classmethod
+    def __open(cls, path: Path) -> tarfile.TarFile:
+        with open(path, "rb") as db:
+            magic = db.read(4)
+
+        if magic == cls.ZSTD_MAGIC:
+            # tarfile doesn't support zstd before python 3.14; the output of a Command is text, so it goes to a file
+            with TemporaryDirectory(prefix="sanarch-syncdb-") as tmp:
+                tar = Path(tmp) / "db.tar"
+                Command("zstd", args=["-d", "-q", str(path), "-o", str(tar)])()
+                return tarfile.open(fileobj=BytesIO(tar.read_bytes()))
+
+        return tarfile.open(path)
+
+    @classmethod
+    def default_paths(cls, sync_db_dir = None) -> list[Path]:
+        def priority(db: Path):
+            repo = db.name.split('.')[0]
+            return (cls.REPO_ORDER.index(repo) if repo in cls.REPO_ORDER else len(cls.REPO_ORDER), repo)
+
+        return sorted(Path(sync_db_dir or cls.SYNC_DB_DIR).glob("*.db"), key=priority)
+
+    @classmethod
+    def load(cls, paths = None) -> Optional["SyncDB"]:
+        """ Index of the given database files; None if there are no databases to read """
+        paths = [Path(path) for path in paths] if paths else cls.default_paths()
+        paths = [path for path in paths if path.exists()]
+        if not paths:
+            return None
+
+        index = cls()
+        for path in paths:
+            index.add(path)
+
+        return index
+
+    def add(self, path: Path):
+        repo = path.name.split('.')[0]
+        with self.__open(path) as db:
+            for member in db:
+                if not member.isfile() or not member.name.endswith("/desc"):
+                    continue
+
+                desc = self.parse_desc(db.extractfile(member).read().decode())
+                package = SyncPackage(
+                    name=desc["NAME"][0],
+                    version=desc["VERSION"][0],
+                    repo=repo,
+                    filename=desc.get("FILENAME", [None])[0],
+                    csize=int(desc.get("CSIZE", [0])[0]),
+                    isize=int(desc.get("ISIZE", [0])[0]),
+                    depends=[self.strip_version(depend) for depend in desc.get("DEPENDS", [])],
+                    provides=[self.strip_version(provide) for provide in desc.get("PROVIDES", [])],
+                    groups=desc.get("GROUPS", []),
+                )
+
+                if package.name in self.packages:
+                    continue
+
+                self.packages[package.name] = package
+                for provide in package.provides:
+                    self.providers.setdefault(provide, []).append(package.name)
+                for group in package.groups:
+                    self.groups.setdefault(group, []).append(package.name)
+
+    def resolve(self, name: str) -> Optional[list[str]]:
+        """ Packages that pacman would install for a name, group or virtual package """
+        if name in self.packages:
+            return [name]
+        if name in self.groups:
+            return list(self.groups[name])
+        if name in self.providers:
+            return [self.providers[name][0]]
+
+        return None
+
+    def missing(self, names: list[str]) -> list[str]:
+        return [name for name in names if self.resolve(name) is None]
+
+    def closure(self, names: list[str]) -> set[str]:
+        """ Packages installed for the names including all their dependencies """
+        closure = set()
+        pending = list(names)
+        while pending:
+            resolved = self.resolve(pending.pop()) or []
+            for name in resolved:
+                if name in closure:
+                    continue
+
+                closure.add(name)
+                pending += self.packages[name].depends
+
+        return closure
+
+
+@dataclass
+class SpaceEstimate:
+    packages: set[str]
+    download_bytes: int
+    installed_bytes: int
+
+    @classmethod
+    def of(cls, index: SyncDB, names: list[str], cached: set[str] = None) -> "SpaceEstimate":
+        """ cached: package files already in the cache, which are not downloaded again """
+        packages = index.closure(names)
+        cached = cached or set()
+        return cls(
+            packages=packages,
+            download_bytes=sum(index.packages[name].csize for name in packages if index.packages[name].filename not in cached),
+            installed_bytes=sum(index.packages[name].isize for name in packages),
+        )
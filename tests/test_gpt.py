@@ -0,0 +1,110 @@
+import struct
+import pytest
+from sanarch.lib.disk.gpt import GPTTable
+from sanarch.lib.disk.partition import Partition
+from sanarch.lib.exceptions import GPTError
+
+MIB = 1024 ** 2
+
+@pytest.fixture
+def image(tmp_path):
+    path = tmp_path / "disk.img"
+    with open(path, "wb") as f:
+        f.truncate(64 * MIB)
+    return path
+
+
+def write_mbr(path, partitions):
+    """ partitions: (type, first_lba, sectors) """
+    mbr = bytearray(512)
+    for idx, (mbr_type, first_lba, sectors) in enumerate(partitions):
+        struct.pack_into("<B3sB3sII", mbr, 446 + idx * 16, 0, bytes(3), mbr_type, bytes(3), first_lba, sectors)
+    mbr[510:512] = b"\x55\xaa"
+    with open(path, "r+b") as f:
+        f.write(mbr)
+
+
+def test_blank_disk_is_all_free(image):
+    table = GPTTable.read(image)
+    assert table.partitions == []
+    assert table.sector_size == 512
+    assert table.free_extents() == [(table.first_usable_lba, table.last_usable_lba)]
+
+
+def test_round_trip(image):
+    table = GPTTable.new(image)
+    efi = table.create(1, sectors=16 * MIB // 512, type_code="ef00", name="efi")
+    root = table.create(2, type_code="8300", name="root")
+    table.write()
+
+    read = GPTTable.read(image)
+    assert read.disk_guid == table.disk_guid
+    assert read.partitions == [efi, root]
+    assert read.typecodes() == {"1": "EF00", "2": "8300"}
+    assert efi.first_lba == GPTTable.ALIGNMENT
+    assert root.last_lba == table.last_usable_lba
+    # Only the gap before the first aligned sector is left
+    assert read.free_extents() == [(table.first_usable_lba, GPTTable.ALIGNMENT - 1)]
+
+    # Backup header in the last sector
+    with open(image, "rb") as f:
+        f.seek((table.total_sectors - 1) * 512)
+        assert f.read(8) == GPTTable.SIGNATURE
+
+
+def test_delete_and_rewrite(image):
+    table = GPTTable.new(image)
+    table.create(1, sectors=8 * MIB // 512)
+    table.create(2)
+    table.write()
+
+    table = GPTTable.read(image)
+    table.delete(2)
+    table.write()
+    assert [entry.number for entry in GPTTable.read(image).partitions] == [1]
+    with pytest.raises(GPTError):
+        table.delete(2)
+
+
+def test_corrupted_header(image):
+    GPTTable.new(image).write()
+    with open(image, "r+b") as f:
+        f.seek(512 + 40)
+        f.write(b"\xff")
+
+    with pytest.raises(GPTError):
+        GPTTable.read(image)
+
+
+def test_no_space_left(image):
+    table = GPTTable.new(image)
+    table.create(1)
+    with pytest.raises(GPTError):
+        table.create(2)
+
+
+def test_mbr_partitions_are_kept(image):
+    write_mbr(image, [(0x07, 2048, 8192), (0x83, 10240, 8192)])
+    table = GPTTable.read(image)
+    assert table.typecodes() == {"1": "0700", "2": "8300"}
+    assert [(entry.first_lba, entry.last_lba) for entry in table.partitions] == [(2048, 10239), (10240, 18431)]
+    assert all(first > 18431 or last < 2048 for first, last in table.free_extents())
+
+
+def test_mbr_logical_partitions(image):
+    write_mbr(image, [(0x05, 2048, 8192)])
+    with pytest.raises(GPTError):
+        GPTTable.read(image)
+
+
+def test_partition_types_compare_by_guid(image):
+    table = GPTTable.new(image)
+    table.create(1, sectors=8 * MIB // 512, type_code="a504")
+    table.create(2, type_code="0FC63DAF-8483-4772-8E79-3D69D8477DE4")
+    table.write()
+
+    typecodes = GPTTable.read(image).typecodes()
+    assert typecodes == {"1": "A504", "2": "8300"}
+    assert Partition(str(image), "8m", 1, type="a504") == Partition(str(image), "8m", 1, type=typecodes["1"])
+    assert Partition(str(image), "8m", 2, type="8300") == Partition(str(image), "8m", 2, type=typecodes["2"])
+    assert Partition(str(image), "8m", 2, type="8301") != Partition(str(image), "8m", 2, type=typecodes["2"])
@@ -0,0 +1,123 @@
+import json
+import os
+import subprocess
+import shutil
+import pytest
+import yaml
+from sanarch.archinstaller import ArchInstaller
+from sanarch.lib.command import Command
+from sanarch.lib.disk.blockdevice import BlockDevice
+from sanarch.lib.runner import RecordingRunner, ReplayRunner, Runner
+from sanarch.lib.utils.initramfs import DeferredInitramfs
+
+MIB = 1024 ** 2
+TARGET_FILES = {
+    "/etc/locale.gen": "#en_US.UTF-8 UTF-8\n",
+    "/etc/sudoers": "root ALL=(ALL:ALL) ALL\n# %wheel ALL=(ALL:ALL) ALL\n",
+    "/etc/pacman.conf": "[options]\n#ParallelDownloads = 5\n",
+}
+
+
+class ScriptedRunner(Runner):
+    """ Answers every command like a successful install would, without running anything """
+    def __init__(self, image):
+        self.image = str(image)
+        self.programs = []
+
+    def run(self, command, input, program_name):
+        self.programs.append(program_name)
+        stdout = ""
+        if program_name == "lsblk":
+            stdout = json.dumps({"blockdevices": [{"name": "disk.img", "path": self.image, "size": "64M",
+                                                   "model": None, "children": []}]})
+        elif program_name == "nproc":
+            stdout = "2\n"
+        elif program_name == "timedatectl":
+            stdout = "NTP service: active\n"
+        elif program_name == "pacstrap":
+            # What the installer reads from the target afterwards
+            for path, content in TARGET_FILES.items():
+                file = f'{Command.ROOT_PATH}{path}'
+                os.makedirs(os.path.dirname(file), exist_ok=True)
+                with open(file, "w") as target:
+                    target.write(content)
+
+        if command.stdout not in [None, subprocess.PIPE, subprocess.DEVNULL]:
+            command.stdout.write(stdout)
+        return subprocess.CompletedProcess(command.cmd, 0, stdout=stdout, stderr="")
+
+
+@pytest.fixture
+def session(tmp_path, monkeypatch):
+    image = tmp_path / "disk.img"
+    with open(image, "wb") as f:
+        f.truncate(64 * MIB)
+
+    record_root = tmp_path / "target"
+    record_root.mkdir()
+    profile = tmp_path / "profile.yaml"
+    profile.write_text(yaml.safe_dump({
+        "partlabel": [{
+            "device": str(image), "wipe": True, "skip-partition": False, "remove-partitions": [],
+            "partitions": [
+                {"number": 1, "path": f'{image}1', "label": "efi", "type": "ef00", "fs": "vfat", "size": "32m",
+                 "mountpoint": f'{record_root}/efi', "force-format": True, "overwrite": True},
+                {"number": 2, "path": f'{image}2', "label": "root", "type": "8300", "fs": "ext4", "size": "0",
+                 "mountpoint": str(record_root), "force-format": True, "overwrite": True},
+            ],
+        }],
+        "base-packages": ["base", "linux"],
+        "hostname": "replayed",
+        "users": [{"name": "archuser", "create-home": True, "groups": ["wheel"]}],
+        "packages": ["openssh"],
+        "enable-services": ["sshd.service"],
+        "after-scripts": [],
+    }))
+
+    log_dir = tmp_path / "logs"
+    monkeypatch.setattr(ArchInstaller, "LOG_DIR", str(log_dir))
+    monkeypatch.setattr(BlockDevice, "PART_TABLE_BACKUP_DIR", str(log_dir))
+    monkeypatch.setattr(DeferredInitramfs, "PENDING_PATH", str(log_dir / "initramfs.pending"))
+    for name in ["ROOT_PATH", "runner", "tracer", "logger", "chroot_session"]:
+        monkeypatch.setattr(Command, name, getattr(Command, name))
+    return image, profile, record_root, log_dir
+
+
+def steps(log_dir) -> list[str]:
+    with open(log_dir / ArchInstaller.JOURNAL_FILENAME) as journal:
+        return [entry["key"] for entry in map(json.loads, journal) if entry.get("op") == "step"]
+
+
+def test_replay_recorded_install(session, monkeypatch):
+    image, profile, record_root, log_dir = session
+    recording = log_dir / "commands.jsonl"
+    args = dict(rootpass="r00t-secret", userpass={"archuser": "us3r-secret"})
+
+    # Recorded without disks or network: the runner of the recording answers every command
+    with monkeypatch.context() as m:
+        m.setattr(Command, "ROOT_PATH", str(record_root))
+        m.setattr(Command, "runner", RecordingRunner(str(recording), runner=ScriptedRunner(image)))
+        m.setattr(ArchInstaller, "rank_mirrors", lambda self: None)
+        m.setattr(ArchInstaller, "setup_parallel_download", lambda self, arch_chroot = True: None)
+        ArchInstaller(profile, **args).install()
+
+    recorded = steps(log_dir)
+    assert "finalize_initramfs" in recorded
+    assert (record_root / "etc/hostname").read_text() == "replayed\n"
+
+    # Replayed on a root of its own
+    installer = ArchInstaller(profile, replay=str(recording), **args)
+    replay_root = Command.ROOT_PATH
+    try:
+        assert isinstance(Command.runner, ReplayRunner)
+        assert replay_root != str(record_root)
+        installer.install()
+
+        assert sorted(steps(log_dir)) == sorted(recorded)
+        with open(f'{replay_root}/etc/hostname') as hostname:
+            assert hostname.read() == "replayed\n"
+        with open(f'{replay_root}/etc/sudoers') as sudoers:
+            assert "%wheel ALL=(ALL:ALL) ALL" in sudoers.read()
+        assert os.path.isdir(f'{replay_root}/efi')
+    finally:
+        shutil.rmtree(replay_root)